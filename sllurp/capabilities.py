@@ -0,0 +1,99 @@
+'''
+On-disk cache of reader capabilities
+'''
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CapabilitiesCache(object):
+	'''
+	Keeps the GET_READER_CAPABILITIES responses of readers in a JSON file,
+	keyed by manufacturer, model and firmware.
+
+	At connection time, the client only requests the small
+	GeneralDeviceCapabilities. When they match the cached ones, the cached
+	capabilities are used and the large response with the mode, power and
+	frequency tables is not decoded. Entries older than maxAge are
+	requested again without waiting for the response: it is handled with
+	the next messages the client reads and updates the cache and the
+	client's capabilities.
+
+		cache = CapabilitiesCache('capabilities.json')
+		reader = R420('192.168.4.2', capabilitiesCache=cache)
+	'''
+	def __init__(self, path, maxAge=86400.):
+		''':param path: JSON file of the cache
+		:param maxAge: seconds after which cached capabilities are refreshed,
+			0 refreshes at every connection
+		'''
+		self.path = path
+		self.maxAge = maxAge
+		self.entries = {} # key -> {'time': seconds since the epoch, 'capabilities': dict}
+		self.lock = threading.Lock()
+		if os.path.exists(path):
+			try:
+				with open(path) as file:
+					self.entries = json.load(file)
+			except ValueError:
+				logger.warning('Ignoring invalid capabilities cache %s', path)
+
+	@staticmethod
+	def key(gdc):
+		''':param gdc: GeneralDeviceCapabilities dictionary
+		:returns: cache key of the reader'''
+		return '{}-{}-{}'.format(gdc['DeviceManufacturerName'], gdc['ModelName'],
+			gdc['ReaderFirmwareVersion'])
+
+	def get(self, gdc):
+		''':param gdc: GeneralDeviceCapabilities dictionary of the reader
+		:returns: cache entry or None when the reader is unknown or differs'''
+		with self.lock:
+			entry = self.entries.get(self.key(gdc))
+		if entry is None or entry['capabilities'].get('GeneralDeviceCapabilities') != gdc:
+			return None
+		return entry
+
+	def put(self, capabilities):
+		'''stores the capabilities of a reader
+		:param capabilities: GET_READER_CAPABILITIES_RESPONSE dictionary'''
+		key = self.key(capabilities['GeneralDeviceCapabilities'])
+		with self.lock:
+			self.entries[key] = {'time': time.time(), 'capabilities': capabilities}
+			# replace the file at once so a concurrent load never sees half of it
+			temp = '{}.{}.tmp'.format(self.path, os.getpid())
+			with open(temp, 'w') as file:
+				json.dump(self.entries, file)
+			os.replace(temp, self.path)
+
+	def load(self, client):
+		'''sets the capabilities of a connected client from the cache
+		:param client: connected LLRPClient
+		:returns: True on a cache hit, False when the client has to request
+			all capabilities'''
+		client.send_GET_READER_CAPABILITIES('General Device Capabilities')
+		response = client.readLLRPMessage('GET_READER_CAPABILITIES_RESPONSE')
+		gdc = response.get('GeneralDeviceCapabilities')
+		entry = gdc and self.get(gdc)
+		if not entry:
+			return False
+		client.capabilities = entry['capabilities']
+		if time.time() - entry['time'] >= self.maxAge:
+			self.refresh(client)
+		return True
+
+	def refresh(self, client):
+		'''requests all capabilities of a client in the background.
+		The response is handled when the client reads its next messages.'''
+		def received(capabilities):
+			client.removeMsgCallback('GET_READER_CAPABILITIES_RESPONSE', received)
+			self.put(capabilities)
+			if capabilities != client.capabilities:
+				logger.info('Capabilities of %s changed', self.key(capabilities['GeneralDeviceCapabilities']))
+				client.capabilities = capabilities
+		client.addMsgCallback('GET_READER_CAPABILITIES_RESPONSE', received)
+		client.send_GET_READER_CAPABILITIES()
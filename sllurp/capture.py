@@ -0,0 +1,648 @@
+'''
+Recording of raw LLRP frames into capture files
+
+A capture file starts with MAGIC, followed by one record per LLRP message:
+a RECORD_HEADER (receive time in seconds since the epoch, direction and
+frame length) and the frame bytes. The sidecar index file (capture path +
+".idx") starts with INDEX_MAGIC, followed by one INDEX_ENTRY per frame:
+time, offset of the record, message type, custom subtype and direction.
+
+A compressed capture starts with COMPRESSED_MAGIC, followed by chunks: a
+CHUNK_HEADER (codec, compressed and raw length) and the compressed records.
+Every chunk can be decompressed on its own. Record offsets in the index
+are the offsets in the uncompressed capture. The chunk index (capture path
++ ".chunks") starts with CHUNK_MAGIC, followed by one CHUNK_ENTRY per chunk:
+offset of its first record in the uncompressed capture, offset of the
+chunk in the file and raw length.
+'''
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+from .compress import codecId, compress, decompress
+from .llrp import LLRPMessage
+from .llrp_proto import Message_struct
+
+try:
+	import numpy as np # optional, for filtering large indices
+except ImportError:
+	np = None
+
+MAGIC = b'LLRPCAP\x01'
+INDEX_MAGIC = b'LLRPIDX\x01'
+RECORD_HEADER = struct.Struct('!dBI') # time, direction, frame length
+INDEX_ENTRY = struct.Struct('!dQHBB') # time, record offset, type, subtype, direction
+COMPRESSED_MAGIC = b'LLRPCAZ\x01'
+CHUNK_MAGIC = b'LLRPCHK\x01'
+CHUNK_HEADER = struct.Struct('!BII') # codec, compressed length, raw length
+CHUNK_ENTRY = struct.Struct('!QQI') # record offset, chunk offset in the file, raw length
+
+RECEIVED = 0 # frame from the reader
+SENT = 1 # frame to the reader
+
+CUSTOM_MESSAGE_TYPE = 1023
+
+
+def frameType(frame):
+	''':param frame: encoded LLRP message
+	:returns: (message type, custom subtype or 0)'''
+	msgtype = struct.unpack_from('!H', frame)[0] & 0x3ff
+	if msgtype == CUSTOM_MESSAGE_TYPE and len(frame) >= 15:
+		return msgtype, frame[14]
+	return msgtype, 0
+
+
+def indexPath(path):
+	return path + '.idx'
+
+
+def chunkIndexPath(path):
+	return path + '.chunks'
+
+
+def scanChunks(data, offset=len(COMPRESSED_MAGIC), recordOffset=len(MAGIC)):
+	'''finds the complete chunks of a compressed capture
+	:param data: bytes or mmap of the capture
+	:param offset: file offset of the first chunk to scan
+	:param recordOffset: offset of its first record in the uncompressed capture
+	:returns: generator of CHUNK_ENTRY tuples'''
+	while offset + CHUNK_HEADER.size <= len(data):
+		_, compressed, raw = CHUNK_HEADER.unpack_from(data, offset)
+		if offset + CHUNK_HEADER.size + compressed > len(data):
+			return
+		yield recordOffset, offset, raw
+		offset += CHUNK_HEADER.size + compressed
+		recordOffset += raw
+
+
+class FrameRecorder(object):
+	'''
+	Appends every frame a LLRPClient sends or receives to a capture file.
+
+	The client only puts the frames into a queue. Encoding the records and
+	writing the file and its index happens in a background thread, so
+	recording does not slow down the decoding of tag reports:
+
+		with FrameRecorder('shift.llrp') as recorder:
+			recorder.attach(reader)
+			...
+
+	With compression, the records are compressed in chunks of chunkSize
+	bytes. A chunk is also written after chunkInterval seconds, the
+	records of an unwritten chunk are lost on a crash.
+	'''
+	def __init__(self, path, clock=time.time, flushInterval=1., bufferSize=1 << 20, 
+			compression=None, level=None, chunkSize=1 << 20, chunkInterval=60.):
+		''':param path: capture file, new frames are appended
+		:param clock: function returning the receive time in seconds
+		:param flushInterval: maximum seconds until records are flushed to disk
+		:param bufferSize: size of the file buffers in bytes
+		:param compression: "zlib", "lzma" or "zstd", None writes uncompressed
+		:param level: compression level, None for the codec's default
+		:param chunkSize: raw bytes per compressed chunk
+		:param chunkInterval: maximum seconds until a compressed chunk is written
+		'''
+		self.path = path
+		self.clock = clock
+		self.flushInterval = flushInterval
+		self.bufferSize = bufferSize
+		self.codec = codecId(compression) if compression else None
+		self.level = level
+		self.chunkSize = chunkSize
+		self.chunkInterval = chunkInterval
+		self.queue = queue.SimpleQueue()
+		self.frames = 0 # number of written frames
+		self.thread = None
+		self.clients = []
+
+	def start(self):
+		'''opens the files and starts the writer thread'''
+		if self.thread is not None:
+			return
+		magic = MAGIC if self.codec is None else COMPRESSED_MAGIC
+		self.offset = len(MAGIC) # record offset in the uncompressed capture
+		if os.path.exists(self.path) and os.path.getsize(self.path):
+			with open(self.path, 'r+b') as file:
+				if file.read(len(magic)) != magic:
+					raise ValueError('{} is not a{} capture'.format(self.path, 
+						'n uncompressed' if self.codec is None else ' compressed'))
+				if self.codec is None:
+					self._recoverRecords(file)
+				else:
+					self._recoverChunks(file)
+		self.file = open(self.path, 'ab', buffering=self.bufferSize)
+		self.index = open(indexPath(self.path), 'ab', buffering=self.bufferSize)
+		if self.file.tell() == 0:
+			self.file.write(magic)
+		if self.index.tell() == 0:
+			self.index.write(INDEX_MAGIC)
+		if self.codec is not None:
+			self.chunks = open(chunkIndexPath(self.path), 'ab')
+			if self.chunks.tell() == 0:
+				self.chunks.write(CHUNK_MAGIC)
+		self.thread = threading.Thread(target=self._write, name='FrameRecorder', daemon=True)
+		self.thread.start()
+
+	def close(self):
+		'''writes the queued frames, detaches from all clients and closes the files'''
+		for client in list(self.clients):
+			self.detach(client)
+		if self.thread is None:
+			return
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+		self.file.close()
+		self.index.close()
+		if self.codec is not None:
+			self.chunks.close()
+
+	def _recoverRecords(self, file):
+		'''drops a torn last record of an existing uncompressed capture, so
+		new records are appended behind the last complete one'''
+		data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			# records in front of an indexed offset were written completely
+			offset = _recordsEnd(data, self._indexedOffset(len(data)))
+			self.offset = offset
+			self._repairIndex(lambda after: (record
+				for record in _scanRecords(data, max(after, len(MAGIC))) if record[0] > after))
+		finally:
+			data.close()
+		file.truncate(offset)
+
+	def _indexedOffset(self, size):
+		''':returns: offset of the last indexed record which starts in the
+			first size bytes of the capture, or of the first record'''
+		path = indexPath(self.path)
+		if os.path.exists(path):
+			with open(path, 'rb') as index:
+				count = max(index.seek(0, os.SEEK_END) - len(INDEX_MAGIC), 0) // INDEX_ENTRY.size
+				while count:
+					index.seek(len(INDEX_MAGIC) + (count - 1) * INDEX_ENTRY.size)
+					offset = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[1]
+					if offset < size:
+						return offset
+					count -= 1
+		return len(MAGIC)
+
+	def _recoverChunks(self, file):
+		'''drops an incomplete last chunk and rewrites the chunk index
+		of an existing compressed capture'''
+		data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			chunks = list(scanChunks(data))
+			end = len(COMPRESSED_MAGIC)
+			if chunks:
+				recordOffset, offset, raw = chunks[-1]
+				end = offset + CHUNK_HEADER.size + CHUNK_HEADER.unpack_from(data, offset)[1]
+				self.offset = recordOffset + raw
+			self._repairIndex(lambda after: self._chunkRecords(data, chunks, after))
+		finally:
+			data.close()
+		file.truncate(end)
+		with open(chunkIndexPath(self.path), 'wb') as index:
+			index.write(CHUNK_MAGIC)
+			index.write(b''.join(CHUNK_ENTRY.pack(*chunk) for chunk in chunks))
+
+	@staticmethod
+	def _chunkRecords(data, chunks, after):
+		''':returns: generator of (offset, record) of the records in chunks behind offset after'''
+		for recordOffset, offset, raw in chunks:
+			if recordOffset + raw <= after:
+				continue
+			codec, compressed, _ = CHUNK_HEADER.unpack_from(data, offset)
+			start = offset + CHUNK_HEADER.size
+			chunk = decompress(codec, data[start:start + compressed], raw)
+			for local, record in _scanRecords(chunk):
+				if recordOffset + local > after:
+					yield recordOffset + local, record
+
+	def _repairIndex(self, records):
+		'''makes the index match the recovered capture: drops the entries of
+		records at or behind self.offset, e.g. of a truncated chunk, and adds
+		the entries of records which were written without them, e.g. when the
+		recorder crashed between writing a chunk and its entries
+		:param records: function returning (offset, record) of the records
+			behind an offset'''
+		with open(indexPath(self.path), 'a+b') as index:
+			size = index.seek(0, os.SEEK_END)
+			count = max(size - len(INDEX_MAGIC), 0) // INDEX_ENTRY.size
+			last = -1 # offset of the last indexed record
+			while count:
+				index.seek(len(INDEX_MAGIC) + (count - 1) * INDEX_ENTRY.size)
+				last = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[1]
+				if last < self.offset:
+					break
+				count -= 1
+				last = -1
+			index.truncate(len(INDEX_MAGIC) + count * INDEX_ENTRY.size)
+			if not count:
+				index.truncate(0)
+				index.write(INDEX_MAGIC)
+			for offset, record in records(last):
+				t, direction, _ = RECORD_HEADER.unpack_from(record)
+				msgtype, subtype = frameType(record[RECORD_HEADER.size:])
+				index.write(INDEX_ENTRY.pack(t, offset, msgtype, subtype, direction))
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def attach(self, client):
+		'''records the frames of a LLRPClient'''
+		self.start()
+		client.recorders.append(self)
+		self.clients.append(client)
+
+	def detach(self, client):
+		client.recorders.remove(self)
+		self.clients.remove(client)
+
+	def received(self, frame, t=None):
+		''':param frame: encoded LLRP message from the reader
+		:param t: receive time, defaults to now'''
+		self.queue.put((self.clock() if t is None else t, RECEIVED, frame))
+
+	def sent(self, frame, t=None):
+		''':param frame: encoded LLRP message to the reader
+		:param t: send time, defaults to now'''
+		self.queue.put((self.clock() if t is None else t, SENT, frame))
+
+	def _write(self):
+		'''writer thread'''
+		file, index = self.file, self.index
+		offset = self.offset
+		chunk = bytearray()
+		chunkIndex = [] # index entries of the records in chunk
+		chunkStart = None # monotonic time of the first record in chunk
+		lastFlush = time.monotonic()
+		running = True
+		while running:
+			records = []
+			# wait for frames, then take everything queued in the meantime
+			try:
+				records.append(self.queue.get(timeout=self.flushInterval))
+				while True:
+					records.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			for record in records:
+				if record is None:
+					running = False
+					break
+				t, direction, frame = record
+				msgtype, subtype = frameType(frame)
+				entry = INDEX_ENTRY.pack(t, offset, msgtype, subtype, direction)
+				if self.codec is None:
+					index.write(entry)
+					file.write(RECORD_HEADER.pack(t, direction, len(frame)))
+					file.write(frame)
+				else:
+					if chunkStart is None:
+						chunkStart = time.monotonic()
+					chunkIndex.append(entry)
+					chunk += RECORD_HEADER.pack(t, direction, len(frame))
+					chunk += frame
+				offset += RECORD_HEADER.size + len(frame)
+				self.frames += 1
+				if len(chunk) >= self.chunkSize:
+					self._writeChunk(chunk, chunkIndex, offset - len(chunk))
+					chunk = bytearray()
+					chunkIndex = []
+					chunkStart = None
+			now = time.monotonic()
+			if chunk and (not running or now - chunkStart >= self.chunkInterval):
+				self._writeChunk(chunk, chunkIndex, offset - len(chunk))
+				chunk = bytearray()
+				chunkIndex = []
+				chunkStart = None
+			if not running or now - lastFlush >= self.flushInterval:
+				file.flush()
+				index.flush()
+				lastFlush = now
+
+	def _writeChunk(self, chunk, entries, recordOffset):
+		'''compresses a chunk and writes it with its index entries.
+		The index is written after the chunk, so it never points behind the file.'''
+		data = compress(self.codec, bytes(chunk), self.level)
+		offset = self.file.tell()
+		self.file.write(CHUNK_HEADER.pack(self.codec, len(data), len(chunk)))
+		self.file.write(data)
+		self.file.flush()
+		self.chunks.write(CHUNK_ENTRY.pack(recordOffset, offset, len(chunk)))
+		self.chunks.flush()
+		self.index.write(b''.join(entries))
+
+
+def readRecords(file):
+	'''reads a capture file sequentially. A truncated last record is ignored.
+	:param file: capture file opened in binary mode, may be compressed
+	:returns: generator of (time, direction, frame)'''
+	magic = file.read(len(MAGIC))
+	if magic == COMPRESSED_MAGIC:
+		yield from _readChunkRecords(file)
+		return
+	if magic != MAGIC:
+		raise ValueError('not a LLRP capture file')
+	while True:
+		header = file.read(RECORD_HEADER.size)
+		if len(header) < RECORD_HEADER.size:
+			return
+		t, direction, length = RECORD_HEADER.unpack(header)
+		frame = file.read(length)
+		if len(frame) < length:
+			return
+		yield t, direction, frame
+
+
+def _readChunkRecords(file):
+	'''reads the chunks of a compressed capture. A truncated last chunk is ignored.'''
+	while True:
+		header = file.read(CHUNK_HEADER.size)
+		if len(header) < CHUNK_HEADER.size:
+			return
+		codec, compressed, raw = CHUNK_HEADER.unpack(header)
+		data = file.read(compressed)
+		if len(data) < compressed:
+			return
+		for _, record in _scanRecords(decompress(codec, data, raw)):
+			t, direction, _ = RECORD_HEADER.unpack_from(record)
+			yield t, direction, record[RECORD_HEADER.size:]
+
+
+def _recordsEnd(data, offset):
+	''':returns: end of the last complete record, starting at the record at offset'''
+	while offset + RECORD_HEADER.size <= len(data):
+		end = offset + RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, offset)[2]
+		if end > len(data):
+			break
+		offset = end
+	return offset
+
+
+def _scanRecords(data, offset=0):
+	''':returns: generator of (offset, record) of the complete records in data'''
+	while offset + RECORD_HEADER.size <= len(data):
+		length = RECORD_HEADER.unpack_from(data, offset)[2]
+		end = offset + RECORD_HEADER.size + length
+		if end > len(data):
+			return
+		yield offset, data[offset:end]
+		offset = end
+
+
+def _timestamp(t):
+	return t.timestamp() if isinstance(t, datetime) else t
+
+
+class CaptureFile(object):
+	'''
+	Random access to a capture file through memory maps.
+
+	The index is searched by time with a binary search, so only the
+	selected frames of the capture are touched. Frames are returned as
+	memoryviews of the mapped file without copying. Without an index file
+	(e.g. after a crash), it is rebuilt by scanning the capture once.
+	Records are expected in time order, as written by FrameRecorder.
+	In compressed captures, only the chunks of the selected frames are
+	decompressed, the last cacheChunks of them are kept.
+
+		with CaptureFile('shift.llrp') as capture:
+			start = datetime(2024, 5, 6, 14, 2)
+			for msg in capture.messages(start, start + timedelta(minutes=1),
+					types=('RO_ACCESS_REPORT',)):
+				...
+	'''
+	if np is not None:
+		indexDtype = np.dtype([('time', '>f8'), ('offset', '>u8'), ('type', '>u2'),
+			('subtype', 'u1'), ('direction', 'u1')])
+
+	def __init__(self, path, cacheChunks=4):
+		''':param path: capture file of FrameRecorder
+		:param cacheChunks: number of decompressed chunks to keep'''
+		self.path = path
+		self.index = self.indexMap = None
+		self.chunkStarts = None # record offsets of the chunks of a compressed capture
+		self.cache = OrderedDict() # chunk number -> decompressed chunk
+		self.cacheChunks = cacheChunks
+		self.file = open(path, 'rb')
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic = self.data[:len(MAGIC)]
+		if magic == COMPRESSED_MAGIC:
+			self._loadChunks()
+		elif magic == MAGIC:
+			self.size = len(self.data)
+		else:
+			self.close()
+			raise ValueError('not a LLRP capture file')
+		self.index = self._loadIndex()
+		self.count = (len(self.index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+
+	def _loadChunks(self):
+		'''reads the chunk index and scans the chunks written after it'''
+		chunks = []
+		path = chunkIndexPath(self.path)
+		if os.path.exists(path):
+			with open(path, 'rb') as file:
+				table = file.read()
+			if table[:len(CHUNK_MAGIC)] == CHUNK_MAGIC:
+				for entry in CHUNK_ENTRY.iter_unpack(table[len(CHUNK_MAGIC):
+						len(table) - (len(table) - len(CHUNK_MAGIC)) % CHUNK_ENTRY.size]):
+					offset = entry[1]
+					if offset + CHUNK_HEADER.size > len(self.data) or offset + CHUNK_HEADER.size + \
+							CHUNK_HEADER.unpack_from(self.data, offset)[1] > len(self.data):
+						break
+					chunks.append(entry)
+		if chunks:
+			recordOffset, offset, raw = chunks[-1]
+			chunks.extend(scanChunks(self.data, offset + CHUNK_HEADER.size + 
+				CHUNK_HEADER.unpack_from(self.data, offset)[1], recordOffset + raw))
+		else:
+			chunks = list(scanChunks(self.data))
+		self.chunkStarts = [chunk[0] for chunk in chunks]
+		self.chunkOffsets = [chunk[1] for chunk in chunks]
+		self.size = chunks[-1][0] + chunks[-1][2] if chunks else len(MAGIC)
+
+	def _chunk(self, i):
+		''':returns: decompressed chunk i'''
+		cache = self.cache
+		try:
+			cache.move_to_end(i)
+			return cache[i]
+		except KeyError:
+			pass
+		offset = self.chunkOffsets[i]
+		codec, compressed, raw = CHUNK_HEADER.unpack_from(self.data, offset)
+		start = offset + CHUNK_HEADER.size
+		chunk = cache[i] = decompress(codec, self.data[start:start + compressed], raw)
+		if len(cache) > self.cacheChunks:
+			cache.popitem(last=False)
+		return chunk
+
+	def _records(self):
+		'''yields (offset, record) of all complete records'''
+		if self.chunkStarts is None:
+			yield from _scanRecords(self.data, len(MAGIC))
+		else:
+			for i, base in enumerate(self.chunkStarts):
+				for offset, record in _scanRecords(self._chunk(i)):
+					yield base + offset, record
+
+	def _loadIndex(self):
+		''':returns: index entries of all complete records'''
+		path = indexPath(self.path)
+		if os.path.exists(path) and os.path.getsize(path) > len(INDEX_MAGIC):
+			with open(path, 'rb') as file:
+				index = self.indexMap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+			if index[:len(INDEX_MAGIC)] == INDEX_MAGIC:
+				# ignore entries of records which were not written completely
+				count = (len(index) - len(INDEX_MAGIC)) // INDEX_ENTRY.size
+				while count:
+					offset = INDEX_ENTRY.unpack_from(index, len(INDEX_MAGIC) + (count-1)*INDEX_ENTRY.size)[1]
+					if self.chunkStarts is not None:
+						if offset < self.size: # chunks are written completely
+							break
+					elif offset + RECORD_HEADER.size <= len(self.data):
+						length = RECORD_HEADER.unpack_from(self.data, offset)[2]
+						if offset + RECORD_HEADER.size + length <= len(self.data):
+							break
+					count -= 1
+				return memoryview(index)[:len(INDEX_MAGIC) + count*INDEX_ENTRY.size]
+		return self._buildIndex()
+
+	def _buildIndex(self):
+		'''scans the capture and creates the index in memory'''
+		index = bytearray(INDEX_MAGIC)
+		for offset, record in self._records():
+			t, direction, _ = RECORD_HEADER.unpack_from(record)
+			msgtype, subtype = frameType(record[RECORD_HEADER.size:])
+			index += INDEX_ENTRY.pack(t, offset, msgtype, subtype, direction)
+		return memoryview(bytes(index))
+
+	def close(self):
+		'''closes the file. Frames returned before must not be used anymore'''
+		if self.index is not None:
+			self.index.release()
+			self.index = None
+		if self.indexMap is not None:
+			self.indexMap.close()
+		self.cache.clear()
+		self.data.close()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __len__(self):
+		return self.count
+
+	def entry(self, i):
+		''':returns: index entry i as (time, offset, type, subtype, direction)'''
+		return INDEX_ENTRY.unpack_from(self.index, len(INDEX_MAGIC) + i*INDEX_ENTRY.size)
+
+	def bisect(self, t):
+		''':param t: time in seconds since the epoch or datetime
+		:returns: number of frames before t'''
+		t = _timestamp(t)
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.entry(mid)[0] < t:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	@property
+	def timeRange(self):
+		''':returns: (first, last) frame time or None for an empty capture'''
+		if not self.count:
+			return None
+		return self.entry(0)[0], self.entry(self.count - 1)[0]
+
+	def _types(self, types):
+		''':param types: message names or types
+		:returns: set of (type, subtype) with subtype None for all subtypes'''
+		result = set()
+		for msgtype in types:
+			if isinstance(msgtype, int):
+				result.add((msgtype, None))
+			else:
+				ms = Message_struct[msgtype]
+				result.add((ms['type'], ms.get('subtype') if ms['type'] == CUSTOM_MESSAGE_TYPE else None))
+		return result
+
+	def select(self, start=None, end=None, types=None, direction=None):
+		'''finds frames in the index
+		:param start: first time (seconds since the epoch or datetime), None from the beginning
+		:param end: time to stop before, None to the end
+		:param types: message names or types, e.g. ('RO_ACCESS_REPORT',), None for all
+		:param direction: RECEIVED or SENT, None for both
+		:returns: list of index entries (time, offset, type, subtype, direction)'''
+		first = 0 if start is None else self.bisect(start)
+		last = self.count if end is None else self.bisect(end)
+		if first >= last:
+			return []
+		wanted = self._types(types) if types else None
+		if np is not None:
+			entries = np.frombuffer(self.index, dtype=self.indexDtype, count=last - first,
+				offset=len(INDEX_MAGIC) + first*INDEX_ENTRY.size)
+			mask = np.ones(len(entries), dtype=bool)
+			if direction is not None:
+				mask &= entries['direction'] == direction
+			if wanted:
+				match = np.zeros(len(entries), dtype=bool)
+				for msgtype, subtype in wanted:
+					m = entries['type'] == msgtype
+					if subtype is not None:
+						m &= entries['subtype'] == subtype
+					match |= m
+				mask &= match
+			return [tuple(entry) for entry in entries[mask].tolist()]
+		result = []
+		for i in range(first, last):
+			entry = self.entry(i)
+			if direction is not None and entry[4] != direction:
+				continue
+			if wanted and (entry[2], entry[3]) not in wanted and (entry[2], None) not in wanted:
+				continue
+			result.append(entry)
+		return result
+
+	def frame(self, offset):
+		''':param offset: record offset from the index
+		:returns: memoryview of the frame'''
+		data = self.data
+		if self.chunkStarts is not None:
+			i = bisect_right(self.chunkStarts, offset) - 1
+			data = self._chunk(i)
+			offset -= self.chunkStarts[i]
+		length = RECORD_HEADER.unpack_from(data, offset)[2]
+		start = offset + RECORD_HEADER.size
+		return memoryview(data)[start:start + length]
+
+	def frames(self, start=None, end=None, types=None, direction=None):
+		'''yields (time, direction, frame) of the selected frames,
+		see "select" for the parameters. Frames are memoryviews of the file'''
+		for t, offset, _, _, frameDirection in self.select(start, end, types, direction):
+			yield t, frameDirection, self.frame(offset)
+
+	def messages(self, start=None, end=None, types=None, direction=RECEIVED):
+		'''decodes the selected frames, see "select" for the parameters.
+		Only messages from the reader can be decoded.
+		:returns: generator of (time, LLRPMessage)'''
+		for t, _, frame in self.frames(start, end, types, direction):
+			yield t, LLRPMessage(msgbytes=bytes(frame))
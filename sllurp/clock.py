@@ -0,0 +1,195 @@
+'''
+Mapping reader timestamps to the host clock
+'''
+from array import array
+from collections import deque
+import threading
+import time
+
+try:
+	import numpy as np # optional, for converting arrays
+except ImportError:
+	np = None
+
+
+class ClockModel(object):
+	'''
+	Linear model host = reader + offset + drift * reader for one time base.
+
+	Every sample pairs a reader timestamp with the host time it arrived.
+	The difference is the clock offset plus the transfer delay, so the
+	smallest difference within a window is the best offset estimate
+	(like NTP). Offset and drift are fitted through the minima of the
+	last windows. Samples of tag reads are only upper bounds, the read may
+	be up to a report interval older than the report. They are only used
+	in windows without exact samples, e.g. of reader events. When the
+	reader time goes back by more than a window (reboot or clock change),
+	the older windows are dropped.
+	'''
+	def __init__(self, window=2., windows=32):
+		''':param window: length of a window in seconds of reader time
+		:param windows: number of windows to fit the drift over
+		'''
+		self.window = window
+		self.minima = deque(maxlen=windows) # (reader time, min offset) per window
+		# [window start, reader time, min offset, reader time, min offset of bounds]
+		# of the open window, None for no samples
+		self.current = None
+		self.origin = None # reader time in seconds the fit is centered around
+		self.offset = None # host - reader in seconds at origin
+		self.drift = 0. # seconds per second
+
+	def add(self, readerS, hostS, bound=False):
+		''':param readerS: reader timestamp in seconds
+		:param hostS: host time of arrival in seconds
+		:param bound: the reader timestamp may be older than the message,
+			e.g. the last seen time of a tag'''
+		diff = hostS - readerS
+		current = self.current
+		if current is not None and readerS < current[0] - self.window:
+			self.minima.clear() # new epoch
+			current = None
+		if current is None or readerS - current[0] >= self.window:
+			if current is not None:
+				self.minima.append(self._point(current))
+			current = self.current = [readerS, None, None, None, None]
+		i = 3 if bound else 1
+		if current[i] is None or diff < current[i + 1]:
+			current[i] = readerS
+			current[i + 1] = diff
+		self.fit()
+
+	@staticmethod
+	def _point(window):
+		''':returns: (reader time, min offset) of a window, preferring exact samples'''
+		return (window[1], window[2]) if window[1] is not None else (window[3], window[4])
+
+	def fit(self):
+		points = list(self.minima)
+		if self.current is not None:
+			points.append(self._point(self.current))
+		n = len(points)
+		xMean = sum(p[0] for p in points) / n
+		yMean = sum(p[1] for p in points) / n
+		sxx = sum((p[0] - xMean)**2 for p in points)
+		if n > 1 and sxx > 0:
+			self.drift = sum((p[0] - xMean)*(p[1] - yMean) for p in points) / sxx
+		else:
+			self.drift = 0.
+		self.origin = xMean
+		self.offset = yMean
+
+	@property
+	def synced(self):
+		return self.offset is not None
+
+	def toHost(self, readerS):
+		''':param readerS: reader timestamp in seconds
+		:returns: host time in seconds'''
+		return readerS + self.offset + self.drift * (readerS - self.origin)
+
+
+class ReaderClock(object):
+	'''
+	Converts reader timestamps (microseconds of uptime or UTC) to the host's
+	time.monotonic(), so reads of several readers share one timeline.
+
+	The clock learns from the Uptime/UTCTimestamp of reader event
+	notifications and from the last seen timestamps of tag reports,
+	each paired with its arrival time:
+
+		clock = ReaderClock()
+		clock.attach(reader)
+		...
+		hostTimes = clock.convertBatch(batch)
+	'''
+	def __init__(self, window=2., windows=32, host=time.monotonic):
+		''':param window: length of an offset window in seconds
+		:param windows: number of windows to estimate the drift from
+		:param host: host clock function returning seconds
+		'''
+		self.host = host
+		self.uptime = ClockModel(window, windows)
+		self.utc = ClockModel(window, windows)
+		self.lock = threading.Lock()
+
+	def model(self, utc=False):
+		return self.utc if utc else self.uptime
+
+	def addSample(self, readerUs, hostS=None, utc=False, bound=False):
+		'''adds a reader timestamp with the host time it was received
+		:param readerUs: reader timestamp in microseconds
+		:param hostS: host time in seconds, defaults to now
+		:param utc: the timestamp is UTC, not uptime
+		:param bound: the timestamp may be older than the message'''
+		if hostS is None:
+			hostS = self.host()
+		with self.lock:
+			self.model(utc).add(readerUs * 1e-6, hostS, bound)
+
+	def attach(self, client):
+		'''learns from the messages a LLRPClient receives'''
+		client.addMsgCallback('READER_EVENT_NOTIFICATION', self.onReaderEvent)
+		client.addMsgCallback('RO_ACCESS_REPORT', self.onReport)
+
+	def detach(self, client):
+		client.removeMsgCallback('READER_EVENT_NOTIFICATION', self.onReaderEvent)
+		client.removeMsgCallback('RO_ACCESS_REPORT', self.onReport)
+
+	def onReaderEvent(self, msgdict):
+		'''callback for READER_EVENT_NOTIFICATION'''
+		now = self.host()
+		data = msgdict.get('ReaderEventNotificationData', {})
+		if 'Uptime' in data:
+			self.addSample(data['Uptime']['Microseconds'], now)
+		elif 'UTCTimestamp' in data:
+			self.addSample(data['UTCTimestamp']['Microseconds'], now, utc=True)
+
+	def onReport(self, msgdict):
+		'''callback for RO_ACCESS_REPORT, uses the latest read of the report
+		as upper bound of the offset'''
+		now = self.host()
+		uptime = utc = None
+		for tag in msgdict.get('TagReportData') or []:
+			if 'LastSeenTimestampUptime' in tag:
+				uptime = max(uptime or 0, tag['LastSeenTimestampUptime'])
+			elif 'LastSeenTimestampUTC' in tag:
+				utc = max(utc or 0, tag['LastSeenTimestampUTC'])
+		if uptime:
+			self.addSample(uptime, now, bound=True)
+		if utc:
+			self.addSample(utc, now, utc=True, bound=True)
+
+	@property
+	def synced(self):
+		return self.uptime.synced or self.utc.synced
+
+	def toHost(self, readerUs, utc=False):
+		''':param readerUs: reader timestamp in microseconds
+		:param utc: the timestamp is UTC, not uptime
+		:returns: host time in seconds'''
+		model = self.model(utc)
+		if not model.synced:
+			raise ValueError('no {} samples yet'.format('UTC' if utc else 'uptime'))
+		return model.toHost(readerUs * 1e-6)
+
+	def convert(self, timestamps, utc=False):
+		'''converts many reader timestamps at once
+		:param timestamps: sequence of timestamps in microseconds,
+			e.g. the last_seen column of a TagBatch
+		:param utc: the timestamps are UTC, not uptime
+		:returns: NumPy array (or array.array without NumPy) of host times in seconds'''
+		model = self.model(utc)
+		if not model.synced:
+			raise ValueError('no {} samples yet'.format('UTC' if utc else 'uptime'))
+		scale = 1e-6 * (1. + model.drift)
+		shift = model.offset - model.drift * model.origin
+		if np is not None:
+			return np.asarray(timestamps, dtype=float) * scale + shift
+		return array('d', [t * scale + shift for t in timestamps])
+
+	def convertBatch(self, batch, column='last_seen'):
+		''':param batch: TagBatch with uptime timestamps
+		:param column: "first_seen" or "last_seen"
+		:returns: host times in seconds of every row'''
+		return self.convert(batch.data[column])
@@ -0,0 +1,60 @@
+'''
+Codecs for compressing captures in independent chunks
+
+zlib and lzma come with Python, zstd needs the zstandard package.
+'''
+import lzma
+import zlib
+
+try:
+	import zstandard # optional, for zstd
+except ImportError:
+	zstandard = None
+
+# codec name -> id stored in the chunk headers
+CODECS = {'zlib': 1, 'lzma': 2, 'zstd': 3}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+
+
+def codecId(name):
+	''':param name: "zlib", "lzma" or "zstd"
+	:returns: id of the codec
+	:raises ValueError: for unknown codecs
+	:raises ImportError: when zstandard is missing'''
+	try:
+		codec = CODECS[name]
+	except KeyError:
+		raise ValueError('unknown compression {}, use one of {}'.format(name, ', '.join(CODECS)))
+	if name == 'zstd' and zstandard is None:
+		raise ImportError('zstd compression needs the zstandard package')
+	return codec
+
+
+def compress(codec, data, level=None):
+	''':param codec: codec id
+	:param data: bytes of one chunk
+	:param level: compression level, None for the codec's default
+	:returns: compressed bytes, which can be decompressed on their own'''
+	if codec == 1:
+		return zlib.compress(data, 6 if level is None else level)
+	if codec == 2:
+		return lzma.compress(data, preset=level)
+	if codec == 3:
+		return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+	raise ValueError('unknown codec id {}'.format(codec))
+
+
+def decompress(codec, data, rawLength):
+	''':param codec: codec id
+	:param data: compressed chunk
+	:param rawLength: length of the decompressed chunk
+	:returns: decompressed bytes'''
+	if codec == 1:
+		return zlib.decompress(data, bufsize=rawLength)
+	if codec == 2:
+		return lzma.decompress(data)
+	if codec == 3:
+		if zstandard is None:
+			raise ImportError('zstd compression needs the zstandard package')
+		return zstandard.ZstdDecompressor().decompress(data, max_output_size=rawLength)
+	raise ValueError('unknown codec id {}'.format(codec))
@@ -0,0 +1,213 @@
+'''
+Merging the tag streams of several readers
+'''
+from collections import namedtuple, deque, OrderedDict
+import heapq
+import threading
+import time
+
+from .tags import TagRead, TagBatch, tagEPC
+
+FusedRead = namedtuple('FusedRead', ('time', 'source', 'tag'))
+
+
+class FusionSource(object):
+	'''
+	Input of one reader into a StreamFusion.
+	Its update method can be used as callback of Reader.startLiveReports.
+	'''
+	def __init__(self, fusion, index, name, clock=None):
+		self.fusion = fusion
+		self.index = index
+		self.name = name
+		self.clock = clock # ReaderClock to normalise the tag timestamps
+		self.queue = deque() # time ordered (time, tag) not yet merged
+		self.latest = float('-inf') # time of the latest read pushed
+
+	def readTime(self, tag, now):
+		''':returns: host time of a read. Arrival time without synced clock'''
+		clock = self.clock
+		if clock is None or not clock.synced:
+			return now
+		if isinstance(tag, TagRead):
+			uptime, utc = tag.last_seen, (tag.extra or {}).get('LastSeenTimestampUTC')
+		else:
+			uptime, utc = tag.get('LastSeenTimestampUptime'), tag.get('LastSeenTimestampUTC')
+		if uptime is not None and clock.uptime.synced:
+			return clock.toHost(uptime)
+		if utc is not None and clock.utc.synced:
+			return clock.toHost(utc, utc=True)
+		return now
+
+	def update(self, tags, now=None):
+		'''pushes the reads of a tag report
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param now: arrival time in seconds, defaults to the fusion's host clock
+		:returns: list of FusedReads which became ready'''
+		return self.fusion.push(self, tags, now)
+
+
+class StreamFusion(object):
+	'''
+	Merges the reads of several readers into one time ordered stream.
+
+	Each source keeps its reads in time order. A heap holds the oldest
+	pending read of every source, so emitting the next read costs O(log N)
+	for N sources. A read is emitted when every source has delivered
+	reads at least as new, or when it is older than the reorder window.
+	Reads of the same EPC by another reader within the tolerance are
+	dropped as duplicates.
+
+		fusion = StreamFusion(window=0.5, tolerance=0.05, callback=handle)
+		for reader in readers:
+			source = fusion.addSource(reader.ip, reader.clock)
+			reader.startLiveReports(source.update, tagInterval=None, timeInterval=0.2)
+	'''
+	def __init__(self, window=0.5, tolerance=0.05, callback=None, host=time.monotonic):
+		''':param window: maximum time in seconds a read waits for slower sources
+		:param tolerance: reads of the same EPC by different readers within this
+			time in seconds are duplicates
+		:param callback: function which gets called with every FusedRead
+		:param host: host clock function returning seconds
+		'''
+		self.window = window
+		self.tolerance = tolerance
+		self.callback = callback
+		self.host = host
+		self.sources = []
+		self.heads = [] # heap of (time, sequence, source index)
+		self.sequence = 0 # keeps the heap order stable for equal times
+		self.latest = [] # heap of (latest time, source index), outdated entries are skipped
+		self.recent = OrderedDict() # epc -> (time, source index) of emitted reads
+		self.duplicates = 0
+		self.lock = threading.Lock() # sources are fed from several reader threads
+		self.outbox = deque() # emitted reads for the callback
+		self.delivering = False # a thread is calling the callback
+
+	def addSource(self, name=None, clock=None):
+		''':param name: name to identify the reader in FusedReads
+		:param clock: ReaderClock of the reader to normalise timestamps
+		:returns: FusionSource'''
+		with self.lock:
+			source = FusionSource(self, len(self.sources), name, clock)
+			self.sources.append(source)
+			heapq.heappush(self.latest, (source.latest, source.index))
+		return source
+
+	def _pushHead(self, source, t):
+		heapq.heappush(self.heads, (t, self.sequence, source.index))
+		self.sequence += 1
+
+	def _pushLatest(self, source):
+		latest = self.latest
+		heapq.heappush(latest, (source.latest, source.index))
+		if len(latest) > 2 * len(self.sources):
+			# an idle source keeps the outdated entries of the others from the top
+			latest[:] = [(s.latest, s.index) for s in self.sources]
+			heapq.heapify(latest)
+
+	def push(self, source, tags, now=None):
+		'''adds the reads of a tag report of a source, see FusionSource.update'''
+		if now is None:
+			now = self.host()
+		if isinstance(tags, TagBatch):
+			tags = tags.toTags()
+		reads = sorted(((source.readTime(tag, now), i, tag) for i, tag in enumerate(tags)),
+			key=lambda read: (read[0], read[1]))
+		with self.lock:
+			wasEmpty = not source.queue
+			for t, _, tag in reads:
+				# keep the queue ordered when reports overlap in time
+				t = max(t, source.latest)
+				source.queue.append((t, tag))
+				source.latest = t
+			if reads:
+				self._pushLatest(source)
+			if wasEmpty and source.queue:
+				self._pushHead(source, source.queue[0][0])
+			emitted = self._drain(now - self.window)
+		self._deliver()
+		return emitted
+
+	def flush(self, now=None, final=False):
+		'''emits reads which waited longer than the reorder window.
+		Call it periodically when sources may stop reporting.
+		:param now: current time in seconds, defaults to the host clock
+		:param final: emit all pending reads
+		:returns: list of FusedReads'''
+		if now is None:
+			now = self.host()
+		with self.lock:
+			emitted = self._drain(float('inf') if final else now - self.window)
+		self._deliver()
+		return emitted
+
+	def _watermark(self):
+		''':returns: time up to which all sources delivered their reads'''
+		latest, sources = self.latest, self.sources
+		while latest and latest[0][0] != sources[latest[0][1]].latest:
+			heapq.heappop(latest) # the source pushed newer reads since
+		return latest[0][0] if latest else float('-inf')
+
+	def _drain(self, expired):
+		'''emits all reads which are safe to emit, needs the lock'''
+		watermark = max(self._watermark(), expired)
+		emitted = []
+		heads = self.heads
+		while heads and heads[0][0] <= watermark:
+			t, _, index = heapq.heappop(heads)
+			source = self.sources[index]
+			_, tag = source.queue.popleft()
+			if source.queue:
+				self._pushHead(source, source.queue[0][0])
+			if self._isDuplicate(tag, t, index):
+				self.duplicates += 1
+				continue
+			read = FusedRead(t, source.name, tag)
+			emitted.append(read)
+		if self.callback:
+			self.outbox.extend(emitted)
+		return emitted
+
+	def _deliver(self):
+		'''calls the callback with the emitted reads in order, without the lock.
+		One thread at a time delivers, so a callback may push or flush and
+		a slow callback does not block the sources.'''
+		with self.lock:
+			if self.delivering or not self.outbox:
+				return # the delivering thread takes the new reads
+			self.delivering = True
+		try:
+			while True:
+				with self.lock:
+					if not self.outbox:
+						self.delivering = False
+						return
+					reads = list(self.outbox)
+					self.outbox.clear()
+				for read in reads:
+					self.callback(read)
+		except BaseException:
+			with self.lock:
+				self.delivering = False
+			raise
+
+	def _isDuplicate(self, tag, t, index):
+		recent = self.recent
+		# forget reads older than the tolerance, they are in time order
+		while recent:
+			epc, (last, _) = next(iter(recent.items()))
+			if t - last <= self.tolerance:
+				break
+			del recent[epc]
+		epc = tagEPC(tag)
+		seen = recent.get(epc)
+		if seen is not None and seen[1] != index:
+			return True
+		recent[epc] = (t, index)
+		recent.move_to_end(epc)
+		return False
+
+	def pending(self):
+		''':returns: number of reads waiting to be merged'''
+		return sum(len(source.queue) for source in self.sources)
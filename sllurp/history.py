@@ -0,0 +1,443 @@
+'''
+Persistent history of where and when every EPC was seen
+
+The store directory holds append-only segment files with the reads of one
+generation each ("segment-<generation>.log") and a snapshot
+("index-<generation>.db") with the first and last sighting of every EPC per
+reader and antenna up to its generation. The reads of the newer segments
+are also kept in memory. When they reach maxRecent EPCs, a background
+thread merges them into a new snapshot and deletes the merged segments.
+
+A segment record is a SEGMENT_RECORD (time, antenna, EPC length, reader
+length) followed by the EPC and reader name. A snapshot starts with a
+SNAPSHOT_HEADER, followed by a hash table of SLOT entries (hash of the EPC,
+offset of its entry) with linear probing and the entries: an ENTRY_HEADER
+(EPC length, number of sightings), the EPC and one SIGHTING plus reader
+name per reader and antenna.
+'''
+from collections import namedtuple
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+
+from .tags import TagRead, TagBatch
+
+logger = logging.getLogger(__name__)
+
+HistoryRecord = namedtuple('HistoryRecord', ('reader', 'antenna', 'firstSeen', 'lastSeen', 'count'))
+
+MAGIC = b'LLRPHIX\x01'
+SNAPSHOT_HEADER = struct.Struct('!8sQQQ') # magic, generation, slots, entries
+SLOT = struct.Struct('!QQ') # EPC hash, entry offset (0: empty)
+ENTRY_HEADER = struct.Struct('!BH') # EPC length, number of sightings
+SIGHTING = struct.Struct('!ddIHB') # first, last, count, antenna, reader length
+SEGMENT_RECORD = struct.Struct('!dHBB') # time, antenna, EPC length, reader length
+
+
+def epcHash(epc):
+	''':returns: 64 bit hash of an EPC, the same in every process'''
+	return int.from_bytes(hashlib.blake2b(epc, digest_size=8).digest(), 'big')
+
+
+def _epc(epc):
+	return epc.encode() if isinstance(epc, str) else bytes(epc)
+
+
+class _Snapshot(object):
+	'''memory mapped snapshot file'''
+	def __init__(self, path):
+		self.path = path
+		self.file = open(path, 'rb')
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.generation, self.slots, self.entries = SNAPSHOT_HEADER.unpack_from(self.data)
+		if magic != MAGIC:
+			self.close()
+			raise ValueError('not a history snapshot: {}'.format(path))
+		self.dataStart = SNAPSHOT_HEADER.size + self.slots * SLOT.size
+
+	def close(self):
+		self.data.close()
+		self.file.close()
+
+	def entry(self, offset):
+		''':returns: (EPC, {(reader, antenna): [first, last, count]}, next offset)'''
+		data = self.data
+		epcLen, n = ENTRY_HEADER.unpack_from(data, offset)
+		offset += ENTRY_HEADER.size
+		epc = data[offset:offset + epcLen]
+		offset += epcLen
+		sightings = {}
+		for _ in range(n):
+			first, last, count, antenna, readerLen = SIGHTING.unpack_from(data, offset)
+			offset += SIGHTING.size
+			reader = data[offset:offset + readerLen].decode()
+			offset += readerLen
+			sightings[(reader, antenna)] = [first, last, count]
+		return epc, sightings, offset
+
+	def find(self, epc):
+		''':returns: sightings of an EPC or None'''
+		if not self.slots:
+			return None
+		h = epcHash(epc)
+		mask = self.slots - 1
+		i = h & mask
+		data = self.data
+		while True:
+			slotHash, offset = SLOT.unpack_from(data, SNAPSHOT_HEADER.size + i * SLOT.size)
+			if not offset:
+				return None
+			if slotHash == h:
+				found, sightings, _ = self.entry(offset)
+				if found == epc:
+					return sightings
+			i = (i + 1) & mask
+
+	def __iter__(self):
+		'''yields (EPC, sightings) of all entries'''
+		offset = self.dataStart
+		while offset < len(self.data):
+			epc, sightings, offset = self.entry(offset)
+			yield epc, sightings
+
+
+def _merge(sightings, other):
+	'''adds the sightings of other to sightings'''
+	for key, (first, last, count) in other.items():
+		known = sightings.get(key)
+		if known is None:
+			sightings[key] = [first, last, count]
+		else:
+			known[0] = min(known[0], first)
+			known[1] = max(known[1], last)
+			known[2] += count
+
+
+def _writeSnapshot(path, generation, entries, count):
+	'''writes a snapshot
+	:param entries: iterable of (EPC, sightings)
+	:param count: upper limit of the number of entries'''
+	slots = 1
+	while slots < 2 * count:
+		slots *= 2
+	dataStart = SNAPSHOT_HEADER.size + slots * SLOT.size
+	temp = path + '.tmp'
+	written = 0
+	with open(temp, 'w+b') as file:
+		file.truncate(dataStart)
+		table = mmap.mmap(file.fileno(), dataStart)
+		try:
+			with open(temp, 'r+b', buffering=1 << 20) as out:
+				out.seek(dataStart)
+				offset = dataStart
+				mask = slots - 1
+				for epc, sightings in entries:
+					i = epcHash(epc) & mask
+					while SLOT.unpack_from(table, SNAPSHOT_HEADER.size + i * SLOT.size)[1]:
+						i = (i + 1) & mask
+					SLOT.pack_into(table, SNAPSHOT_HEADER.size + i * SLOT.size, epcHash(epc), offset)
+					entry = [ENTRY_HEADER.pack(len(epc), len(sightings)), epc]
+					for (reader, antenna), (first, last, n) in sightings.items():
+						reader = reader.encode()
+						entry.append(SIGHTING.pack(first, last, n, antenna, len(reader)))
+						entry.append(reader)
+					entry = b''.join(entry)
+					out.write(entry)
+					offset += len(entry)
+					written += 1
+			SNAPSHOT_HEADER.pack_into(table, 0, MAGIC, generation, slots, written)
+			table.flush()
+		finally:
+			table.close()
+		# the merged segments are deleted afterwards, the snapshot has to be on disk
+		os.fsync(file.fileno())
+	os.replace(temp, path)
+	_syncDirectory(os.path.dirname(path))
+
+
+def _syncDirectory(directory):
+	'''makes renames and new files in a directory durable'''
+	try:
+		fd = os.open(directory or '.', os.O_RDONLY)
+	except OSError:
+		return # e.g. directories cannot be opened on Windows
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+
+class HistoryStore(object):
+	'''
+	Keeps the first and last sighting of every EPC per reader and antenna
+	across restarts. Lookups take a few microseconds: the recent reads are
+	in a dictionary, older ones in a memory mapped hash table. Memory is
+	bounded by maxRecent, older sightings are only on disk.
+
+		history = HistoryStore('history')
+		reader.startLiveReports(lambda tags: history.update(tags, reader='dock 4'))
+		...
+		print(history.lastSeen('300833b2ddd9014000000000'))
+	'''
+	def __init__(self, directory, maxRecent=100000, flushInterval=1.):
+		''':param directory: directory of the segment and snapshot files
+		:param maxRecent: number of EPCs in memory which triggers a compaction
+		:param flushInterval: maximum seconds until reads are flushed to disk
+		'''
+		self.directory = directory
+		self.maxRecent = maxRecent
+		self.flushInterval = flushInterval
+		os.makedirs(directory, exist_ok=True)
+		self.lock = threading.Lock()
+		self.snapshot = None
+		self.recent = {} # EPC -> {(reader, antenna): [first, last, count]}
+		self.frozen = None # recent reads which are being compacted
+		self.compactor = None
+		self.generation = self._recover()
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self._write, name='HistoryStore', daemon=True)
+		self.thread.start()
+
+	def _files(self, prefix):
+		''':returns: sorted list of (generation, path) of the files with a prefix'''
+		pattern = re.compile(re.escape(prefix) + r'-(\d+)\.(log|db)$')
+		files = []
+		for name in os.listdir(self.directory):
+			match = pattern.match(name)
+			if match:
+				files.append((int(match.group(1)), os.path.join(self.directory, name)))
+		return sorted(files)
+
+	def _recover(self):
+		'''loads the latest snapshot and the newer segments
+		:returns: generation of new reads'''
+		for name in os.listdir(self.directory):
+			if name.endswith('.db.tmp'):
+				os.remove(os.path.join(self.directory, name)) # interrupted compaction
+		snapshots = self._files('index')
+		generation = 0
+		if snapshots:
+			generation, path = snapshots[-1]
+			self.snapshot = _Snapshot(path)
+		for gen, path in snapshots[:-1]:
+			os.remove(path)
+		last = generation
+		for gen, path in self._files('segment'):
+			if gen <= generation:
+				os.remove(path) # already in the snapshot
+				continue
+			with open(path, 'rb') as file:
+				self._replay(file)
+			last = gen
+		return last + 1
+
+	def _replay(self, file):
+		'''adds the reads of a segment to the recent reads. A truncated last record is ignored.'''
+		while True:
+			header = file.read(SEGMENT_RECORD.size)
+			if len(header) < SEGMENT_RECORD.size:
+				return
+			t, antenna, epcLen, readerLen = SEGMENT_RECORD.unpack(header)
+			data = file.read(epcLen + readerLen)
+			if len(data) < epcLen + readerLen:
+				return
+			self._add(data[:epcLen], data[epcLen:].decode(), antenna, t)
+
+	def _add(self, epc, reader, antenna, t):
+		'''adds one read to the recent reads, needs the lock'''
+		sightings = self.recent.get(epc)
+		if sightings is None:
+			sightings = self.recent[epc] = {}
+		known = sightings.get((reader, antenna))
+		if known is None:
+			sightings[(reader, antenna)] = [t, t, 1]
+		else:
+			if t < known[0]:
+				known[0] = t
+			if t > known[1]:
+				known[1] = t
+			known[2] += 1
+
+	def update(self, tags, now=None, reader=''):
+		'''adds the reads of a tag report
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param now: time of the reads in seconds since the epoch, defaults to now
+		:param reader: name of the reader, e.g. its address or location'''
+		if now is None:
+			now = time.time()
+		if isinstance(tags, TagBatch):
+			reads = list(zip(tags.epcColumn(), tags.antenna))
+		else:
+			reads = []
+			for tag in tags:
+				if not isinstance(tag, TagRead):
+					tag = TagRead.fromDict(tag)
+				reads.append((tag.epc, tag.antenna))
+		reads = [(_epc(epc), antenna or 0) for epc, antenna in reads]
+		with self.lock:
+			for epc, antenna in reads:
+				self._add(epc, reader, antenna, now)
+			self.queue.put((self.generation, now, reader, reads))
+			if len(self.recent) >= self.maxRecent and self.frozen is None:
+				self._freeze()
+
+	def history(self, epc):
+		''':param epc: EPC as hex string or bytes
+		:returns: list of HistoryRecord, the last seen first'''
+		epc = _epc(epc)
+		sightings = {}
+		with self.lock:
+			for part in (self.recent, self.frozen):
+				if part and epc in part:
+					_merge(sightings, part[epc])
+			snapshot = self.snapshot
+			if snapshot is not None:
+				found = snapshot.find(epc)
+				if found:
+					_merge(sightings, found)
+		records = [HistoryRecord(reader, antenna, first, last, count)
+			for (reader, antenna), (first, last, count) in sightings.items()]
+		records.sort(key=lambda record: record.lastSeen, reverse=True)
+		return records
+
+	def lastSeen(self, epc):
+		''':returns: HistoryRecord of the last sighting of an EPC or None'''
+		records = self.history(epc)
+		return records[0] if records else None
+
+	def _freeze(self):
+		'''starts the compaction of the recent reads, needs the lock'''
+		self.frozen, self.recent = self.recent, {}
+		generation = self.generation
+		self.generation += 1
+		self.compactor = threading.Thread(target=self._compact, args=(generation,),
+			name='HistoryCompaction', daemon=True)
+		self.compactor.start()
+
+	def compact(self, wait=True):
+		'''merges the recent reads into the snapshot
+		:param wait: wait until the compaction finished'''
+		with self.lock:
+			if self.frozen is None and self.recent:
+				self._freeze()
+			compactor = self.compactor
+		if wait and compactor is not None:
+			compactor.join()
+
+	def _compact(self, generation):
+		'''compaction thread'''
+		frozen = self.frozen
+		old = self.snapshot
+		def entries():
+			if old is not None:
+				for epc, sightings in old:
+					if epc in frozen:
+						_merge(sightings, frozen[epc])
+					yield epc, sightings
+			for epc, sightings in frozen.items():
+				if old is None or old.find(epc) is None:
+					yield epc, sightings
+		path = os.path.join(self.directory, 'index-{:08d}.db'.format(generation))
+		start = time.monotonic()
+		try:
+			_writeSnapshot(path, generation, entries(), len(frozen) + (old.entries if old else 0))
+			snapshot = _Snapshot(path)
+		except Exception:
+			logger.exception('History compaction failed')
+			with self.lock:
+				# keep the reads in memory, the segments are still there
+				_mergeRecent(self.recent, self.frozen)
+				self.frozen = None
+			return
+		with self.lock:
+			self.snapshot = snapshot
+			self.frozen = None
+		if old is not None:
+			old.close()
+			os.remove(old.path)
+		# the writer deletes the merged segments after their last reads
+		self.queue.put(('compacted', generation))
+		logger.debug('compacted %d EPCs in %.3f s', snapshot.entries, time.monotonic() - start)
+
+	def close(self):
+		'''finishes the compaction, writes the queued reads and closes the files'''
+		if self.thread is None:
+			return
+		compactor = self.compactor
+		if compactor is not None:
+			compactor.join()
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+		if self.snapshot is not None:
+			self.snapshot.close()
+			self.snapshot = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _segmentPath(self, generation):
+		return os.path.join(self.directory, 'segment-{:08d}.log'.format(generation))
+
+	def _write(self):
+		'''writer thread'''
+		segment = None
+		generation = None
+		lastFlush = time.monotonic()
+		running = True
+		while running:
+			items = []
+			try:
+				items.append(self.queue.get(timeout=self.flushInterval))
+				while True:
+					items.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			for item in items:
+				if item is None:
+					running = False
+					break
+				if item[0] == 'compacted':
+					if segment is not None and generation <= item[1]:
+						segment.close()
+						segment = None
+					for gen, path in self._files('segment'):
+						if gen <= item[1]:
+							os.remove(path)
+					continue
+				gen, t, reader, reads = item
+				if gen != generation or segment is None:
+					if segment is not None:
+						segment.close()
+					generation = gen
+					segment = open(self._segmentPath(gen), 'ab', buffering=1 << 20)
+				readerBytes = reader.encode()
+				segment.write(b''.join(SEGMENT_RECORD.pack(t, antenna, len(epc), len(readerBytes)) +
+					epc + readerBytes for epc, antenna in reads))
+			now = time.monotonic()
+			if segment is not None and (not running or now - lastFlush >= self.flushInterval):
+				segment.flush()
+				lastFlush = now
+		if segment is not None:
+			segment.close()
+
+
+def _mergeRecent(recent, frozen):
+	'''adds the EPCs of frozen to recent'''
+	for epc, sightings in frozen.items():
+		known = recent.get(epc)
+		if known is None:
+			recent[epc] = sightings
+		else:
+			_merge(known, sightings)
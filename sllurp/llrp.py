@@ -1,11 +1,12 @@
 from __future__ import print_function
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import logging
 import pprint
 import struct
 from .llrp_proto import LLRPROSpec, LLRPError, Message_struct, \
 	Message_Type2Name, Capability_Name2Type, AirProtocol, \
-	llrp_data2xml, LLRPMessageDict, ReaderConfigurationError, EXT_TYPE
+	llrp_data2xml, LLRPMessageDict, ReaderConfigurationError, EXT_TYPE, \
+	LLRPWriter
 from binascii import hexlify
 from .util import BITMASK
 import socket # for connecting to the reader via TCP/IP
@@ -44,17 +45,17 @@ class LLRPMessage(object):
 		ver = self.msgdict[name]['Ver'] & BITMASK(3)
 		msgtype = self.msgdict[name]['Type'] & BITMASK(10)
 		msgid = self.msgdict[name]['ID']
-		try:
-			encoder = Message_struct[name]['encode']
-		except KeyError:
+		ms = Message_struct.get(name, {})
+		if 'write' not in ms and 'encode' not in ms:
 			raise LLRPError('Cannot find encoder for message type '
 							'{}'.format(name))
-		data = encoder(self.msgdict[name])
-		self.msgbytes = struct.pack(self.full_hdr_fmt,
-									(ver << 10) | msgtype,
-									len(data) + self.full_hdr_len,
-									msgid) + data
-		logger.debug('serialized bytes: %s', hexlify(self.msgbytes))
+		w = LLRPWriter()
+		start = w.begin(self.full_hdr_fmt, (ver << 10) | msgtype, msgid)
+		w.write(name, self.msgdict[name])
+		w.end(start, '!I')
+		self.msgbytes = w.getvalue()
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('serialized bytes: %s', hexlify(self.msgbytes))
 		logger.debug('done serializing %s command', name)
 
 	def deserialize(self):
@@ -131,6 +132,165 @@ class LLRPMessage(object):
 		return ret
 
 
+class LLRPMessageTemplate(object):
+	'''Pre-encoded LLRP message. 
+	Fields at fixed byte offsets can be patched without encoding again.'''
+	def __init__(self, msgdict, **fields):
+		''':param msgdict: message dictionary to encode once
+		:param fields: field name -> tuple of (byte offset, struct format)
+		'''
+		self.msg = LLRPMessage(msgdict=msgdict)
+		self.name = self.msg.getName()
+		self.fields = {'ID': ((6, '!I'),)} # message ID is in every header
+		self.fields.update(fields)
+	
+	def message(self, msgdict=None, **values):
+		'''Creates the message with patched field values.
+		:param msgdict: message dictionary matching the values. 
+			When None, it is derived from the template dictionary
+		:param values: field name -> new value
+		:returns: LLRPMessage'''
+		template = self.msg.msgdict[self.name]
+		if all(template.get(name) == value for name, value in values.items()):
+			return self.msg
+		
+		msgbytes = bytearray(self.msg.msgbytes)
+		for name, value in values.items():
+			for offset, fmt in self.fields[name]:
+				struct.pack_into(fmt, msgbytes, offset, value)
+		
+		if msgdict is None:
+			msgdict = {self.name: dict(self.msg.msgdict[self.name], **values)}
+		return LLRPMessage(msgdict=msgdict, msgbytes=bytes(msgbytes))
+
+
+class ROSpecCache(object):
+	'''Encoded ADD_ROSPEC messages, keyed by the structure of the ROSpec.
+	Power, channel, mode, tari, session, population and ROSpecID 
+	are patched into the cached bytes.'''
+	# parameter type: {field name: (offset in parameter, struct format, conversion)}
+	patchFields = {
+		177: {'ROSpecID': (4, '!I', lambda v: v & BITMASK(10))}, # ROSpec
+		224: {'ChannelIndex': (6, '!H', None), 'TransmitPower': (8, '!H', None)}, # RFTransmitter
+		335: {'ModeIndex': (4, '!H', None), 'Tari': (6, '!H', None)}, # C1G2RFControl
+		336: {'Session': (4, '!B', lambda v: v << 6), 'TagPopulation': (5, '!H', None)}, # C1G2SingulationControl
+	}
+	# parameter type: bytes in front of the sub-parameters (incl. header)
+	containers = {
+		177: 10, # ROSpec
+		183: 6, # AISpec (plus 2 bytes per antenna ID)
+		186: 7, # InventoryParameterSpec
+		222: 6, # AntennaConfiguration
+		330: 5, # C1G2InventoryCommand
+	}
+	
+	def __init__(self, size=32):
+		''':param size: maximum number of cached ROSpec structures'''
+		self.size = size
+		self.templates = OrderedDict()
+	
+	def message(self, rospec):
+		''':param rospec: LLRPROSpec instance
+		:returns: ADD_ROSPEC LLRPMessage'''
+		msgdict = {
+			'ADD_ROSPEC': {
+				'Ver':  1,
+				'Type': 20,
+				'ID':   0,
+				'ROSpecID': rospec['ROSpec']['ROSpecID'],
+				'ROSpec': rospec['ROSpec'],
+			}}
+		
+		template = self.templates.get(rospec.templateKey)
+		if template is None:
+			template = LLRPMessageTemplate(msgdict)
+			fields = {}
+			self.scan(template.msg.msgbytes, LLRPMessage.full_hdr_len, len(template.msg.msgbytes), fields)
+			template.fields.update(fields)
+			template.values = rospec.templateValues
+			self.templates[rospec.templateKey] = template
+			if len(self.templates) > self.size:
+				self.templates.popitem(last=False)
+			return template.msg
+		
+		# patch fields which differ from the cached message
+		values = {}
+		for name, value in rospec.templateValues.items():
+			if value != template.values[name]:
+				conv = self.conversions[name]
+				values[name] = conv(value) if conv else value
+		if values:
+			return template.message(msgdict, **values)
+		return LLRPMessage(msgdict=msgdict, msgbytes=template.msg.msgbytes)
+	
+	def scan(self, msgbytes, start, end, fields):
+		'''Finds the offsets of patchable fields in encoded parameters.
+		:param msgbytes: encoded message
+		:param start: offset of the first parameter
+		:param end: offset behind the last parameter
+		:param fields: dictionary which gets filled with 
+			field name -> list of (offset, struct format)
+		'''
+		while start + 4 <= end:
+			partype, parlen = struct.unpack_from('!HH', msgbytes, start)
+			partype = partype & BITMASK(10)
+			for name, (offset, fmt, _) in self.patchFields.get(partype, {}).items():
+				fields.setdefault(name, []).append((start + offset, fmt))
+			if partype in self.containers:
+				substart = start + self.containers[partype]
+				if partype == 183:
+					# skip antenna IDs of AISpec
+					nAnts, = struct.unpack_from('!H', msgbytes, start + 4)
+					substart += 2*nAnts
+				self.scan(msgbytes, substart, start + parlen, fields)
+			start += parlen
+
+ROSpecCache.conversions = dict((name, conv) 
+	for fields in ROSpecCache.patchFields.values() 
+	for name, (_, _, conv) in fields.items())
+
+
+# control messages without variable content are encoded only once
+KEEPALIVE_ACK = LLRPMessageTemplate({
+	'KEEPALIVE_ACK': {
+		'Ver':  1,
+		'Type': 72,
+		'ID':   0,
+	}})
+
+GET_READER_CAPABILITIES = LLRPMessageTemplate({
+	'GET_READER_CAPABILITIES': {
+		'Ver':  1,
+		'Type': 1,
+		'ID':   0,
+		'RequestedData': Capability_Name2Type['All']
+	}}, RequestedData=((10, '!B'),))
+
+ROSPEC_ID_FIELD = ((10, '!I'),)
+ENABLE_ROSPEC, START_ROSPEC, DISABLE_ROSPEC, DELETE_ROSPEC = (
+	LLRPMessageTemplate({
+		name: {
+			'Ver':  1,
+			'Type': msgtype,
+			'ID':   0,
+			'ROSpecID': 0
+		}}, ROSpecID=ROSPEC_ID_FIELD)
+	for name, msgtype in (('ENABLE_ROSPEC', 24), ('START_ROSPEC', 22), 
+		('DISABLE_ROSPEC', 25), ('DELETE_ROSPEC', 21)))
+
+ACCESSSPEC_ID_FIELD = ((10, '!I'),)
+ENABLE_ACCESSSPEC, DISABLE_ACCESSSPEC, DELETE_ACCESSSPEC = (
+	LLRPMessageTemplate({
+		name: {
+			'Ver':  1,
+			'Type': msgtype,
+			'ID':   0,
+			'AccessSpecID': 0
+		}}, AccessSpecID=ACCESSSPEC_ID_FIELD)
+	for name, msgtype in (('ENABLE_ACCESSSPEC', 42), ('DISABLE_ACCESSSPEC', 43), 
+		('DELETE_ACCESSSPEC', 41)))
+
+
 class Transport:
 	'''TCP socket interface'''
 	def __init__(self):
@@ -157,7 +317,16 @@ class LLRPClient(object):
 	def __init__(self, ip, antennas=(0,), power=0, channel=1, 
 				report_interval=1., report_every_n_tags=None, 
 				report_selection={}, mode_index=None, mode_identifier=None, tari=None, 
-				session=2, population=1, freq_hop_table_id=1):
+				session=2, population=1, freq_hop_table_id=1, clock=None, transport=None, 
+				capabilitiesCache=None):
+		'''
+		:param clock: optional clock.ReaderClock which learns the mapping 
+			of reader timestamps to host time from the received messages
+		:param transport: object with the methods of Transport, 
+			e.g. replay.ReplayTransport. Defaults to a TCP socket
+		:param capabilitiesCache: optional capabilities.CapabilitiesCache 
+			to skip requesting all capabilities when connecting
+		'''
 		# settings
 		self.ip = ip # reader ip address
 		
@@ -168,6 +337,8 @@ class LLRPClient(object):
 		
 		self.report_interval = report_interval # report after duration in sec, OR...
 		self.report_every_n_tags = report_every_n_tags # report every n tags
+		self.tag_observation = None # stop early on a TagObservationTrigger
+		self.antenna_dwell = None # (antenna, dwell) schedule with one AISpec per antenna
 		
 		self.population = population # estimated tag population
 		self.session = session # 0...3 for inventoring same tag(s) with different readers
@@ -178,8 +349,10 @@ class LLRPClient(object):
 		self.report_selection = report_selection # what to report
 		
 		# instance properties
-		self.transport = Transport()
+		self.transport = transport or Transport()
+		self.rospecCache = ROSpecCache()
 		self.capabilities = {}
+		self.capabilitiesCache = capabilitiesCache
 		self.power_table = []
 		self.power_idx_table = []
 		self.freq_table = []
@@ -187,8 +360,15 @@ class LLRPClient(object):
 		self.reader_mode = None
 		
 		self.partialData = b''
+		self.recorders = [] # capture.FrameRecorder instances
 		self.lastReceivedMsg = None
+		self.receivedMsgs = {}
 		self.msgCallbacks = defaultdict(list)
+		
+		# attach before connecting to get the first reader event
+		self.clock = clock
+		if clock:
+			clock.attach(self)
 	
 	def reportTimeout(self):
 		''':returns: timeout for tag reports'''
@@ -293,9 +473,14 @@ class LLRPClient(object):
 	
 	def getCapabilities(self):
 		'''Requests reader capabilities and parses them to 
-		set reader mode, tari and tx power table.'''
-		self.send_GET_READER_CAPABILITIES()
-		self.capabilities = self.readLLRPMessage('GET_READER_CAPABILITIES_RESPONSE')
+		set reader mode, tari and tx power table.
+		With a capabilitiesCache, they are taken from the cache when possible.'''
+		cache = self.capabilitiesCache
+		if cache is None or not cache.load(self):
+			self.send_GET_READER_CAPABILITIES()
+			self.capabilities = self.readLLRPMessage('GET_READER_CAPABILITIES_RESPONSE')
+			if cache is not None:
+				cache.put(self.capabilities)
 		logger.debug('Capabilities: %s', pprint.pformat(self.capabilities))
 		try:
 			self.parseCapabilities(self.capabilities)
@@ -303,17 +488,28 @@ class LLRPClient(object):
 			logger.exception('Capabilities mismatch')
 			raise err
 	
-	def getROSpec(self, *args, **kwargs):
+	def readerIdentity(self):
+		''':returns: string identifying the reader by manufacturer, model,
+			firmware and address'''
+		gdc = self.capabilities['GeneralDeviceCapabilities']
+		return '{}-{}-{}@{}'.format(gdc['DeviceManufacturerName'], gdc['ModelName'],
+			gdc['ReaderFirmwareVersion'], self.ip)
+	
+	def getROSpec(self, rospecID=1, **kwargs):
 		logger.debug('Creating ROSpec')
 		self.parseCapabilities(self.capabilities) # check if parameters are valid
 		# create an ROSpec to define the reader's inventorying behavior
-		rospec = LLRPROSpec(1, *args, **kwargs)
+		rospec = LLRPROSpec(rospecID, **kwargs)
 		logger.debug('ROSpec: %s', rospec)
 		return rospec
 	
-	def startInventory(self):
-		'''Add a ROSpec to the reader and enable it.'''
-		rospec = self.getROSpec(
+	def getInventoryROSpec(self, rospecID=1, **kwargs):
+		'''Creates a ROSpec from the current instance settings.
+		:param rospecID: ID of the ROSpec (>0)
+		:param kwargs: additional LLRPROSpec arguments, e.g. start_trigger
+		:returns: LLRPROSpec'''
+		return self.getROSpec(
+			rospecID=rospecID, 
 			antennas=self.antennas, 
 			power=self.power, 
 			channel=self.channel, 
@@ -324,14 +520,31 @@ class LLRPClient(object):
 			tari=self.tari or self.reader_mode['MaxTari'],
 			session=self.session,
 			population=self.population,
-			hopTableID=self.hopTableID
-		)['ROSpec']
+			hopTableID=self.hopTableID, 
+			tag_observation=self.tag_observation,
+			antenna_dwell=self.antenna_dwell,
+			**kwargs
+		)
+	
+	def maxROSpecs(self):
+		''':returns: number of ROSpecs the reader can hold at the same time'''
+		llrpcap = self.capabilities.get('LLRPCapabilities', {})
+		return llrpcap.get('MaxNumROSpec') or 1
+	
+	def maxPriority(self):
+		''':returns: lowest ROSpec priority the reader supports (0 is the highest)'''
+		llrpcap = self.capabilities.get('LLRPCapabilities', {})
+		return llrpcap.get('MaxPriorityLevelSupported') or 0
+	
+	def startInventory(self):
+		'''Add a ROSpec to the reader and enable it.'''
+		rospec = self.getInventoryROSpec()
 		logger.info('starting inventory')
 		# add rospec
 		self.send_ADD_ROSPEC(rospec)
 		self.readLLRPMessage('ADD_ROSPEC_RESPONSE')
 		# enable rospec
-		self.send_ENABLE_ROSPEC(rospec['ROSpecID'])
+		self.send_ENABLE_ROSPEC(rospec['ROSpec']['ROSpecID'])
 		self.readLLRPMessage('ENABLE_ROSPEC_RESPONSE')
 	
 	def stopPolitely(self):
@@ -431,23 +644,18 @@ class LLRPClient(object):
 		self.readLLRPMessage('ENABLE_ACCESSSPEC_RESPONSE')
 	
 	def send_KEEPALIVE_ACK(self):
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'KEEPALIVE_ACK': {
-				'Ver':  1,
-				'Type': 72,
-				'ID':   0,
-			}}))
+		self.sendLLRPMessage(KEEPALIVE_ACK.message())
 	
-	def send_GET_READER_CAPABILITIES(self):
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'GET_READER_CAPABILITIES': {
-				'Ver':  1,
-				'Type': 1,
-				'ID':   0,
-				'RequestedData': Capability_Name2Type['All']
-			}}))
+	def send_GET_READER_CAPABILITIES(self, requestedData='All'):
+		''':param requestedData: name in Capability_Name2Type'''
+		self.sendLLRPMessage(GET_READER_CAPABILITIES.message(
+			RequestedData=Capability_Name2Type[requestedData]))
 	
 	def send_ADD_ROSPEC(self, roSpec):
+		if isinstance(roSpec, LLRPROSpec):
+			# reuse encoded bytes of a ROSpec with the same structure
+			self.sendLLRPMessage(self.rospecCache.message(roSpec))
+			return
 		self.sendLLRPMessage(LLRPMessage(msgdict={
 			'ADD_ROSPEC': {
 				'Ver':  1,
@@ -458,23 +666,18 @@ class LLRPClient(object):
 			}}))
 	
 	def send_ENABLE_ROSPEC(self, roSpecID):
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'ENABLE_ROSPEC': {
-				'Ver':  1,
-				'Type': 24,
-				'ID':   0,
-				'ROSpecID': roSpecID
-			}}))
+		self.sendLLRPMessage(ENABLE_ROSPEC.message(ROSpecID=roSpecID))
+	
+	def send_START_ROSPEC(self, roSpecID):
+		self.sendLLRPMessage(START_ROSPEC.message(ROSpecID=roSpecID))
+	
+	def send_DISABLE_ROSPEC(self, roSpecID=0):
+		# when ID is 0, disables all ROSpecs
+		self.sendLLRPMessage(DISABLE_ROSPEC.message(ROSpecID=roSpecID))
 	
 	def send_DELETE_ROSPEC(self, roSpecID=0):
 		# when ID is 0, deletes all ROSpecs
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'DELETE_ROSPEC': {
-				'Ver':  1,
-				'Type': 21,
-				'ID':   0,
-				'ROSpecID': roSpecID
-			}}))
+		self.sendLLRPMessage(DELETE_ROSPEC.message(ROSpecID=roSpecID))
 	
 	def send_ADD_ACCESSSPEC(self, accessSpec):
 		self.sendLLRPMessage(LLRPMessage(msgdict={
@@ -486,32 +689,14 @@ class LLRPClient(object):
 			}}))
 
 	def send_ENABLE_ACCESSSPEC(self, accessSpecID):
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'ENABLE_ACCESSSPEC': {
-				'Ver':  1,
-				'Type': 42,
-				'ID':   0,
-				'AccessSpecID': accessSpecID,
-			}}))
+		self.sendLLRPMessage(ENABLE_ACCESSSPEC.message(AccessSpecID=accessSpecID))
 	
 	def send_DISABLE_ACCESSSPEC(self, accessSpecID=1):
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'DISABLE_ACCESSSPEC': {
-				'Ver':  1,
-				'Type': 43,
-				'ID':   0,
-				'AccessSpecID': accessSpecID,
-			}}))
+		self.sendLLRPMessage(DISABLE_ACCESSSPEC.message(AccessSpecID=accessSpecID))
 	
 	def send_DELETE_ACCESSSPEC(self, accessSpecID=0):
 		# when ID is 0, deletes all access specs
-		self.sendLLRPMessage(LLRPMessage(msgdict={
-			'DELETE_ACCESSSPEC': {
-				'Ver': 1,
-				'Type': 41,
-				'ID': 0,
-				'AccessSpecID': accessSpecID
-			}}))
+		self.sendLLRPMessage(DELETE_ACCESSSPEC.message(AccessSpecID=accessSpecID))
 	
 	def parsePowerTable(self, uhfbandcap):
 		'''Parse the transmit power table.
@@ -570,32 +755,58 @@ class LLRPClient(object):
 	
 	def sendLLRPMessage(self, llrp_msg):
 		self.transport.write(llrp_msg.msgbytes)
+		for recorder in self.recorders:
+			recorder.sent(llrp_msg.msgbytes)
 	
-	def readLLRPMessage(self, msgName=None):
-		'''Reads incoming data from the reader until a specified message.'''
+	def readLLRPMessage(self, msgName=None, timeout=None):
+		'''Reads incoming data from the reader until a specified message.
+		:param timeout: seconds to wait for data, defaults to reportTimeout()'''
 		self.lastReceivedMsg = {}
+		self.receivedMsgs = {}
 		
 		# receive raw data until a message was decoded
 		while True:
-			self.rawDataReceived(self.transport.read(self.reportTimeout()))
+			self.rawDataReceived(self.transport.read(timeout or self.reportTimeout()))
 			if self.lastReceivedMsg:
 				if msgName:
-					# wait until expected message received
-					if self.lastReceivedMsg.getName() != msgName:
+					# wait until expected message received.
+					# several messages can arrive with the same chunk of data
+					if msgName not in self.receivedMsgs:
 						continue
+					return self.receivedMsgs[msgName].msgdict[msgName]
 				else:
 					msgName = self.lastReceivedMsg.getName()
 
 				return self.lastReceivedMsg.msgdict[msgName]
+	
+	def readLLRPMessages(self, msgName, count):
+		'''Reads incoming data from the reader until a specified message 
+		was received count times, e.g. the responses of pipelined requests.
+		:param msgName: name of the expected message
+		:param count: number of expected messages
+		:returns: list of message dictionaries'''
+		msgs = []
+		self.addMsgCallback(msgName, msgs.append)
+		try:
+			while len(msgs) < count:
+				self.readLLRPMessage()
+		finally:
+			self.removeMsgCallback(msgName, msgs.append)
+		return msgs
 		
 	def rawDataReceived(self, data):
 		'''Receives binary data from the reader. In normal cases, we can parse 
 		the message according to the protocoll and return it as a dictionary.'''
-		logger.debug('got %d bytes from reader: %s', len(data), hexlify(data))
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug('got %d bytes from reader: %s', len(data), hexlify(data))
 		if not data:
 			return
 		
 		self.partialData += data
+		# frames of one chunk share its receive time
+		recorders = self.recorders
+		if recorders:
+			now = recorders[0].clock()
 
 		while self.partialData:
 			if len(self.partialData) >= LLRPMessage.hdr_len:
@@ -604,7 +815,10 @@ class LLRPClient(object):
 
 				if len(self.partialData) >= msg_len:
 					# parse the message
-					lmsg = LLRPMessage(msgbytes=self.partialData[:msg_len])
+					frame = self.partialData[:msg_len]
+					for recorder in recorders:
+						recorder.received(frame, now)
+					lmsg = LLRPMessage(msgbytes=frame)
 					self.handleMessage(lmsg)
 					self.partialData = self.partialData[msg_len:]
 				else:
@@ -615,6 +829,7 @@ class LLRPClient(object):
 	def handleMessage(self, lmsg):
 		'''Checks a LLRP message for common issues.'''
 		self.lastReceivedMsg = lmsg
+		self.receivedMsgs[lmsg.getName()] = lmsg
 		logger.debug('LLRPMessage received: %s', lmsg)
 		msgName = lmsg.getName()
 		if not msgName:
@@ -635,6 +850,6 @@ class LLRPClient(object):
 		if msgName == 'KEEPALIVE':
 			self.send_KEEPALIVE_ACK()
 		
-		# call registered callback functions
-		for fn in self.msgCallbacks[msgName]:
+		# call registered callback functions, which may remove themselves
+		for fn in tuple(self.msgCallbacks[msgName]):
 			fn(msgDict)
\ No newline at end of file
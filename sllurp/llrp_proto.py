@@ -68,6 +68,76 @@ def bin2dump(data, label=''):
 def dump(data, label):
 	logger.debug(bin2dump(data, label))
 
+
+class LLRPWriter(object):
+	'''Encodes LLRP messages and parameters into one growing bytearray.
+	
+	A parameter header is reserved with a zero length when the parameter 
+	starts and the length is back-patched when it ends, so nested 
+	parameters are written in a single pass without copying.'''
+	__slots__ = ('buf',)
+	
+	def __init__(self):
+		self.buf = bytearray()
+	
+	def pack(self, fmt, *values):
+		'''appends packed values'''
+		self.buf += struct.pack(fmt, *values)
+	
+	def append(self, data):
+		'''appends raw bytes'''
+		self.buf += data
+	
+	def begin(self, fmt, msgtype, *values):
+		'''starts a parameter or message.
+		:param fmt: struct format of the header. 
+			The first two fields are the type and the length
+		:param msgtype: parameter or message type
+		:param values: other header fields after the length
+		:returns: offset of the header, needed for end()'''
+		buf = self.buf
+		start = len(buf)
+		buf += struct.pack(fmt, msgtype, 0, *values)
+		return start
+	
+	def param(self, fmt, msgtype, *values):
+		'''appends a complete parameter of fixed size, 
+		no back-patching is needed.
+		:param fmt: struct format of the whole parameter including header
+		:param msgtype: parameter type
+		:param values: fields after the length'''
+		self.buf += struct.pack(fmt, msgtype, struct.calcsize(fmt), *values)
+	
+	def end(self, start, lenfmt='!H'):
+		'''ends a parameter or message by patching its length into the header.
+		:param start: offset returned by begin()
+		:param lenfmt: struct format of the length field'''
+		buf = self.buf
+		struct.pack_into(lenfmt, buf, start + 2, len(buf) - start)
+	
+	def write(self, name, par):
+		'''appends a parameter with its writer or, if there is none, 
+		with its bytes encoder from Message_struct'''
+		ms = Message_struct[name]
+		try:
+			writer = ms['write']
+		except KeyError:
+			self.buf += ms['encode'](par)
+			return
+		writer(self, par)
+	
+	def getvalue(self):
+		return bytes(self.buf)
+
+
+def write_encoder(writer):
+	'''Creates a bytes encoder function from a writer function.'''
+	def encoder(par):
+		w = LLRPWriter()
+		writer(w, par)
+		return w.getvalue()
+	return encoder
+
 #
 # LLRP defines & structs
 #
@@ -286,8 +356,8 @@ Message_struct['GET_READER_CAPABILITIES_RESPONSE'] = {
 
 
 # 16.1.3 ADD_ROSPEC
-def encode_AddROSpec(msg):
-	return encode('ROSpec')(msg['ROSpec'])
+def write_AddROSpec(w, msg):
+	write_ROSpec(w, msg['ROSpec'])
 
 
 Message_struct['ADD_ROSPEC'] = {
@@ -296,7 +366,8 @@ Message_struct['ADD_ROSPEC'] = {
 		'Ver', 'Type', 'ID',
 		'ROSpec'
 	],
-	'encode': encode_AddROSpec
+	'encode': write_encoder(write_AddROSpec),
+	'write': write_AddROSpec
 }
 
 def decode_StatusResponse(data):
@@ -1360,24 +1431,21 @@ Message_struct['ErrorMessage'] = {
 
 
 # 16.2.4.1 ROSpec Parameter
-def encode_ROSpec(par):
+def write_ROSpec(w, par):
 	msgtype = Message_struct['ROSpec']['type']
 	msgid = par['ROSpecID'] & BITMASK(10)
 	priority = par['Priority'] & BITMASK(7)
 	state = ROSpecState_Name2Type[par['CurrentState']] & BITMASK(7)
 	
-	msg_header = '!HHIBB'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = encode('ROBoundarySpec')(par['ROBoundarySpec'])
-	data += encode('AISpec')(par['AISpec'])
-	data += encode('ROReportSpec')(par['ROReportSpec'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len,
-					msgid, priority, state) + data
-	
-	return data
+	start = w.begin('!HHIBB', msgtype, msgid, priority, state)
+	write_ROBoundarySpec(w, par['ROBoundarySpec'])
+	aispecs = par['AISpec']
+	if isinstance(aispecs, dict):
+		aispecs = (aispecs,)
+	for aispec in aispecs:
+		write_AISpec(w, aispec)
+	write_ROReportSpec(w, par['ROReportSpec'])
+	w.end(start)
 
 
 Message_struct['ROSpec'] = {
@@ -1392,7 +1460,8 @@ Message_struct['ROSpec'] = {
 		'RFSurveySpec',
 		'ROReportSpec'
 	],
-	'encode': encode_ROSpec
+	'encode': write_encoder(write_ROSpec),
+	'write': write_ROSpec
 }
 
 
@@ -1872,19 +1941,13 @@ Message_struct['AccessReportSpec'] = {
 
 
 # 16.2.4.1.1 ROBoundarySpec Parameter
-def encode_ROBoundarySpec(par):
+def write_ROBoundarySpec(w, par):
 	msgtype = Message_struct['ROBoundarySpec']['type']
 	
-	msg_header = '!HH'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = encode('ROSpecStartTrigger')(par['ROSpecStartTrigger'])
-	data += encode('ROSpecStopTrigger')(par['ROSpecStopTrigger'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len) + data
-	
-	return data
+	start = w.begin('!HH', msgtype)
+	write_ROSpecStartTrigger(w, par['ROSpecStartTrigger'])
+	write_ROSpecStopTrigger(w, par['ROSpecStopTrigger'])
+	w.end(start)
 
 
 Message_struct['ROBoundarySpec'] = {
@@ -1894,28 +1957,22 @@ Message_struct['ROBoundarySpec'] = {
 		'ROSpecStartTrigger',
 		'ROSpecStopTrigger'
 	],
-	'encode': encode_ROBoundarySpec
+	'encode': write_encoder(write_ROBoundarySpec),
+	'write': write_ROBoundarySpec
 }
 
 
 # 16.2.4.1.1.1 ROSpecStartTrigger Parameter
-def encode_ROSpecStartTrigger(par):
+def write_ROSpecStartTrigger(w, par):
 	msgtype = Message_struct['ROSpecStartTrigger']['type']
 	t_type = StartTrigger_Name2Type[par['ROSpecStartTriggerType']]
 	
-	msg_header = '!HHB'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = bytes()
+	start = w.begin('!HHB', msgtype, t_type)
 	if par['ROSpecStartTriggerType'] == 'Periodic':
-		data += encode('PeriodicTriggerValue')(par['PeriodicTriggerValue'])
+		write_PeriodicTriggerValue(w, par['PeriodicTriggerValue'])
 	elif par['ROSpecStartTriggerType'] == 'GPI':
-		data += encode('GPITriggerValue')(par['GPITriggerValue'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len, t_type) + data
-	
-	return data
+		w.write('GPITriggerValue', par['GPITriggerValue'])
+	w.end(start)
 
 
 Message_struct['ROSpecStartTrigger'] = {
@@ -1926,22 +1983,19 @@ Message_struct['ROSpecStartTrigger'] = {
 		'PeriodicTriggerValue',
 		'GPITriggerValue'
 	],
-	'encode': encode_ROSpecStartTrigger
+	'encode': write_encoder(write_ROSpecStartTrigger),
+	'write': write_ROSpecStartTrigger
 }
 
 
-def encode_PeriodicTriggerValue(par):
+def write_PeriodicTriggerValue(w, par):
 	msgtype = Message_struct['PeriodicTriggerValue']['type']
-	msg_header = '!HH'
-	msg_header_len = struct.calcsize(msg_header)
 	
-	data = struct.pack('!I', par['Offset'])
-	data += struct.pack('!I', par['Period'])
+	start = w.begin('!HH', msgtype)
+	w.pack('!II', par['Offset'], par['Period'])
 	if 'UTCTimestamp' in par:
-		data += encode('UTCTimestamp')(par['UTCTimestamp'])
-	
-	data = struct.pack(msg_header, msgtype, len(data) + msg_header_len) + data
-	return data
+		w.write('UTCTimestamp', par['UTCTimestamp'])
+	w.end(start)
 
 
 # 16.2.4.1.1.1 PeriodicTriggerValue Parameter
@@ -1953,26 +2007,18 @@ Message_struct['PeriodicTriggerValue'] = {
 		'Period',
 		'UTCTimestamp'
 	],
-	'encode': encode_PeriodicTriggerValue
+	'encode': write_encoder(write_PeriodicTriggerValue),
+	'write': write_PeriodicTriggerValue
 }
 
 
 # 16.2.4.1.1.2 ROSpecStopTrigger Parameter
-def encode_ROSpecStopTrigger(par):
+def write_ROSpecStopTrigger(w, par):
 	msgtype = Message_struct['ROSpecStopTrigger']['type']
 	t_type = StopTrigger_Name2Type[par['ROSpecStopTriggerType']]
 	duration = par['DurationTriggerValue']
 	
-	msg_header = '!HHBI'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = bytes()
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len,
-					t_type, duration) + data
-	
-	return data
+	w.param('!HHBI', msgtype, t_type, duration)
 
 
 Message_struct['ROSpecStopTrigger'] = {
@@ -1983,34 +2029,27 @@ Message_struct['ROSpecStopTrigger'] = {
 		'DurationTriggerValue',
 		'GPITriggerValue'
 	],
-	'encode': encode_ROSpecStopTrigger
+	'encode': write_encoder(write_ROSpecStopTrigger),
+	'write': write_ROSpecStopTrigger
 }
 
 
 # 16.2.4.2 AISpec Parameter
-def encode_AISpec(par):
+def write_AISpec(w, par):
 	msgtype = Message_struct['AISpec']['type']
 	
-	msg_header = '!HHH'
-	msg_header_len = struct.calcsize(msg_header)
-	data = bytes()
-	
 	antid = par['AntennaIDs']
 	antennas = []
 	if type(antid) is str:
 		antennas = antid.split()
 	else:
 		antennas.extend(antid)
-	for a in antennas:
-		data += struct.pack('!H', int(a))
 	
-	data += encode('AISpecStopTrigger')(par['AISpecStopTrigger'])
-	data += encode('InventoryParameterSpec')(par['InventoryParameterSpec'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len, len(antennas)) + data
-	
-	return data
+	start = w.begin('!HHH', msgtype, len(antennas))
+	w.pack('!{}H'.format(len(antennas)), *map(int, antennas))
+	write_AISpecStopTrigger(w, par['AISpecStopTrigger'])
+	write_InventoryParameterSpec(w, par['InventoryParameterSpec'])
+	w.end(start)
 
 
 Message_struct['AISpec'] = {
@@ -2022,31 +2061,25 @@ Message_struct['AISpec'] = {
 		'AISpecStopTrigger',
 		'InventoryParameterSpec'
 	],
-	'encode': encode_AISpec
+	'encode': write_encoder(write_AISpec),
+	'write': write_AISpec
 }
 
 
 # 16.2.4.2.1 AISpecStopTrigger Parameter
-def encode_AISpecStopTrigger(par):
+def write_AISpecStopTrigger(w, par):
 	msgtype = Message_struct['AISpecStopTrigger']['type']
 	t_type = StopTrigger_Name2Type[par['AISpecStopTriggerType']]
 	duration = int(par['DurationTriggerValue'])
 	
-	msg_header = '!HH'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = struct.pack('!B', t_type)
-	data += struct.pack('!I', int(duration))
+	start = w.begin('!HH', msgtype)
+	w.pack('!BI', t_type, duration)
 	if 'GPITriggerValue' in par:
 		# TODO implement GPITriggerValue Message_struct
-		data += encode('GPITriggerValue')(par['GPITriggerValue'])
+		w.write('GPITriggerValue', par['GPITriggerValue'])
 	if 'TagObservationTrigger' in par:
-		data += encode('TagObservationTrigger')(par['TagObservationTrigger'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len) + data
-	
-	return data
+		write_TagObservationTrigger(w, par['TagObservationTrigger'])
+	w.end(start)
 
 
 Message_struct['AISpecStopTrigger'] = {
@@ -2058,12 +2091,13 @@ Message_struct['AISpecStopTrigger'] = {
 		'GPITriggerValue',
 		'TagObservationTrigger'
 	],
-	'encode': encode_AISpecStopTrigger
+	'encode': write_encoder(write_AISpecStopTrigger),
+	'write': write_AISpecStopTrigger
 }
 
 
 # 17.2.4.2.1.1
-def encode_TagObservationTrigger(par):
+def write_TagObservationTrigger(w, par):
 	msgtype = Message_struct['TagObservationTrigger']['type']
 	t_type = TagObservationTrigger_Name2Type[par['TriggerType']]
 	n_tags = int(par['NumberOfTags'])
@@ -2071,19 +2105,7 @@ def encode_TagObservationTrigger(par):
 	t = int(par['T'])
 	timeout = int(par['Timeout'])
 
-	msg_header = '!HH'
-	msg_header_len = struct.calcsize(msg_header)
-
-	data = struct.pack('!B', t_type)
-	data += struct.pack('!B', 0)
-	data += struct.pack('!H', n_tags)
-	data += struct.pack('!H', n_attempts)
-	data += struct.pack('!H', t)
-	data += struct.pack('!I', timeout)
-
-	data = struct.pack(msg_header, msgtype,
-					   len(data) + msg_header_len) + data
-	return data
+	w.param('!HHBBHHHI', msgtype, t_type, 0, n_tags, n_attempts, t, timeout)
 
 
 Message_struct['TagObservationTrigger'] = {
@@ -2096,27 +2118,21 @@ Message_struct['TagObservationTrigger'] = {
 		'T',
 		'Timeout'
 	],
-	'encode': encode_TagObservationTrigger
+	'encode': write_encoder(write_TagObservationTrigger),
+	'write': write_TagObservationTrigger
 }
 
 
 # 16.2.4.2.2 InventoryParameterSpec Parameter
-def encode_InventoryParameterSpec(par):
+def write_InventoryParameterSpec(w, par):
 	msgtype = Message_struct['InventoryParameterSpec']['type']
 	
-	msg_header = '!HH'
-	msg_header_len = struct.calcsize(msg_header)
-	data = struct.pack('!H', par['InventoryParameterSpecID'])
-	data += struct.pack('!B', par['ProtocolID'])
-	
+	start = w.begin('!HH', msgtype)
+	w.pack('!HB', par['InventoryParameterSpecID'], par['ProtocolID'])
 	for antconf in par['AntennaConfiguration']:
 		logger.debug('encoding AntennaConfiguration: %s', antconf)
-		data += encode('AntennaConfiguration')(antconf)
-	
-	data = struct.pack(msg_header, msgtype,
-					msg_header_len + len(data)) + data
-	
-	return data
+		write_AntennaConfiguration(w, antconf)
+	w.end(start)
 
 
 Message_struct['InventoryParameterSpec'] = {
@@ -2127,24 +2143,22 @@ Message_struct['InventoryParameterSpec'] = {
 		'ProtocolID',
 		'AntennaConfiguration'
 	],
-	'encode': encode_InventoryParameterSpec
+	'encode': write_encoder(write_InventoryParameterSpec),
+	'write': write_InventoryParameterSpec
 }
 
 
 # 16.2.6.6 AntennaConfiguration Parameter
-def encode_AntennaConfiguration(par):
+def write_AntennaConfiguration(w, par):
 	msgtype = Message_struct['AntennaConfiguration']['type']
-	msg_header = '!HH'
-	data = struct.pack('!H', int(par['AntennaID']))
+	start = w.begin('!HHH', msgtype, int(par['AntennaID']))
 	if 'RFReceiver' in par:
-		data += encode('RFReceiver')(par['RFReceiver'])
+		write_RFReceiver(w, par['RFReceiver'])
 	if 'RFTransmitter' in par:
-		data += encode('RFTransmitter')(par['RFTransmitter'])
+		write_RFTransmitter(w, par['RFTransmitter'])
 	if 'C1G2InventoryCommand' in par:
-		data += encode('C1G2InventoryCommand')(par['C1G2InventoryCommand'])
-	data = struct.pack(msg_header, msgtype,
-					   len(data) + struct.calcsize(msg_header)) + data
-	return data
+		write_C1G2InventoryCommand(w, par['C1G2InventoryCommand'])
+	w.end(start)
 
 
 Message_struct['AntennaConfiguration'] = {
@@ -2158,18 +2172,15 @@ Message_struct['AntennaConfiguration'] = {
 		# C1G2InventoryCommand?
 		'C1G2InventoryCommand'
 	],
-	'encode': encode_AntennaConfiguration
+	'encode': write_encoder(write_AntennaConfiguration),
+	'write': write_AntennaConfiguration
 }
 
 
 # 16.2.6.7 RFReceiver Parameter
-def encode_RFReceiver(par):
+def write_RFReceiver(w, par):
 	msgtype = Message_struct['RFReceiver']['type']
-	msg_header = '!HH'
-	data = struct.pack('!H', par['ReceiverSensitivity'])
-	data = struct.pack(msg_header, msgtype,
-					   len(data) + struct.calcsize(msg_header)) + data
-	return data
+	w.param('!HHH', msgtype, par['ReceiverSensitivity'])
 
 
 Message_struct['RFReceiver'] = {
@@ -2178,20 +2189,16 @@ Message_struct['RFReceiver'] = {
 		'Type',
 		'ReceiverSensitivity',
 	],
-	'encode': encode_RFReceiver
+	'encode': write_encoder(write_RFReceiver),
+	'write': write_RFReceiver
 }
 
 
 # 16.2.6.8 RFTransmitter Parameter
-def encode_RFTransmitter(par):
+def write_RFTransmitter(w, par):
 	msgtype = Message_struct['RFTransmitter']['type']
-	msg_header = '!HH'
-	data = struct.pack('!H', par['HopTableId'])
-	data += struct.pack('!H', par['ChannelIndex'])
-	data += struct.pack('!H', par['TransmitPower'])
-	data = struct.pack(msg_header, msgtype,
-					   len(data) + struct.calcsize(msg_header)) + data
-	return data
+	w.param('!HHHHH', msgtype, par['HopTableId'], 
+		par['ChannelIndex'], par['TransmitPower'])
 
 
 Message_struct['RFTransmitter'] = {
@@ -2202,30 +2209,28 @@ Message_struct['RFTransmitter'] = {
 		'ChannelIndex',
 		'TransmitPower',
 	],
-	'encode': encode_RFTransmitter
+	'encode': write_encoder(write_RFTransmitter),
+	'write': write_RFTransmitter
 }
 
 
 # 16.3.1.2.1 C1G2InventoryCommand Parameter
-def encode_C1G2InventoryCommand(par):
+def write_C1G2InventoryCommand(w, par):
 	msgtype = Message_struct['C1G2InventoryCommand']['type']
-	msg_header = '!HH'
-	data = struct.pack('!B', (par['TagInventoryStateAware'] and 1 or 0) << 7)
+	start = w.begin('!HHB', msgtype, 
+		(par['TagInventoryStateAware'] and 1 or 0) << 7)
 	if 'C1G2Filter' in par:
-		data += encode('C1G2Filter')(par['C1G2Filter'])
+		w.write('C1G2Filter', par['C1G2Filter'])
 	if 'C1G2RFControl' in par:
-		data += encode('C1G2RFControl')(par['C1G2RFControl'])
+		write_C1G2RFControl(w, par['C1G2RFControl'])
 	if 'C1G2SingulationControl' in par:
-		data += encode('C1G2SingulationControl')(par['C1G2SingulationControl'])
+		write_C1G2SingulationControl(w, par['C1G2SingulationControl'])
 	# XXX custom parameters
 	if 'ImpinjInventorySearchMode' in par:
-		data += encode('ImpinjInventorySearchMode')(par['ImpinjInventorySearchMode'])
+		write_ImpinjInventorySearchMode(w, par['ImpinjInventorySearchMode'])
 	if 'MotoAntennaConfig' in par:
-		data += encode('MotoAntennaConfig')(par['MotoAntennaConfig'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + struct.calcsize(msg_header)) + data
-	return data
+		write_MotoAntennaConfig(w, par['MotoAntennaConfig'])
+	w.end(start)
 
 
 Message_struct['C1G2InventoryCommand'] = {
@@ -2237,7 +2242,8 @@ Message_struct['C1G2InventoryCommand'] = {
 		'C1G2SingulationControl'
 		# XXX custom parameters
 	],
-	'encode': encode_C1G2InventoryCommand
+	'encode': write_encoder(write_C1G2InventoryCommand),
+	'write': write_C1G2InventoryCommand
 }
 
 
@@ -2254,14 +2260,9 @@ Message_struct['C1G2Filter'] = {
 
 
 # 16.3.1.2.1.2 C1G2RFControl Parameter
-def encode_C1G2RFControl(par):
+def write_C1G2RFControl(w, par):
 	msgtype = Message_struct['C1G2RFControl']['type']
-	msg_header = '!HH'
-	data = struct.pack('!H', par['ModeIndex'])
-	data += struct.pack('!H', par['Tari'])
-	data = struct.pack(msg_header, msgtype,
-					len(data) + struct.calcsize(msg_header)) + data
-	return data
+	w.param('!HHHH', msgtype, par['ModeIndex'], par['Tari'])
 
 
 Message_struct['C1G2RFControl'] = {
@@ -2270,20 +2271,16 @@ Message_struct['C1G2RFControl'] = {
 		'ModeIndex',
 		'Tari',
 	],
-	'encode': encode_C1G2RFControl
+	'encode': write_encoder(write_C1G2RFControl),
+	'write': write_C1G2RFControl
 }
 
 
 # 16.3.1.2.1.3 C1G2SingulationControl Parameter
-def encode_C1G2SingulationControl(par):
+def write_C1G2SingulationControl(w, par):
 	msgtype = Message_struct['C1G2SingulationControl']['type']
-	msg_header = '!HH'
-	data = struct.pack('!B', par['Session'] << 6)
-	data += struct.pack('!H', par['TagPopulation'])
-	data += struct.pack('!I', par['TagTransitTime'])
-	data = struct.pack(msg_header, msgtype,
-					len(data) + struct.calcsize(msg_header)) + data
-	return data
+	w.param('!HHBHI', msgtype, par['Session'] << 6, 
+		par['TagPopulation'], par['TagTransitTime'])
 
 
 Message_struct['C1G2SingulationControl'] = {
@@ -2293,29 +2290,23 @@ Message_struct['C1G2SingulationControl'] = {
 		'TagPopulation',
 		'TagTransitTime',
 	],
-	'encode': encode_C1G2SingulationControl
+	'encode': write_encoder(write_C1G2SingulationControl),
+	'write': write_C1G2SingulationControl
 }
 
 
 # 16.2.7.1 ROReportSpec Parameter
-def encode_ROReportSpec(par):
+def write_ROReportSpec(w, par):
 	msgtype = Message_struct['ROReportSpec']['type']
 	n = int(par['N'])
 	roReportTrigger = ROReportTrigger_Name2Type[par['ROReportTrigger']]
 	
-	msg_header = '!HHBH'
-	msg_header_len = struct.calcsize(msg_header)
-	
-	data = encode('TagReportContentSelector')(par['TagReportContentSelector'])
+	start = w.begin('!HHBH', msgtype, roReportTrigger, n)
+	write_TagReportContentSelector(w, par['TagReportContentSelector'])
 	# add custom report
 	if 'ImpinjTagReportContentSelector' in par:
-		data += encode('ImpinjTagReportContentSelector')(par['ImpinjTagReportContentSelector'])
-	
-	data = struct.pack(msg_header, msgtype,
-					len(data) + msg_header_len,
-					roReportTrigger, n) + data
-	
-	return data
+		write_ImpinjTagReportContentSelector(w, par['ImpinjTagReportContentSelector'])
+	w.end(start)
 
 
 Message_struct['ROReportSpec'] = {
@@ -2325,16 +2316,15 @@ Message_struct['ROReportSpec'] = {
 		'ROReportTrigger',
 		'TagReportContentSelector'
 	],
-	'encode': encode_ROReportSpec
+	'encode': write_encoder(write_ROReportSpec),
+	'write': write_ROReportSpec
 }
 
 
 # 16.2.7.1 TagReportContentSelector Parameter
-def encode_TagReportContentSelector(par):
+def write_TagReportContentSelector(w, par):
 	msgtype = Message_struct['TagReportContentSelector']['type']
 	
-	msg_header = '!HH'
-	
 	flags = 0
 	i = 15
 	for field in Message_struct['TagReportContentSelector']['fields']:
@@ -2342,11 +2332,7 @@ def encode_TagReportContentSelector(par):
 			flags = flags | (1 << i)
 		i = i - 1
 	
-	data = struct.pack('!H', flags)
-	data = struct.pack(msg_header, msgtype,
-					len(data) + struct.calcsize(msg_header)) + data
-	
-	return data
+	w.param('!HHH', msgtype, flags)
 
 
 Message_struct['TagReportContentSelector'] = {
@@ -2363,7 +2349,8 @@ Message_struct['TagReportContentSelector'] = {
 		'EnableTagSeenCount',
 		'EnableAccessSpecID'
 	],
-	'encode': encode_TagReportContentSelector
+	'encode': write_encoder(write_TagReportContentSelector),
+	'write': write_TagReportContentSelector
 }
 
 # 16.2.7.3 TagReportData Parameter
@@ -3367,6 +3354,22 @@ def pack_data(msg, data):
 	
 	return data
 
+def begin_custom(w, msg):
+	'''
+	Starts a custom parameter in a LLRPWriter
+	:returns: offset for LLRPWriter.end
+	'''
+	ms = Message_struct[msg]
+	return w.begin('!HHII', ms['type'], ms['vendorID'], ms['subtype'])
+
+def param_custom(w, msg, fmt, *values):
+	'''
+	Writes a complete custom parameter of fixed size to a LLRPWriter
+	'''
+	ms = Message_struct[msg]
+	w.param('!HHII' + fmt.lstrip('!'), ms['type'], 
+		ms['vendorID'], ms['subtype'], *values)
+
 #
 # Impinj specific protocol extentions
 #
@@ -3411,13 +3414,12 @@ Message_struct['IMPINJ_ENABLE_EXTENSIONS_RESPONSE'] = {
 }
 
 # Impinj_Octane_LLRP 6.2.30 ImpinjTagReportContentSelector Parameter
-def encode_ImpinjTagReportContentSelector(par):
-	data = bytes()
+def write_ImpinjTagReportContentSelector(w, par):
+	start = begin_custom(w, 'ImpinjTagReportContentSelector')
 	for field in Message_struct['ImpinjTagReportContentSelector']['fields']:
 		# encode each parameter
-		data += encode(field)(field in par and par[field])
-	
-	return pack_data('ImpinjTagReportContentSelector', data)
+		w.write(field, field in par and par[field])
+	w.end(start)
 
 Message_struct['ImpinjTagReportContentSelector'] = {
 	'type': EXT_TYPE,
@@ -3427,20 +3429,19 @@ Message_struct['ImpinjTagReportContentSelector'] = {
 		'ImpinjEnableRFPhaseAngle',
 		'ImpinjEnablePeakRSSI'
 	],
-	'encode': encode_ImpinjTagReportContentSelector
+	'encode': write_encoder(write_ImpinjTagReportContentSelector),
+	'write': write_ImpinjTagReportContentSelector
 }
 
-def encode_ImpinjEnableTagReportParameter(par, enable):
+def write_ImpinjEnableTagReportParameter(w, par, enable):
 	# generic function to enable or disable impinj specific tag report parameters
 	# encode enable
 	active = 1 if enable else 0
-	data = struct.pack('!H', active)
-	
-	return pack_data(par, data)
+	param_custom(w, par, '!H', active)
 
 # Impinj_Octane_LLRP 6.2.32 ImpinjEnableRFPhaseAngle Parameter
-def encode_ImpinjEnableRFPhaseAngle(par):
-	return encode_ImpinjEnableTagReportParameter('ImpinjEnableRFPhaseAngle', par)
+def write_ImpinjEnableRFPhaseAngle(w, par):
+	write_ImpinjEnableTagReportParameter(w, 'ImpinjEnableRFPhaseAngle', par)
 
 Message_struct['ImpinjEnableRFPhaseAngle'] = {
 	'type': EXT_TYPE,
@@ -3449,12 +3450,13 @@ Message_struct['ImpinjEnableRFPhaseAngle'] = {
 	'fields': [
 		'RFPhaseAngleMode'
 	],
-	'encode': encode_ImpinjEnableRFPhaseAngle
+	'encode': write_encoder(write_ImpinjEnableRFPhaseAngle),
+	'write': write_ImpinjEnableRFPhaseAngle
 }
 
 # Impinj_Octane_LLRP 6.2.33 ImpinjEnablePeakRSSI Parameter
-def encode_ImpinjEnablePeakRSSI(par):
-	return encode_ImpinjEnableTagReportParameter('ImpinjEnablePeakRSSI', par)
+def write_ImpinjEnablePeakRSSI(w, par):
+	write_ImpinjEnableTagReportParameter(w, 'ImpinjEnablePeakRSSI', par)
 
 Message_struct['ImpinjEnablePeakRSSI'] = {
 	'type': EXT_TYPE,
@@ -3463,13 +3465,13 @@ Message_struct['ImpinjEnablePeakRSSI'] = {
 	'fields': [
 		'PeakRSSIMode'
 	],
-	'encode': encode_ImpinjEnablePeakRSSI
+	'encode': write_encoder(write_ImpinjEnablePeakRSSI),
+	'write': write_ImpinjEnablePeakRSSI
 }
 
 # Impinj_Octane_LLRP 6.2.3 ImpinjInventorySearchMode Parameter
-def encode_ImpinjInventorySearchMode(par):
-	data = struct.pack('!H', par) # encode searchmode	
-	return pack_data('ImpinjInventorySearchMode', data)
+def write_ImpinjInventorySearchMode(w, par):
+	param_custom(w, 'ImpinjInventorySearchMode', '!H', par) # encode searchmode
 
 Message_struct['ImpinjInventorySearchMode'] = {
 	'type': EXT_TYPE,
@@ -3478,7 +3480,8 @@ Message_struct['ImpinjInventorySearchMode'] = {
 	'fields': [
 		'InventorySearchMode'
 	],
-	'encode': encode_ImpinjInventorySearchMode
+	'encode': write_encoder(write_ImpinjInventorySearchMode),
+	'write': write_ImpinjInventorySearchMode
 }
 
 #
@@ -3488,14 +3491,13 @@ Message_struct['ImpinjInventorySearchMode'] = {
 MOTO_VEND = 161
 
 # MotoAntennaConfig
-def encode_MotoAntennaConfig(par):
-	data = bytes()
+def write_MotoAntennaConfig(w, par):
+	start = begin_custom(w, 'MotoAntennaConfig')
 	# encode optional parameters
 	for field in Message_struct['MotoAntennaConfig']['fields']:
 		if field in par:
-			data += encode(field)(par[field])
-	
-	return pack_data('MotoAntennaConfig', data)
+			w.write(field, par[field])
+	w.end(start)
 
 Message_struct['MotoAntennaConfig'] = {
 	'type': EXT_TYPE,
@@ -3506,13 +3508,14 @@ Message_struct['MotoAntennaConfig'] = {
 		'MotoAntennaPhysicalPortConfig', 
 		'MotoAntennaQueryConfig'
 	],
-	'encode': encode_MotoAntennaConfig
+	'encode': write_encoder(write_MotoAntennaConfig),
+	'write': write_MotoAntennaConfig
 }
 
 # MotoAntennaStopCondition
-def encode_MotoAntennaStopCondition(par):
-	data = struct.pack('!BH', par['AntennaStopTrigger'], par['AntennaStopConditionValue'])
-	return pack_data('MotoAntennaStopCondition', data)
+def write_MotoAntennaStopCondition(w, par):
+	param_custom(w, 'MotoAntennaStopCondition', '!BH', 
+		par['AntennaStopTrigger'], par['AntennaStopConditionValue'])
 
 Message_struct['MotoAntennaStopCondition'] = {
 	'type': EXT_TYPE,
@@ -3522,13 +3525,14 @@ Message_struct['MotoAntennaStopCondition'] = {
 		'AntennaStopTrigger', 
 		'AntennaStopConditionValue'
 	],
-	'encode': encode_MotoAntennaStopCondition
+	'encode': write_encoder(write_MotoAntennaStopCondition),
+	'write': write_MotoAntennaStopCondition
 }
 
 # MotoAntennaPhysicalPortConfig
-def encode_MotoAntennaPhysicalPortConfig(par):
-	data = struct.pack('!HH', par['PhysicalTransmitPort'], par['PhysicalReceivePort'])
-	return pack_data('MotoAntennaPhysicalPortConfig', data)
+def write_MotoAntennaPhysicalPortConfig(w, par):
+	param_custom(w, 'MotoAntennaPhysicalPortConfig', '!HH', 
+		par['PhysicalTransmitPort'], par['PhysicalReceivePort'])
 
 Message_struct['MotoAntennaPhysicalPortConfig'] = {
 	'type': EXT_TYPE,
@@ -3538,15 +3542,16 @@ Message_struct['MotoAntennaPhysicalPortConfig'] = {
 		'PhysicalTransmitPort', 
 		'PhysicalReceivePort'
 	],
-	'encode': encode_MotoAntennaPhysicalPortConfig
+	'encode': write_encoder(write_MotoAntennaPhysicalPortConfig),
+	'write': write_MotoAntennaPhysicalPortConfig
 }
 
 # MotoAntennaQueryConfig
-def encode_MotoAntennaQueryConfig(par):
+def write_MotoAntennaQueryConfig(w, par):
 	enableS = 1 if par['S'] else 0
 	enableB = 1 if par['B'] else 0
-	data = struct.pack('!B', enableS << 7 | enableB << 6)
-	return pack_data('MotoAntennaQueryConfig', data)
+	param_custom(w, 'MotoAntennaQueryConfig', '!B', 
+		enableS << 7 | enableB << 6)
 
 Message_struct['MotoAntennaQueryConfig'] = {
 	'type': EXT_TYPE,
@@ -3556,7 +3561,8 @@ Message_struct['MotoAntennaQueryConfig'] = {
 		'S', 
 		'B'
 	],
-	'encode': encode_MotoAntennaQueryConfig
+	'encode': write_encoder(write_MotoAntennaQueryConfig),
+	'write': write_MotoAntennaQueryConfig
 }
 
 
@@ -3597,7 +3603,17 @@ class LLRPROSpec(dict):
 				report_interval=1., report_every_n_tags=None,
 				report_selection={}, impinj_report_selection={}, 
 				mode_index=1, tari=16670, session=2, population=1, 
-				impinj_searchmode=0, hopTableID=0, moto_antenna_conf={}):
+				impinj_searchmode=0, hopTableID=0, moto_antenna_conf={},
+				start_trigger='Immediate', tag_observation=None, antenna_dwell=None):
+		'''
+		:param tag_observation: stop the AISpec early on a 
+			TagObservationTrigger, e.g. {'TriggerType': 'UponNUniqueTags', 
+			'NumberOfTags': 10} or {'TriggerType': 'UponSilenceMs', 'T': 200}.
+			report_interval is used as timeout
+		:param antenna_dwell: list of (antenna ID, dwell time in seconds). 
+			Creates one AISpec per antenna, run in the given order, 
+			and reports at the end of the ROSpec. Replaces antennas
+		'''
 		# Sanity checks
 		if msgid <= 0:
 			raise LLRPError('invalid ROSpec message ID {} (need >0)'.format(
@@ -3608,6 +3624,23 @@ class LLRPROSpec(dict):
 		if state not in ROSpecState_Name2Type:
 			raise LLRPError('invalid ROSpec state {} (need [{}])'.format(
 							state, ','.join(ROSpecState_Name2Type.keys())))
+		if start_trigger not in ('Null', 'Immediate'):
+			raise LLRPError('invalid ROSpec start trigger {} '
+							'(need [Null,Immediate])'.format(start_trigger))
+		if tag_observation and tag_observation.get('TriggerType') \
+				not in TagObservationTrigger_Name2Type:
+			raise LLRPError('invalid tag observation trigger {} (need [{}])'.format(
+							tag_observation.get('TriggerType'), 
+							','.join(TagObservationTrigger_Name2Type.keys())))
+		if antenna_dwell:
+			if tag_observation:
+				raise LLRPError('antenna_dwell cannot be combined with tag_observation')
+			if any(antid <= 0 for antid, _ in antenna_dwell):
+				raise LLRPError('invalid antenna_dwell antenna ID (need >0)')
+			antennas = tuple(antid for antid, _ in antenna_dwell)
+			dwellMs = tuple(max(int(dwell * 1000), 1) for _, dwell in antenna_dwell)
+		else:
+			dwellMs = None
 		
 		tagReportContentSelector = {
 			'EnableROSpecID': False,
@@ -3624,13 +3657,32 @@ class LLRPROSpec(dict):
 		if report_selection:
 			tagReportContentSelector.update(report_selection)
 		
+		# the encoded ROSpec only depends on the arguments in templateKey. 
+		# The templateValues are at fixed offsets and can be patched into 
+		# cached bytes (see llrp.ROSpecCache)
+		self.templateKey = repr((priority, state, tuple(antennas), 
+			report_interval, report_every_n_tags, 
+			sorted(tagReportContentSelector.items()), 
+			sorted(impinj_report_selection.items()), impinj_searchmode, 
+			hopTableID, moto_antenna_conf, start_trigger, 
+			sorted((tag_observation or {}).items()), dwellMs))
+		self.templateValues = {
+			'ROSpecID': msgid,
+			'TransmitPower': power,
+			'ChannelIndex': channel,
+			'ModeIndex': mode_index,
+			'Tari': tari,
+			'Session': session,
+			'TagPopulation': population,
+		}
+		
 		self['ROSpec'] = {
 			'ROSpecID': msgid,
 			'Priority': priority,
 			'CurrentState': state,
 			'ROBoundarySpec': {
 				'ROSpecStartTrigger': {
-					'ROSpecStartTriggerType': 'Immediate',
+					'ROSpecStartTriggerType': start_trigger,
 				},
 				'ROSpecStopTrigger': {
 					'ROSpecStopTriggerType': 'Null',
@@ -3693,12 +3745,44 @@ class LLRPROSpec(dict):
 			
 			ips['AntennaConfiguration'].append(antconf)
 		
-		if report_interval is not None:
+		if tag_observation:
+			# stop when the tags were observed, report_interval is the timeout
+			trigger = {
+				'TriggerType': tag_observation['TriggerType'],
+				'NumberOfTags': 0,
+				'NumberOfAttempts': 0,
+				'T': 0,
+				'Timeout': int((report_interval or 0) * 1000),
+			}
+			trigger.update(tag_observation)
+			self['ROSpec']['AISpec']['AISpecStopTrigger'] = {
+				'AISpecStopTriggerType': 'Tag observation',
+				'DurationTriggerValue': 0,
+				'TagObservationTrigger': trigger,
+			}
+		elif report_interval is not None:
 			self['ROSpec']['AISpec']['AISpecStopTrigger'] = {
 				'AISpecStopTriggerType': 'Duration',
 				'DurationTriggerValue': int(report_interval * 1000)
 			}
 		
+		if antenna_dwell:
+			# one AISpec per antenna, each stops after its dwell time
+			ips = self['ROSpec']['AISpec']['InventoryParameterSpec']
+			self['ROSpec']['AISpec'] = [{
+				'AntennaIDs': str(antconf['AntennaID']),
+				'AISpecStopTrigger': {
+					'AISpecStopTriggerType': 'Duration',
+					'DurationTriggerValue': ms,
+				},
+				'InventoryParameterSpec': {
+					'InventoryParameterSpecID': i + 1,
+					'ProtocolID': ips['ProtocolID'],
+					'AntennaConfiguration': [antconf],
+				},
+			} for i, (antconf, ms) in enumerate(zip(ips['AntennaConfiguration'], dwellMs))]
+			self['ROSpec']['ROReportSpec']['ROReportTrigger'] = 'Upon_N_Tags_Or_End_Of_ROSpec'
+		
 		if report_every_n_tags is not None:
 			# report n tags or upon timeout (when AISpec stops)
 			self['ROSpec']['ROReportSpec'].update({
@@ -0,0 +1,200 @@
+'''
+Ranking and benchmarking of the reader's RF modes
+'''
+from collections import namedtuple
+import json
+import math
+import os
+import threading
+import time
+
+from .tags import TagRead, tagEPC
+
+ModeRating = namedtuple('ModeRating', ('identifier', 'tagsPerSecond', 'mode'))
+
+EPC_REPLY_BITS = 16 + 96 + 16 # PC, EPC-96 and CRC-16
+
+
+def linkTimes(mode, tari=None, epcBits=EPC_REPLY_BITS):
+	'''Durations of the Gen2 slot types of a mode table entry.
+
+	:param mode: UHFC1G2RFModeTableEntry dictionary with BDR (bps),
+		Mod (0: FM0, 1: Miller 2, 2: Miller 4, 3: Miller 8), PIE (ratio * 1000)
+		and MinTari/MaxTari (ns)
+	:param tari: Tari in ns, defaults to MaxTari as used by getInventoryROSpec
+	:param epcBits: length of the EPC reply in bits
+	:returns: (success, collision, empty) slot durations in seconds,
+		or None when the mode does not describe its link'''
+	tari = (tari or mode['MaxTari'] or mode['MinTari']) * 1e-9
+	bdr = mode['BDR']
+	if not tari or not bdr:
+		return None # e.g. Impinj Autoset modes
+	pie = (mode['PIE'] or 1500) / 1000.
+	m = 2 ** (mode['Mod'] or 0) # subcarrier cycles per symbol
+	# reader to tag: data-0 is one Tari, data-1 is PIE Tari
+	bit = tari * (1. + pie) / 2.
+	rtcal = tari * (1. + pie)
+	frameSync = 12.5e-6 + tari + rtcal
+	queryRep = frameSync + 4 * bit
+	ack = frameSync + 18 * bit
+	# tag to reader
+	tpri = 1. / (bdr * m) # backscatter link period
+	preamble = (6 if m == 1 else 10) / bdr
+	rn16 = preamble + 17. / bdr
+	epc = preamble + (epcBits + 1.) / bdr
+	t1 = max(rtcal, 10. * tpri)
+	t2 = 3. * tpri
+	empty = queryRep + t1 + preamble
+	collision = queryRep + t1 + rn16 + t2
+	success = collision + ack + t1 + epc + t2
+	return success, collision, empty
+
+
+def theoreticalThroughput(mode, tari=None, epcBits=EPC_REPLY_BITS):
+	'''Singulated tags per second of a mode with optimal Q.
+	With as many slots as tags, 1/e of the slots are successful,
+	1/e are empty and the rest collide.
+	:returns: tags per second, 0 when unknown'''
+	times = linkTimes(mode, tari, epcBits)
+	if times is None:
+		return 0.
+	success, collision, empty = times
+	ps = pe = 1. / math.e
+	pc = 1. - ps - pe
+	return ps / (ps*success + pc*collision + pe*empty)
+
+
+def channelSpacing(freqTable):
+	''':param freqTable: frequencies in MHz, e.g. LLRPClient.freq_table
+	:returns: smallest distance of two channels in Hz, None for one channel'''
+	freqs = sorted(set(freqTable))
+	if len(freqs) < 2:
+		return None
+	return min(b - a for a, b in zip(freqs, freqs[1:])) * 1e6
+
+
+def fitsChannel(mode, spacing, tari=None):
+	'''checks if the reader signal (about 2/Tari wide for ASK)
+	fits into the channel spacing'''
+	tari = (tari or mode['MaxTari'] or mode['MinTari']) * 1e-9
+	if spacing is None or not tari:
+		return True
+	return 2. / tari <= spacing
+
+
+def rankModes(modes, freqTable=(), tari=None, epcBits=EPC_REPLY_BITS):
+	'''Ranks mode table entries by theoretical throughput.
+	:param modes: UHFRFModeTable dictionary or list of mode entries
+	:param freqTable: frequencies in MHz to skip modes wider than a channel
+	:param tari: Tari in ns, defaults to the MaxTari of every mode
+	:returns: list of ModeRating, fastest first. Modes without link
+		parameters are appended with 0 tags per second'''
+	if isinstance(modes, dict):
+		modes = [mode for key, mode in modes.items() if key.startswith('UHFC1G2RFModeTableEntry')]
+	spacing = channelSpacing(freqTable)
+	ratings = [ModeRating(mode['ModeIdentifier'], theoreticalThroughput(mode, tari, epcBits), mode)
+		for mode in modes if fitsChannel(mode, spacing, tari)]
+	ratings.sort(key=lambda rating: -rating.tagsPerSecond)
+	return ratings
+
+
+def uniqueTagsPerSecond(tags, duration):
+	'''Rate of new unique tags. Uses the reader's first seen timestamps
+	when available, so connection overhead is not counted.
+	:param tags: list of tag dictionaries or TagRead objects
+	:param duration: fallback duration in seconds
+	:returns: unique tags per second'''
+	firstSeen = {}
+	for tag in tags:
+		if isinstance(tag, TagRead):
+			epc, seen = tag.epc, tag.first_seen
+		else:
+			epc = tagEPC(tag)
+			seen = tag.get('FirstSeenTimestampUptime', tag.get('FirstSeenTimestampUTC'))
+		if epc not in firstSeen or (seen is not None and seen < firstSeen[epc]):
+			firstSeen[epc] = seen
+	times = sorted(t for t in firstSeen.values() if t is not None)
+	if len(times) > 1 and times[-1] > times[0]:
+		return (len(times) - 1) / ((times[-1] - times[0]) * 1e-6)
+	return len(firstSeen) / duration if duration > 0 else 0.
+
+
+class ModeSelector(object):
+	'''
+	Selects the fastest mode of a reader.
+
+	Modes are ranked by the theoretical throughput of their link
+	parameters. The best candidates can be benchmarked with short
+	inventories on the actual tags. The choice is cached per reader
+	(model, firmware, address and frequencies), optionally in a JSON file:
+
+		selector = ModeSelector(reader, cacheFile='modes.json')
+		mode = selector.select(benchmark=3, powerDBm=25)
+		tags = reader.detectTags(mode=mode)
+	'''
+	cache = {} # shared by all selectors of this process
+	lock = threading.Lock()
+
+	def __init__(self, reader, cacheFile=None):
+		''':param reader: connected Reader
+		:param cacheFile: path of a JSON file to keep the choices between runs
+		'''
+		self.reader = reader
+		self.cacheFile = cacheFile
+		if cacheFile and os.path.exists(cacheFile):
+			with open(cacheFile) as file:
+				with self.lock:
+					self.cache.update(json.load(file))
+
+	def key(self):
+		''':returns: cache key of the reader and its frequencies'''
+		return '{} {}'.format(self.reader.readerIdentity(),
+			','.join(str(f) for f in self.reader.freq_table))
+
+	def rank(self, tari=None):
+		''':returns: list of ModeRating of the reader's mode table, fastest first'''
+		bandcap = self.reader.capabilities['RegulatoryCapabilities']['UHFBandCapabilities']
+		return rankModes(bandcap['UHFRFModeTable'], self.reader.freq_table, tari)
+
+	def benchmark(self, identifiers, duration=0.5, **kwargs):
+		'''runs a short inventory with every mode
+		:param identifiers: mode identifiers to test
+		:param duration: inventory duration per mode in seconds
+		:param kwargs: other parameters of Reader.detectTags, e.g. powerDBm
+		:returns: dictionary mode identifier -> unique tags per second'''
+		results = {}
+		for identifier in identifiers:
+			start = time.monotonic()
+			tags = self.reader.detectTags(mode=identifier, duration=duration, **kwargs)
+			results[identifier] = uniqueTagsPerSecond(tags, time.monotonic() - start)
+		return results
+
+	def select(self, benchmark=0, refresh=False, duration=0.5, **kwargs):
+		'''gets the fastest mode, from the cache when possible
+		:param benchmark: number of best ranked modes to benchmark,
+			0 trusts the theoretical ranking
+		:param refresh: ignore the cached choice
+		:param duration: inventory duration per benchmarked mode in seconds
+		:param kwargs: other parameters of Reader.detectTags
+		:returns: mode identifier'''
+		key = self.key()
+		with self.lock:
+			cached = self.cache.get(key)
+		if cached and not refresh and (cached['benchmarked'] or not benchmark):
+			return cached['mode']
+		ranking = self.rank()
+		if not ranking:
+			raise ValueError('reader has no modes')
+		best = ranking[0].identifier
+		if benchmark:
+			# modes without link parameters can only be judged by measuring
+			candidates = [r.identifier for r in ranking if r.tagsPerSecond][:benchmark] or \
+				[r.identifier for r in ranking][:benchmark]
+			results = self.benchmark(candidates, duration, **kwargs)
+			best = max(candidates, key=lambda identifier: results[identifier])
+		with self.lock:
+			self.cache[key] = {'mode': best, 'benchmarked': bool(benchmark)}
+			if self.cacheFile:
+				with open(self.cacheFile, 'w') as file:
+					json.dump(self.cache, file, indent=4)
+		return best
@@ -0,0 +1,370 @@
+'''
+Reading LLRP sessions from pcap and pcapng files, e.g. tcpdump captures
+
+Everything is parsed in one pass over the file. Memory stays bounded:
+only the TCP segments which arrived out of order and the incomplete
+LLRP message of every connection are kept.
+'''
+from collections import namedtuple, OrderedDict
+import ipaddress
+import logging
+import struct
+
+from .llrp import LLRPMessage, LLRP_PORT
+from .llrp_proto import LLRPError, Message_Type2Name, EXT_TYPE
+
+logger = logging.getLogger(__name__)
+
+PcapMessage = namedtuple('PcapMessage', ('time', 'source', 'destination', 'name', 'msgdict', 'frame'))
+
+PCAPNG_SHB = 0x0A0D0D0A
+MAX_MESSAGE_LEN = 1 << 24 # larger headers are treated as garbage
+MAX_SEGMENTS = 256 # out of order segments kept per direction
+
+
+def _linkPayload(linktype, data):
+	''':returns: IP packet of a link layer frame or None'''
+	if linktype == 1: # Ethernet
+		etype, = struct.unpack_from('!H', data, 12)
+		offset = 14
+		while etype in (0x8100, 0x88a8): # VLAN tags
+			etype, = struct.unpack_from('!H', data, offset + 2)
+			offset += 4
+	elif linktype == 113: # Linux cooked capture
+		etype, = struct.unpack_from('!H', data, 14)
+		offset = 16
+	elif linktype == 276: # Linux cooked capture v2
+		etype, = struct.unpack_from('!H', data, 0)
+		offset = 20
+	elif linktype in (101, 12, 14): # raw IP
+		return data
+	elif linktype in (0, 108): # BSD loopback
+		return data[4:]
+	else:
+		return None
+	if etype not in (0x0800, 0x86dd):
+		return None
+	return data[offset:]
+
+
+def _tcpSegment(packet):
+	''':returns: (source address, destination address, TCP segment) or None'''
+	version = packet[0] >> 4
+	if version == 4:
+		ihl = (packet[0] & 0xf) * 4
+		total, = struct.unpack_from('!H', packet, 2)
+		fragment, = struct.unpack_from('!H', packet, 6)
+		if packet[9] != 6 or fragment & 0x3fff: # not TCP or fragmented
+			return None
+		# the total length drops Ethernet padding
+		return packet[12:16], packet[16:20], packet[ihl:total]
+	if version == 6:
+		nxt = packet[6]
+		length, = struct.unpack_from('!H', packet, 4)
+		offset = 40
+		while nxt in (0, 43, 60): # hop-by-hop, routing and destination options
+			nxt = packet[offset]
+			offset += (packet[offset + 1] + 1) * 8
+		if nxt != 6:
+			return None
+		return packet[8:24], packet[24:40], packet[offset:40 + length]
+	return None
+
+
+class _Direction(object):
+	'''TCP reassembly and LLRP framing of one direction of a connection'''
+	__slots__ = ('next', 'segments', 'buffer', 'synced', 'gaps')
+
+	def __init__(self):
+		self.next = None # next expected sequence number
+		self.segments = {} # sequence number -> payload received too early
+		self.buffer = bytearray() # bytes of incomplete messages
+		self.synced = False # buffer starts at a message header
+		self.gaps = 0 # number of missing segments which were skipped
+
+	def add(self, seq, syn, payload):
+		''':returns: payload bytes in stream order which became available'''
+		if syn:
+			self.next = (seq + 1) & 0xffffffff
+			self.synced = True
+			return b''
+		if not payload:
+			return b''
+		if self.next is None:
+			# capture started in the middle of the connection
+			self.next = seq
+		rel = ((seq - self.next + 0x80000000) & 0xffffffff) - 0x80000000
+		if rel > 0:
+			self.segments[seq] = payload
+			if len(self.segments) <= MAX_SEGMENTS:
+				return b''
+			return self.skipGap()
+		return self._pull(payload[-rel:] if rel else payload)
+
+	def skipGap(self):
+		'''gives up waiting for a missing segment
+		:returns: payload bytes of the buffered segments after the gap'''
+		if not self.segments:
+			return b''
+		self.next = min(self.segments, key=lambda s: (s - self.next) & 0xffffffff)
+		self.buffer.clear()
+		self.synced = False
+		self.gaps += 1
+		return self._pull(b'')
+
+	def _pull(self, data):
+		'''appends data and the buffered segments which follow it'''
+		out = bytearray(data)
+		self.next = (self.next + len(data)) & 0xffffffff
+		found = True
+		while found and self.segments:
+			found = False
+			for seq in list(self.segments):
+				rel = ((seq - self.next + 0x80000000) & 0xffffffff) - 0x80000000
+				if rel <= 0:
+					payload = self.segments.pop(seq)
+					if len(payload) > -rel:
+						out += payload[-rel:]
+						self.next = (self.next + len(payload) + rel) & 0xffffffff
+					found = True
+		return out
+
+	def frames(self, data):
+		''':returns: complete LLRP messages of the stream'''
+		buf = self.buffer
+		buf += data
+		frames = []
+		start = 0
+		while True:
+			if not self.synced:
+				start = self._resync(start)
+				if start is None:
+					# keep a few bytes, a header may start in them
+					del buf[:max(len(buf) - 9, 0)]
+					return frames
+			if len(buf) - start < 10:
+				break
+			msgtype, length = struct.unpack_from('!HI', buf, start)
+			if not _plausible(msgtype, length):
+				self.synced = False
+				start += 1
+				continue
+			if len(buf) - start < length:
+				break
+			frames.append(bytes(buf[start:start + length]))
+			start += length
+		del buf[:start]
+		return frames
+
+	def _resync(self, start):
+		''':returns: offset of the next plausible message header or None'''
+		buf = self.buffer
+		for i in range(start, len(buf) - 9):
+			msgtype, length = struct.unpack_from('!HI', buf, i)
+			if _plausible(msgtype, length):
+				self.synced = True
+				return i
+		return None
+
+
+def _plausible(msgtype, length):
+	''':returns: True when a message header looks valid'''
+	version = (msgtype >> 10) & 0x7
+	msgtype &= 0x3ff
+	return version in (1, 2) and 10 <= length <= MAX_MESSAGE_LEN and \
+		(msgtype in Message_Type2Name or msgtype == EXT_TYPE)
+
+
+class PcapParser(object):
+	'''
+	Extracts the LLRP messages of all connections in a pcap or pcapng file.
+
+		parser = PcapParser('site.pcapng')
+		for msg in parser.messages():
+			print(msg.time, msg.source, msg.name)
+		for t, reader, tag in PcapParser('site.pcap').tags():
+			print(t, reader, tagEPC(tag))
+	'''
+	def __init__(self, source, port=LLRP_PORT, maxConnections=1024):
+		''':param source: file name or binary file object
+		:param port: TCP port of the readers
+		:param maxConnections: connections to keep state for, the least
+			recently active one is dropped first
+		'''
+		self.source = source
+		self.port = port
+		self.maxConnections = maxConnections
+		self.packets = 0 # number of packets read
+		self.gaps = 0 # number of times a missing segment was skipped
+
+	def _packets(self, file):
+		'''yields (time, link type, frame) of every packet'''
+		magic = file.read(4)
+		if len(magic) < 4:
+			return
+		if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+			yield from self._pcapng(file, magic)
+		else:
+			yield from self._pcap(file, magic)
+
+	def _pcap(self, file, magic):
+		formats = {
+			b'\xd4\xc3\xb2\xa1': ('<', 1e-6), b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+			b'\x4d\x3c\xb2\xa1': ('<', 1e-9), b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+		}
+		if magic not in formats:
+			raise ValueError('not a pcap or pcapng file')
+		endian, scale = formats[magic]
+		header = file.read(20)
+		linktype = struct.unpack(endian + 'I', header[16:20])[0] & 0xffff
+		record = struct.Struct(endian + 'IIII')
+		while True:
+			head = file.read(record.size)
+			if len(head) < record.size:
+				return
+			sec, frac, length, _ = record.unpack(head)
+			data = file.read(length)
+			if len(data) < length:
+				return
+			yield sec + frac * scale, linktype, data
+
+	def _pcapng(self, file, magic):
+		endian = '<'
+		interfaces = [] # (link type, timestamp scale)
+		head = magic + file.read(4)
+		while len(head) == 8:
+			blocktype = struct.unpack(endian + 'I', head[:4])[0]
+			if blocktype == PCAPNG_SHB:
+				order = file.read(4)
+				endian = '<' if order == b'\x4d\x3c\x2b\x1a' else '>'
+				length = struct.unpack(endian + 'I', head[4:8])[0]
+				file.read(length - 12)
+				interfaces = []
+			else:
+				length = struct.unpack(endian + 'I', head[4:8])[0]
+				body = file.read(length - 8)
+				if len(body) < length - 8:
+					return
+				packet = self._pcapngBlock(endian, blocktype, body, interfaces)
+				if packet is not None:
+					yield packet
+			head = file.read(8)
+
+	def _pcapngBlock(self, endian, blocktype, body, interfaces):
+		''':returns: (time, link type, frame) of a packet block or None'''
+		if blocktype == 1: # interface description
+			linktype, = struct.unpack_from(endian + 'H', body, 0)
+			interfaces.append((linktype, _tsresol(endian, body[8:-4])))
+		elif blocktype == 6: # enhanced packet
+			ifid, high, low, caplen = struct.unpack_from(endian + 'IIII', body, 0)
+			linktype, scale = interfaces[ifid]
+			return ((high << 32) | low) * scale, linktype, body[20:20 + caplen]
+		elif blocktype == 3: # simple packet, no time stamp
+			origlen, = struct.unpack_from(endian + 'I', body, 0)
+			return None, interfaces[0][0], body[4:4 + min(origlen, len(body) - 8)]
+		elif blocktype == 2: # obsolete packet
+			ifid, _, high, low, caplen = struct.unpack_from(endian + 'HHIII', body, 0)
+			linktype, scale = interfaces[ifid]
+			return ((high << 32) | low) * scale, linktype, body[20:20 + caplen]
+		return None
+
+	def frames(self):
+		'''yields (time, source, destination, frame) of every LLRP message,
+		with addresses as (IP address, port)'''
+		connections = OrderedDict()
+		file = open(self.source, 'rb') if isinstance(self.source, str) else self.source
+		t = None
+		try:
+			for t, linktype, data in self._packets(file):
+				self.packets += 1
+				try:
+					packet = _linkPayload(linktype, data)
+					segment = packet and _tcpSegment(packet)
+					if not segment:
+						continue
+					src, dst, tcp = segment
+					sport, dport, seq, _, flags = struct.unpack_from('!HHIIH', tcp, 0)
+				except (struct.error, IndexError):
+					continue # truncated packet
+				if self.port not in (sport, dport):
+					continue
+				key = (src, sport, dst, dport)
+				direction = connections.get(key)
+				if direction is None:
+					direction = connections[key] = _Direction()
+					if len(connections) > self.maxConnections:
+						connections.popitem(last=False)
+				else:
+					connections.move_to_end(key)
+				payload = tcp[(flags >> 12) * 4:]
+				gaps = direction.gaps
+				data = direction.add(seq, flags & 0x02, payload)
+				self.gaps += direction.gaps - gaps
+				for frame in direction.frames(data):
+					yield t, (src, sport), (dst, dport), frame
+				if flags & 0x05: # FIN or RST
+					yield from self._close(t, key, connections.pop(key))
+			# the capture missed segments of connections which are still open
+			while connections:
+				key, direction = connections.popitem(last=False)
+				yield from self._close(t, key, direction)
+		finally:
+			if file is not self.source:
+				file.close()
+
+	def _close(self, t, key, direction):
+		'''yields the frames of a connection which are still waiting for missing segments'''
+		src, sport, dst, dport = key
+		while direction.segments:
+			self.gaps += 1
+			for frame in direction.frames(direction.skipGap()):
+				yield t, (src, sport), (dst, dport), frame
+
+	def messages(self, decode=True):
+		'''yields PcapMessage for every LLRP message.
+		:param decode: decode the messages from the readers into msgdict'''
+		addresses = {}
+		for t, src, dst, frame in self.frames():
+			msgtype = struct.unpack_from('!H', frame)[0] & 0x3ff
+			if msgtype == EXT_TYPE and len(frame) >= 15:
+				name = Message_Type2Name.get((msgtype, frame[14]))
+			else:
+				name = Message_Type2Name.get(msgtype)
+			msgdict = None
+			if decode and src[1] == self.port and name:
+				try:
+					msgdict = LLRPMessage(msgbytes=frame).msgdict.get(name)
+				except (LLRPError, struct.error, IndexError, KeyError):
+					logger.debug('cannot decode %s at %s', name, t)
+			yield PcapMessage(t, _address(addresses, src), _address(addresses, dst), name, msgdict, frame)
+
+	def tags(self):
+		'''yields (time, reader address, tag dictionary) of every tag report'''
+		for msg in self.messages():
+			if msg.name == 'RO_ACCESS_REPORT' and msg.msgdict:
+				for tag in msg.msgdict.get('TagReportData') or []:
+					yield msg.time, msg.source, tag
+
+
+def _tsresol(endian, options):
+	''':returns: timestamp scale from the if_tsresol option of an interface'''
+	offset = 0
+	while offset + 4 <= len(options):
+		code, length = struct.unpack_from(endian + 'HH', options, offset)
+		if code == 0:
+			break
+		if code == 9 and length >= 1:
+			value = options[offset + 4]
+			return 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+		offset += 4 + (length + 3) // 4 * 4
+	return 1e-6
+
+
+def _address(cache, address):
+	''':returns: "ip:port" string of an (address bytes, port) pair'''
+	try:
+		return cache[address]
+	except KeyError:
+		ip = ipaddress.ip_address(address[0])
+		text = cache[address] = ('[{}]:{}' if ip.version == 6 else '{}:{}').format(ip, address[1])
+		return text
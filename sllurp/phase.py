@@ -0,0 +1,149 @@
+'''
+Processing of Impinj phase angles: unwrapping and phase-slope ranging
+
+All functions work on a TagBatch (see tags.py) and are vectorized with NumPy.
+Phases are expected in degrees, as reported by the R420.
+'''
+from collections import namedtuple
+import math
+
+from .tags import TagBatch
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+SPEED_OF_LIGHT = 299792458. # m/s
+
+RangeEstimate = namedtuple('RangeEstimate', ('distance', 'slope', 'channels', 'reads'))
+
+
+def _requireNumpy():
+	if np is None:
+		raise ImportError('sllurp.phase needs numpy')
+
+
+def _columns(tags):
+	'''gets the columns of a TagBatch or a list of tags as NumPy arrays'''
+	_requireNumpy()
+	if not isinstance(tags, TagBatch):
+		tags = TagBatch.fromTags(tags)
+	return tags, tags.toNumpy()
+
+
+def channelFrequencies(channels, freqTable):
+	'''maps channel indices of tag reports to frequencies
+	:param channels: array of ChannelIndex values (starting at 1)
+	:param freqTable: frequencies in MHz, e.g. LLRPClient.freq_table
+	:returns: array of frequencies in MHz, NaN for unknown channels'''
+	_requireNumpy()
+	table = np.append(np.asarray(freqTable, dtype=float), np.nan)
+	channels = np.asarray(channels, dtype=int) - 1
+	channels[(channels < 0) | (channels >= len(freqTable))] = len(freqTable)
+	return table[channels]
+
+
+def _segmentStarts(*keys):
+	''':param keys: sorted key arrays
+	:returns: indices where any key changes, starting with 0'''
+	n = len(keys[0])
+	change = np.zeros(n, dtype=bool)
+	if n:
+		change[0] = True
+	for key in keys:
+		change[1:] |= key[1:] != key[:-1]
+	return np.flatnonzero(change)
+
+
+def _unwrapSegments(phase, starts, period):
+	'''unwraps phase (radians) within each segment,
+	every segment keeps its first value'''
+	if not len(phase):
+		return phase
+	diff = np.diff(phase)
+	wrapped = (diff + period/2) % period - period/2
+	# keep the raw step between segments, so each segment starts unchanged
+	boundaries = starts[1:] - 1
+	wrapped[boundaries] = diff[boundaries]
+	return np.concatenate(([phase[0]], phase[0] + np.cumsum(wrapped)))
+
+
+def unwrapPhase(tags, piAmbiguity=False):
+	'''Unwraps the phase of every (EPC, antenna, channel) over time.
+
+	:param tags: TagBatch or list of tags
+	:param piAmbiguity: the reader reports phase modulo 180 degree
+		instead of 360 degree
+	:returns: array of unwrapped phases in radians, one per row of the batch.
+		NaN for rows without phase'''
+	tags, cols = _columns(tags)
+	period = math.pi if piAmbiguity else 2*math.pi
+	result = np.full(len(tags), np.nan)
+	rows = np.flatnonzero(~np.isnan(cols['phase']))
+	if not len(rows):
+		return result
+	epc, antenna, channel = cols['epc'][rows], cols['antenna'][rows], cols['channel'][rows]
+	order = np.lexsort((cols['last_seen'][rows], channel, antenna, epc))
+	rows = rows[order]
+	phase = np.radians(cols['phase'][rows]) % period
+	starts = _segmentStarts(epc[order], antenna[order], channel[order])
+	result[rows] = _unwrapSegments(phase, starts, period)
+	return result
+
+
+def estimateRanges(tags, freqTable, piAmbiguity=False, minChannels=3):
+	'''Estimates the distance of every (EPC, antenna) from the slope
+	of phase over frequency.
+
+	The backscatter phase grows with 4*pi*f*d/c, so d = c/(4*pi) * dphase/df.
+	Reads of each channel are averaged (circular mean), the channel phases are
+	unwrapped along frequency and a line is fitted. The unambiguous range
+	is c/(4*df) for adjacent channels df apart (c/(8*df) with piAmbiguity).
+	Readers may add a constant offset, so calibrate with a known distance.
+
+	:param tags: TagBatch or list of tags with phase and channel
+	:param freqTable: frequencies in MHz, e.g. LLRPClient.freq_table
+	:param piAmbiguity: the reader reports phase modulo 180 degree
+	:param minChannels: minimum number of different channels for an estimate
+	:returns: dictionary (EPC, antenna) -> RangeEstimate with distance in m
+		and slope in rad/Hz'''
+	tags, cols = _columns(tags)
+	period = math.pi if piAmbiguity else 2*math.pi
+	freq = channelFrequencies(cols['channel'], freqTable) * 1e6
+	rows = np.flatnonzero(~(np.isnan(cols['phase']) | np.isnan(freq)))
+	if not len(rows):
+		return {}
+	epc, antenna, freq = cols['epc'][rows], cols['antenna'][rows], freq[rows]
+	order = np.lexsort((freq, antenna, epc))
+	epc, antenna, freq = epc[order], antenna[order], freq[order]
+	phase = np.radians(cols['phase'][rows][order])
+
+	# circular mean per (EPC, antenna, frequency)
+	starts = _segmentStarts(epc, antenna, freq)
+	phasor = np.exp(1j * phase * (2*math.pi/period))
+	meanPhase = np.angle(np.add.reduceat(phasor, starts)) * (period/(2*math.pi)) % period
+	reads = np.diff(np.append(starts, len(phase)))
+	epc, antenna, freq = epc[starts], antenna[starts], freq[starts]
+
+	# unwrap along frequency and fit a line per (EPC, antenna)
+	groups = _segmentStarts(epc, antenna)
+	meanPhase = _unwrapSegments(meanPhase, groups, period)
+	n = np.diff(np.append(groups, len(freq)))
+	fMean = np.add.reduceat(freq, groups) / n
+	pMean = np.add.reduceat(meanPhase, groups) / n
+	df = freq - np.repeat(fMean, n)
+	dp = meanPhase - np.repeat(pMean, n)
+	sxx = np.add.reduceat(df*df, groups)
+	sxy = np.add.reduceat(df*dp, groups)
+	nReads = np.add.reduceat(reads, groups)
+
+	result = {}
+	for i, start in enumerate(groups):
+		if n[i] < minChannels or not sxx[i]:
+			continue
+		slope = sxy[i] / sxx[i]
+		key = (tags.epcs[epc[start]], int(antenna[start]))
+		result[key] = RangeEstimate(SPEED_OF_LIGHT * slope / (4*math.pi),
+			slope, int(n[i]), int(nReads[i]))
+	return result
@@ -0,0 +1,166 @@
+'''
+Tracking which tags are present at which antenna
+'''
+from collections import namedtuple
+import threading
+import time
+
+from .tags import TagRead, TagBatch, tagEPC
+
+ENTER = 'enter' # tag seen for the first time (again)
+MOVE = 'move' # tag seen at another antenna or gone from its current antenna
+EXIT = 'exit' # tag not seen at any antenna for the timeout
+
+PresenceEvent = namedtuple('PresenceEvent', ('kind', 'epc', 'antenna', 'time', 'previous'))
+
+
+class PresenceTracker(object):
+	'''
+	Turns tag reads into enter, move and exit events.
+
+	The last-seen time is kept per (EPC, antenna) in a dictionary. Entries
+	expire through a timing wheel: each entry sits in the slot of its
+	deadline and is only looked at again when that slot comes around.
+	A read therefore costs O(1) and expiring costs O(1) per entry,
+	independent of the number of present tags.
+
+	Feed it with the live reports of a reader:
+
+		tracker = PresenceTracker(timeout=3., callback=print)
+		reader.startLiveReports(tracker.update, tagInterval=None, timeInterval=0.2)
+	'''
+	def __init__(self, timeout=3., resolution=0.1, callback=None, trackAntennas=True):
+		''':param timeout: seconds without a read until a tag is gone
+		:param resolution: step of the timing wheel in seconds.
+			Exit events are late by at most this value
+		:param callback: function which gets called with every PresenceEvent
+		:param trackAntennas: emit move events between antennas.
+			If False, tags are only tracked by EPC
+		'''
+		self.timeout = float(timeout)
+		self.resolution = float(resolution)
+		self.callback = callback
+		self.trackAntennas = trackAntennas
+
+		self.lastSeen = {} # (epc, antenna) -> time of last read
+		self.antennas = {} # epc -> set of antennas the tag is present at
+		self.current = {} # epc -> antenna of the latest appearance
+
+		# timing wheel covering one timeout
+		self.slots = int(self.timeout / self.resolution) + 2
+		self.wheel = [[] for _ in range(self.slots)]
+		self.tick = None # tick of the last advance
+		self.lock = threading.RLock() # live reports arrive on the reader thread
+
+	def __len__(self):
+		''':returns: number of present tags'''
+		return len(self.antennas)
+
+	def __contains__(self, epc):
+		return epc in self.antennas
+
+	def where(self, epc):
+		''':returns: antenna the tag is currently assigned to or None'''
+		return self.current.get(epc)
+
+	def update(self, tags, now=None):
+		'''Processes the reads of a tag report.
+		Can be used as callback of Reader.startLiveReports.
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param now: time of the reads in seconds. Defaults to time.monotonic()
+		:returns: list of PresenceEvents'''
+		if now is None:
+			now = time.monotonic()
+		with self.lock:
+			events = self.advance(now)
+			for epc, antenna in self._reads(tags):
+				self._seen(epc, antenna, now, events)
+		return events
+
+	def advance(self, now=None):
+		'''Expires tags which were not seen for the timeout.
+		Called by update, call it periodically when no reports arrive.
+		:param now: current time in seconds. Defaults to time.monotonic()
+		:returns: list of PresenceEvents'''
+		if now is None:
+			now = time.monotonic()
+		events = []
+		with self.lock:
+			target = int(now / self.resolution)
+			if self.tick is None:
+				self.tick = target
+			# each slot needs to be visited at most once
+			self.tick = max(self.tick, target - self.slots)
+			while self.tick < target:
+				self.tick += 1
+				slot = self.tick % self.slots
+				due, self.wheel[slot] = self.wheel[slot], []
+				for key in due:
+					last = self.lastSeen.get(key)
+					if last is None:
+						continue
+					deadline = last + self.timeout
+					if int(deadline / self.resolution) <= self.tick:
+						self._expire(key, deadline, events)
+					else:
+						# seen again meanwhile
+						self._schedule(key, deadline)
+		return events
+
+	def _reads(self, tags):
+		'''yields (epc, antenna) of each read'''
+		track = self.trackAntennas
+		if isinstance(tags, TagBatch):
+			antennas = tags.antenna if track else [0]*len(tags)
+			for epc, antenna in zip(tags.epcColumn(), antennas):
+				yield epc, antenna
+			return
+		for tag in tags:
+			if isinstance(tag, TagRead):
+				yield tag.epc, (tag.antenna or 0) if track else 0
+			else:
+				epc = tagEPC(tag)
+				yield epc, tag.get('AntennaID', 0) if track else 0
+
+	def _schedule(self, key, deadline):
+		tick = max(int(deadline / self.resolution), self.tick + 1)
+		self.wheel[tick % self.slots].append(key)
+
+	def _emit(self, events, *args):
+		event = PresenceEvent(*args)
+		events.append(event)
+		if self.callback:
+			self.callback(event)
+
+	def _seen(self, epc, antenna, now, events):
+		key = (epc, antenna)
+		known = key in self.lastSeen
+		self.lastSeen[key] = now
+		if known:
+			return
+		self._schedule(key, now + self.timeout)
+		present = self.antennas.get(epc)
+		if present is None:
+			self.antennas[epc] = {antenna}
+			self.current[epc] = antenna
+			self._emit(events, ENTER, epc, antenna, now, None)
+		else:
+			present.add(antenna)
+			previous = self.current[epc]
+			self.current[epc] = antenna
+			self._emit(events, MOVE, epc, antenna, now, previous)
+
+	def _expire(self, key, deadline, events):
+		epc, antenna = key
+		del self.lastSeen[key]
+		present = self.antennas[epc]
+		present.discard(antenna)
+		if not present:
+			del self.antennas[epc]
+			del self.current[epc]
+			self._emit(events, EXIT, epc, None, deadline, antenna)
+		elif self.current[epc] == antenna:
+			# still there at other antennas, take the latest one
+			latest = max(present, key=lambda a: self.lastSeen[(epc, a)])
+			self.current[epc] = latest
+			self._emit(events, MOVE, epc, latest, deadline, antenna)
@@ -0,0 +1,561 @@
+'''
+Sharing one reader connection between many local LLRP clients
+'''
+from collections import deque
+import itertools
+import json
+import logging
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from .capture import frameType
+from .llrp import LLRPMessage, Transport
+from .llrp_proto import Message_Type2Name
+
+logger = logging.getLogger(__name__)
+
+HELLO = b'SUBSCRIBE ' # optional first line of a subscriber with its filter
+
+KEEPALIVE = 62
+KEEPALIVE_ACK = 72
+CLOSE_CONNECTION = 14
+ERROR_MESSAGE = 100
+ADD_ROSPEC = 20
+ADD_ACCESSSPEC = 40
+LLRP_STATUS = 287
+
+# message type -> (kind of spec, offset of its ID) of the commands whose
+# ROSpecID or AccessSpecID is replaced by an ID of the proxy
+SPEC_COMMANDS = {
+	ADD_ROSPEC: ('ROSpec', 14), # ID in the ROSpec parameter
+	21: ('ROSpec', 10), # DELETE_ROSPEC
+	22: ('ROSpec', 10), # START_ROSPEC
+	23: ('ROSpec', 10), # STOP_ROSPEC
+	24: ('ROSpec', 10), # ENABLE_ROSPEC
+	25: ('ROSpec', 10), # DISABLE_ROSPEC
+	ADD_ACCESSSPEC: ('AccessSpec', 14), # ID in the AccessSpec parameter
+	41: ('AccessSpec', 10), # DELETE_ACCESSSPEC
+	42: ('AccessSpec', 10), # ENABLE_ACCESSSPEC
+	43: ('AccessSpec', 10), # DISABLE_ACCESSSPEC
+}
+ACCESSSPEC_ROSPEC = 24 # offset of the ROSpecID in ADD_ACCESSSPEC
+ALL_SPECS = {21, 24, 25, 41, 42, 43} # commands for which ID 0 means all specs
+DELETE_SPECS = {21, 41}
+FIRST_SPEC_ID = 1 << 16 # above the IDs of specs the reader may already have
+
+LATE_RESPONSES = 1000 # maximum number of commands whose response is overdue
+
+
+def _frameKey(name):
+	''':returns: (type, subtype) of a message name as returned by frameType'''
+	for key, msgname in Message_Type2Name.items():
+		if msgname == name:
+			return key if isinstance(key, tuple) else (key, 0)
+	raise ValueError('unknown message {}'.format(name))
+
+
+RESPONSES = {key if isinstance(key, tuple) else (key, 0)
+	for key, name in Message_Type2Name.items()
+	if name.endswith('_RESPONSE') or name == 'ERROR_MESSAGE'}
+
+
+def _message(msgtype, body=b'', msgid=0):
+	''':returns: encoded LLRP message'''
+	return struct.pack('!HII', (1 << 10) | msgtype, len(body) + 10, msgid) + body
+
+
+def connectionEvent():
+	''':returns: READER_EVENT_NOTIFICATION of a successful connection'''
+	timestamp = struct.pack('!HHQ', 128, 12, int(time.time() * 1e6)) # UTCTimestamp
+	event = struct.pack('!HHH', 256, 6, 0) # ConnectionAttemptEvent: Success
+	data = timestamp + event
+	return _message(63, struct.pack('!HH', 246, len(data) + 4) + data)
+
+
+def statusResponse(msgtype, msgid, code=0, description=''):
+	''':param msgtype: type of the response
+	:param code: StatusCode of the LLRPStatus, 0 for M_Success
+	:returns: encoded response with only a LLRPStatus'''
+	description = description.encode()
+	status = struct.pack('!HHHH', LLRP_STATUS, len(description) + 8, code, len(description))
+	return _message(msgtype, status + description, msgid)
+
+
+def _status(frame):
+	''':returns: StatusCode of a response, 0 when it has no LLRPStatus'''
+	if len(frame) < 16 or struct.unpack_from('!H', frame, 10)[0] & 0x3ff != LLRP_STATUS:
+		return 0
+	return struct.unpack_from('!H', frame, 14)[0]
+
+
+def _patchID(frame, offset, specID):
+	''':returns: frame with another ROSpecID or AccessSpecID at offset'''
+	return frame[:offset] + struct.pack('!I', specID) + frame[offset + 4:]
+
+
+class _Subscriber(object):
+	'''one local client of a LLRPProxy'''
+	def __init__(self, proxy, sock, name):
+		self.proxy = proxy
+		self.sock = sock
+		self.name = name
+		self.types = None # (type, subtype) of the forwarded messages, None for all
+		self.queue = deque()
+		self.cond = threading.Condition()
+		self.alive = True
+		self.flush = False # send the queued frames after closing
+		self.sent = 0 # number of forwarded frames
+		self.dropped = 0 # number of frames dropped because of a full queue
+		# kind of spec -> {ID of the subscriber: ID on the reader}, used by the command thread
+		self.specs = {'ROSpec': {}, 'AccessSpec': {}}
+		self.sender = threading.Thread(target=self._send, name='LLRPProxy send', daemon=True)
+		self.receiver = threading.Thread(target=self._receive, name='LLRPProxy receive', daemon=True)
+
+	def start(self):
+		self.sender.start()
+		self.receiver.start()
+
+	def offer(self, frame, key=None):
+		'''queues a frame for the subscriber
+		:param key: (type, subtype) of a frame which may be filtered and dropped,
+			None for responses which are always delivered'''
+		if key is not None and self.types is not None and key not in self.types:
+			return
+		with self.cond:
+			if key is not None and len(self.queue) >= self.proxy.queueSize:
+				self.dropped += 1
+				return
+			self.queue.append(frame)
+			self.cond.notify()
+
+	def close(self, flush=False):
+		''':param flush: disconnect after sending the queued frames'''
+		with self.cond:
+			if not self.alive:
+				return
+			if flush:
+				self.sock.settimeout(1.) # a stalled subscriber is still disconnected
+			self.alive = False
+			self.flush = flush
+			self.cond.notify()
+		if not flush:
+			self._disconnect()
+		self.proxy._removeSubscriber(self)
+
+	def _disconnect(self):
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+
+	def _send(self):
+		'''sender thread, a slow subscriber only delays itself'''
+		try:
+			while True:
+				with self.cond:
+					while self.alive and not self.queue:
+						self.cond.wait()
+					if not self.alive and not self.flush:
+						return
+					frames = list(self.queue)
+					self.queue.clear()
+					last = not self.alive
+				self.sock.sendall(b''.join(frames))
+				self.sent += len(frames)
+				if last:
+					break
+		except OSError:
+			pass
+		self.close()
+		self._disconnect()
+
+	def _receive(self):
+		'''receiver thread, forwards the commands of the subscriber'''
+		data = b''
+		try:
+			while self.alive:
+				chunk = self.sock.recv(65536)
+				if not chunk:
+					break
+				data += chunk
+				if data.startswith(HELLO[:len(data)]):
+					if b'\n' not in data:
+						continue
+					line, data = data.split(b'\n', 1)
+					self._hello(json.loads(line[len(HELLO):].decode()))
+				while len(data) >= LLRPMessage.hdr_len:
+					length = struct.unpack_from('!I', data, 2)[0]
+					if length < LLRPMessage.hdr_len:
+						raise ValueError('invalid message length {}'.format(length))
+					if len(data) < length:
+						break
+					frame, data = data[:length], data[length:]
+					self.proxy._command(self, frame)
+		except (OSError, ValueError) as err:
+			if self.alive:
+				logger.warning('Subscriber %s failed: %s', self.name, err)
+		self.close()
+
+	def _hello(self, options):
+		''':param options: dictionary with "types": list of message names'''
+		types = options.get('types')
+		if types is not None:
+			self.types = {_frameKey(name) for name in types}
+
+
+class LLRPProxy(object):
+	'''
+	Shares the connection of a LLRPClient with local clients on a Unix socket.
+
+	Subscribers speak LLRP. Messages from the reader (e.g. tag reports and
+	events) are forwarded to every subscriber, optionally filtered by
+	message type. Every subscriber has its own queue of at most queueSize
+	messages and sender thread: while the queue of a slow subscriber is
+	full, it misses new messages instead of delaying the others. Responses
+	are never dropped.
+
+	Commands of the subscribers are forwarded one at a time. The next
+	command is sent when the reader answered the previous one. Their message
+	IDs are replaced, so every response goes back to the subscriber that
+	sent the command, even when it arrives after commandTimeout. Responses
+	which answer no command are dropped. The proxy answers KEEPALIVE itself
+	and CLOSE_CONNECTION only closes the subscriber.
+
+	Every subscriber only sees its own ROSpecs and AccessSpecs: their IDs
+	are replaced by IDs of the proxy, ID 0 (all) only stands for the specs
+	of the subscriber and commands for the specs of others are rejected.
+	So LLRPClient.stopPolitely of one subscriber keeps the inventories of
+	the others running. The specs of a subscriber are deleted when it
+	disconnects. Reports, events and GET_ROSPECS_RESPONSE carry the IDs of
+	the proxy.
+
+		reader = R420('192.168.4.2')
+		with LLRPProxy(reader, '/tmp/reader.sock'):
+			...
+
+	Other processes connect through a UnixTransport:
+
+		client = LLRPClient('proxy', transport=UnixTransport('/tmp/reader.sock',
+			types=('RO_ACCESS_REPORT',)))
+		client.startConnection()
+		client.addMsgCallback('RO_ACCESS_REPORT', onReport)
+
+	The proxy reads the reader connection, the client must not be used
+	for inventories while it runs.
+	'''
+	def __init__(self, client, path, queueSize=1000, commandTimeout=10.):
+		''':param client: connected LLRPClient or Reader
+		:param path: path of the Unix socket
+		:param queueSize: maximum number of queued messages per subscriber
+		:param commandTimeout: seconds to wait for the response of a command
+			before sending the next one
+		'''
+		self.client = client
+		self.path = path
+		self.queueSize = queueSize
+		self.commandTimeout = commandTimeout
+		self.subscribers = []
+		self.lock = threading.Lock() # subscribers and pending commands
+		self.writeLock = threading.Lock() # reader connection
+		self.pending = {} # proxy message ID -> (subscriber, message ID, event, undo)
+		self.late = {} # proxy message ID -> (subscriber, message ID) of timed out commands
+		self.ids = itertools.count(1)
+		self.specIDs = itertools.count(FIRST_SPEC_ID)
+		self.commands = queue.SimpleQueue()
+		self.running = False
+		self.threads = []
+		self.count = 0 # number of subscribers so far
+
+	def start(self):
+		'''listens for subscribers and starts forwarding'''
+		if self.running:
+			return
+		if os.path.exists(self.path):
+			os.remove(self.path) # socket of a previous proxy
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(self.path)
+		self.server.listen()
+		self.running = True
+		self.threads = [threading.Thread(target=target, name=name, daemon=True)
+			for target, name in ((self._accept, 'LLRPProxy accept'),
+				(self._pump, 'LLRPProxy reader'), (self._forward, 'LLRPProxy commands'))]
+		for thread in self.threads:
+			thread.start()
+
+	def close(self):
+		'''disconnects all subscribers and stops forwarding.
+		The reader connection stays open.'''
+		if not self.running:
+			return
+		self.running = False
+		try:
+			self.server.shutdown(socket.SHUT_RDWR) # wakes up accept
+		except OSError:
+			pass
+		self.server.close()
+		self.commands.put(None)
+		with self.lock:
+			for entry in self.pending.values():
+				entry[2].set() # the command thread stops waiting
+		for subscriber in list(self.subscribers):
+			subscriber.close()
+		for thread in self.threads:
+			if thread is not threading.current_thread(): # closed by a failing thread
+				thread.join()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def stats(self):
+		''':returns: list of dictionaries with name, sent, dropped and queued
+			messages of every subscriber'''
+		with self.lock:
+			return [{'name': s.name, 'sent': s.sent, 'dropped': s.dropped, 'queued': len(s.queue)}
+				for s in self.subscribers]
+
+	def _removeSubscriber(self, subscriber):
+		with self.lock:
+			if subscriber in self.subscribers:
+				self.subscribers.remove(subscriber)
+		if self.running:
+			self.commands.put((subscriber, None)) # deletes its specs
+
+	def _accept(self):
+		'''accept thread'''
+		while self.running:
+			try:
+				sock, _ = self.server.accept()
+			except OSError:
+				return
+			self.count += 1
+			subscriber = _Subscriber(self, sock, 'subscriber {}'.format(self.count))
+			# LLRPClient.startConnection waits for the connection event
+			subscriber.offer(connectionEvent())
+			with self.lock:
+				self.subscribers.append(subscriber)
+			subscriber.start()
+			logger.info('%s connected', subscriber.name)
+
+	def _write(self, frame):
+		'''sends a frame to the reader'''
+		with self.writeLock:
+			self.client.transport.write(frame)
+			for recorder in self.client.recorders:
+				recorder.sent(frame)
+
+	def _command(self, subscriber, frame):
+		'''handles a frame of a subscriber'''
+		msgtype = frameType(frame)[0]
+		if msgtype == KEEPALIVE_ACK:
+			return # the proxy acknowledges keepalives itself
+		if msgtype == CLOSE_CONNECTION:
+			subscriber.offer(statusResponse(CLOSE_CONNECTION + 10, struct.unpack_from('!I', frame, 6)[0]))
+			subscriber.close(flush=True)
+			return
+		self.commands.put((subscriber, frame))
+
+	def _forward(self):
+		'''command thread, sends one command at a time'''
+		while True:
+			item = self.commands.get()
+			if item is None:
+				return
+			subscriber, frame = item
+			if frame is None: # disconnected, delete its specs
+				commands = self._cleanup(subscriber)
+				subscriber = None
+			elif not subscriber.alive:
+				continue
+			else:
+				try:
+					commands = self._translate(subscriber, frame)
+				except KeyError as err:
+					msgtype = frameType(frame)[0]
+					subscriber.offer(statusResponse(msgtype + 10, struct.unpack_from('!I', frame, 6)[0],
+						101, 'unknown {}'.format(err.args[0]))) # M_FieldError
+					continue
+				if not commands: # e.g. deleting all specs of a subscriber without specs
+					subscriber.offer(statusResponse(frameType(frame)[0] + 10, struct.unpack_from('!I', frame, 6)[0]))
+					continue
+			for index, (command, undo) in enumerate(commands):
+				# only the response to the last command goes back to the subscriber
+				target = subscriber if index == len(commands) - 1 else None
+				if not self._send(target, frame[6:10] if target is not None else None, command, undo):
+					if subscriber is not None:
+						subscriber.offer(statusResponse(ERROR_MESSAGE, struct.unpack_from('!I', frame, 6)[0],
+							401, 'reader connection failed')) # DeviceError
+						subscriber.close(flush=True)
+					self.close()
+					return
+
+	def _send(self, subscriber, originalID, frame, undo):
+		'''sends a command to the reader and waits for the response
+		:param subscriber: receiver of the response, None to drop it
+		:param originalID: message ID of the subscriber
+		:param undo: function called when the command failed, or None
+		:returns: False when the reader connection failed'''
+		msgid = next(self.ids) & 0xffffffff
+		done = threading.Event()
+		with self.lock:
+			self.pending[msgid] = (subscriber, originalID, done, undo)
+		try:
+			self._write(frame[:6] + struct.pack('!I', msgid) + frame[10:])
+		except OSError as err:
+			logger.error('Cannot send to the reader: %s', err)
+			with self.lock:
+				self.pending.pop(msgid, None)
+			return False
+		if not done.wait(self.commandTimeout):
+			logger.warning('No response to a command of %s',
+				subscriber.name if subscriber else 'the proxy')
+			with self.lock:
+				entry = self.pending.pop(msgid, None)
+				if entry is not None and subscriber is not None:
+					# a late response still goes to the subscriber
+					self.late[msgid] = (subscriber, originalID)
+					if len(self.late) > LATE_RESPONSES:
+						del self.late[next(iter(self.late))]
+		return True
+
+	def _translate(self, subscriber, frame):
+		'''replaces the ROSpecID or AccessSpecID of a command with IDs of the proxy
+		:returns: list of (command, undo function or None), one per spec for ID 0
+		:raises KeyError: with the ID of a spec the subscriber did not add'''
+		msgtype = frameType(frame)[0]
+		spec = SPEC_COMMANDS.get(msgtype)
+		if spec is None or len(frame) < spec[1] + 4:
+			return [(frame, None)]
+		kind, offset = spec
+		specs = subscriber.specs[kind]
+		specID = struct.unpack_from('!I', frame, offset)[0]
+		if msgtype in (ADD_ROSPEC, ADD_ACCESSSPEC):
+			undo = None
+			if specID not in specs: # else the reader rejects the duplicate
+				specs[specID] = next(self.specIDs)
+				undo = lambda: specs.pop(specID, None)
+			command = _patchID(frame, offset, specs[specID])
+			if msgtype == ADD_ACCESSSPEC and len(frame) >= ACCESSSPEC_ROSPEC + 4:
+				roSpecID = struct.unpack_from('!I', frame, ACCESSSPEC_ROSPEC)[0]
+				if roSpecID: # 0: all ROSpecs
+					roSpecs = subscriber.specs['ROSpec']
+					if roSpecID not in roSpecs:
+						if undo:
+							undo()
+						raise KeyError('ROSpecID {}'.format(roSpecID))
+					command = _patchID(command, ACCESSSPEC_ROSPEC, roSpecs[roSpecID])
+			return [(command, undo)]
+		if specID == 0 and msgtype in ALL_SPECS:
+			targets = list(specs)
+		elif specID in specs:
+			targets = [specID]
+		else:
+			raise KeyError('{}ID {}'.format(kind, specID))
+		commands = [(_patchID(frame, offset, specs[target]), None) for target in targets]
+		if msgtype in DELETE_SPECS:
+			for target in targets:
+				del specs[target]
+		return commands
+
+	def _cleanup(self, subscriber):
+		''':returns: commands deleting the specs of a subscriber'''
+		commands = []
+		for msgtype, kind in ((41, 'AccessSpec'), (21, 'ROSpec')): # DELETE_ACCESSSPEC, DELETE_ROSPEC
+			for specID in subscriber.specs[kind].values():
+				commands.append((_message(msgtype, struct.pack('!I', specID)), None))
+			subscriber.specs[kind].clear()
+		return commands
+
+	def _pump(self):
+		'''reader thread, frames the data of the reader and distributes it'''
+		client = self.client
+		data = b''
+		while self.running:
+			try:
+				chunk = client.transport.read(0.5)
+			except socket.timeout:
+				continue
+			except OSError as err:
+				logger.error('Reader connection failed: %s', err)
+				break
+			if not chunk:
+				logger.error('Reader closed the connection')
+				break
+			data += chunk
+			now = client.recorders[0].clock() if client.recorders else None
+			offset = 0
+			while len(data) - offset >= LLRPMessage.hdr_len:
+				length = struct.unpack_from('!I', data, offset + 2)[0]
+				if len(data) - offset < length:
+					break
+				frame = data[offset:offset + length]
+				offset += length
+				for recorder in client.recorders:
+					recorder.received(frame, now)
+				self._distribute(frame)
+			data = data[offset:]
+		self.close()
+
+	def _distribute(self, frame):
+		'''forwards a frame of the reader'''
+		key = frameType(frame)
+		if key[0] == KEEPALIVE:
+			self._write(_message(KEEPALIVE_ACK, msgid=struct.unpack_from('!I', frame, 6)[0]))
+			return
+		if key in RESPONSES:
+			msgid = struct.unpack_from('!I', frame, 6)[0]
+			with self.lock:
+				entry = self.pending.pop(msgid, None)
+				late = self.late.pop(msgid, None) if entry is None else None
+			if entry is not None:
+				subscriber, originalID, done, undo = entry
+				status = _status(frame)
+				if status and undo is not None:
+					undo()
+				if subscriber is not None:
+					subscriber.offer(frame[:6] + originalID + frame[10:])
+				elif status:
+					logger.warning('Reader rejected a command of the proxy with status %d', status)
+				done.set()
+			elif late is not None:
+				subscriber, originalID = late
+				subscriber.offer(frame[:6] + originalID + frame[10:])
+			else:
+				logger.warning('Dropping %s which answers no command', Message_Type2Name.get(
+					key if key[1] else key[0], key))
+			return
+		with self.lock:
+			subscribers = list(self.subscribers)
+		for subscriber in subscribers:
+			subscriber.offer(frame, key)
+
+
+class UnixTransport(Transport):
+	'''Transport of a LLRPClient to a LLRPProxy'''
+	def __init__(self, path, types=None):
+		''':param path: path of the proxy's Unix socket
+		:param types: names of the messages to receive from the reader,
+			e.g. ('RO_ACCESS_REPORT',). None receives all. Responses to
+			the client's own commands are always received.
+		'''
+		self.path = path
+		self.types = types
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.isConnected = False
+
+	def connect(self, ip=None, port=None):
+		'''connects to the proxy, ip and port are ignored'''
+		self.sock.connect(self.path)
+		if self.types is not None:
+			self.sock.sendall(HELLO + json.dumps({'types': list(self.types)}).encode() + b'\n')
+		self.isConnected = True
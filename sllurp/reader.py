@@ -1,21 +1,110 @@
-from .llrp import LLRPClient, LLRPMessage # low level reader protocoll
+from .llrp import LLRPClient, LLRPMessage, LLRPError # low level reader protocoll
+import logging
 import threading # for making live tag reports non-blocking
+import time
+from collections import deque
+from .tags import TagRead, TagBatch, tagEPC
 
 '''
 Classes for specific reader implementations
 '''
 
+logger = logging.getLogger(__name__)
+
+class InventoryStream(object):
+	'''
+	Iterates over the tags of a running inventory while the reports arrive.
+	
+	Reports are read on the thread which iterates, so nothing is buffered 
+	apart from the reports decoded from the last chunk of received data.
+	Use it as a context manager to make sure the inventory is stopped:
+	
+		with reader.inventory(powerDBm=20) as stream:
+			for tag in stream:
+				...
+	'''
+	def __init__(self, reader, batches=False, rounds=None, columnar=False):
+		''':param reader: connected Reader with applied inventory settings
+		:param batches: yield the filtered tag list of every tag report 
+			(even if empty) instead of single tags
+		:param rounds: stop after that many tag reports. None runs until stopped
+		:param columnar: yield every tag report as TagBatch. 
+			All batches of the stream share their EPC indices
+		'''
+		self.reader = reader
+		self.batches = batches or columnar
+		self.columnar = TagBatch() if columnar else None
+		self.rounds = rounds
+		self.round = 0
+		self.pending = deque()
+		self.running = False
+	
+	def start(self):
+		'''adds and enables the ROSpec of the inventory'''
+		if self.running:
+			return
+		self.pending.clear()
+		self.round = 0
+		self.reader.addMsgCallback('RO_ACCESS_REPORT', self._report)
+		try:
+			self.reader.startInventory()
+		except:
+			self.reader.removeMsgCallback('RO_ACCESS_REPORT', self._report)
+			raise
+		self.running = True
+	
+	def stop(self):
+		'''stops the inventory and deletes its ROSpec'''
+		if not self.running:
+			return
+		self.running = False
+		self.reader.removeMsgCallback('RO_ACCESS_REPORT', self._report)
+		self.reader.stopPolitely()
+	
+	def _report(self, msgdict):
+		tags = self.reader.reportedTags(msgdict)
+		if self.columnar is not None:
+			tags = TagBatch.fromTags(tags, shared=self.columnar)
+		self.pending.append(tags)
+	
+	def __enter__(self):
+		self.start()
+		return self
+	
+	def __exit__(self, *exc):
+		self.stop()
+	
+	def __iter__(self):
+		while self.running:
+			if not self.pending:
+				self.reader.readLLRPMessage('RO_ACCESS_REPORT')
+			while self.pending:
+				tags = self.pending.popleft()
+				self.round += 1
+				if self.batches:
+					yield tags
+				else:
+					for tag in tags:
+						yield tag
+				if self.rounds and self.round >= self.rounds:
+					self.stop()
+					return
+
+
 class Reader(LLRPClient):
-	def __init__(self, ip='192.168.5.2', includeEPCs=[], excludeEPCs=[], *args, **kwargs):
+	def __init__(self, ip='192.168.5.2', includeEPCs=[], excludeEPCs=[], *args, compact=False, **kwargs):
 		''':param ip: IP address of the reader
 		:param includeEPCs: string or list of strings containing EPCs to look for during inventory.
 			Other tags will not be reported when used.
 		:param excludeEPCs: string or list of strings containing EPCs to ignore during inventory.
 			Tags with these EPCs will not be reported when used.
+		:param compact: report tags as TagRead objects instead of dictionaries.
+			Saves memory when many tag reads are kept.
 		'''
 		# epc filters
 		self.includeEPCs = includeEPCs
 		self.excludeEPCs = excludeEPCs
+		self.compact = compact
 		
 		# init common llrp stuff
 		LLRPClient.__init__(self, ip, *args, **kwargs)
@@ -74,6 +163,29 @@ class Reader(LLRPClient):
 		:returns: table index'''
 		return self.nearestIndex(self.freq_table, freqMHz)+1
 	
+	def _applySettings(self, powerDBm, freqMHz, mode, session, population, antennas, tagObservation=None):
+		'''updates the inventory settings used for the next ROSpec'''
+		self.power = self.getPowerIndex(powerDBm)
+		self.channel = self.getChannelIndex(freqMHz)
+		self.mode_identifier = mode
+		self.session = session
+		self.population = population
+		self.antennas = antennas
+		self.tag_observation = tagObservation
+	
+	def getTagObservation(self, stop_after_unique=None, stop_on_silence_ms=None):
+		'''creates the TagObservationTrigger settings for an early inventory stop
+		:param stop_after_unique: stop when that many unique tags were seen
+		:param stop_on_silence_ms: stop when no tag was seen for that many milliseconds
+		:returns: dictionary for LLRPROSpec or None'''
+		if stop_after_unique and stop_on_silence_ms:
+			raise LLRPError('stop_after_unique and stop_on_silence_ms cannot be combined')
+		if stop_after_unique:
+			return {'TriggerType': 'UponNUniqueTags', 'NumberOfTags': stop_after_unique}
+		if stop_on_silence_ms:
+			return {'TriggerType': 'UponSilenceMs', 'T': stop_on_silence_ms}
+		return None
+	
 	def filterTags(self, trp):
 		'''Filters tags based on the EPC filters specified on construction
 		:param trp: tagreport
@@ -88,10 +200,21 @@ class Reader(LLRPClient):
 			# nothing to filter
 			return trp
 	
-	def detectTags(self, powerDBm, freqMHz, mode, duration=0.5, session=2, population=1, antennas=(0,), rounds=1):
+	def reportedTags(self, msgdict):
+		'''Gets the filtered tags of a tag report
+		:param msgdict: RO_ACCESS_REPORT message dictionary
+		:returns: list of tags, as TagRead objects in compact mode'''
+		tags = msgdict['TagReportData'] or []
+		if self.compact:
+			tags = [TagRead.fromDict(tag) for tag in tags]
+		return self.filterTags(tags)
+	
+	def detectTags(self, powerDBm, freqMHz, mode, duration=0.5, session=2, population=1, antennas=(0,), rounds=1, 
+			stop_after_unique=None, stop_on_silence_ms=None):
 		'''starts the readers inventoring process and return the found tags.
 		
-		:param duration: gives the reader that much time in seconds to find tags
+		:param duration: gives the reader that much time in seconds to find tags.
+			When stopping early, this is the maximum duration
 		:param powerDBm: tx power in dBm
 		:param freqMHz: frequency band in MHz
 		:param mode: preset mode identifier which defines tari, miller, etc.
@@ -100,17 +223,15 @@ class Reader(LLRPClient):
 		:antennas: tuple of antenna ports to use for inventory.
 			Set to (0,) to scan automatically over all
 		:param rounds: number of tag reports until stopping inventoring
+		:param stop_after_unique: end the inventory as soon as that many unique tags were seen
+		:param stop_on_silence_ms: end the inventory when no tag was seen for that many milliseconds
 		:returns: list of detected tags with their meta informations
 		'''
 		# update settings
 		self.report_interval = duration
 		self.report_every_n_tags = None
-		self.power = self.getPowerIndex(powerDBm)
-		self.channel = self.getChannelIndex(freqMHz)
-		self.mode_identifier = mode
-		self.session = session
-		self.population = population
-		self.antennas = antennas
+		self._applySettings(powerDBm, freqMHz, mode, session, population, antennas, 
+			self.getTagObservation(stop_after_unique, stop_on_silence_ms))
 		
 		# prepare inventory
 		self.round = 0
@@ -137,13 +258,104 @@ class Reader(LLRPClient):
 	
 	def foundTags(self, msgdict):
 		'''report about found tags'''
-		tags = msgdict['TagReportData'] or []
-		tags = self.filterTags(tags) # filter tags
+		tags = self.reportedTags(msgdict)
 		self.detectedTags.append(tags) # save tag list
 		print('{} unique tags detected'.format(len(self.uniqueTags(tags))))
 		self.round += 1
 	
-	def startLiveReports(self, reportCallback, powerDBm, freqMHz, mode, tagInterval=10, timeInterval=1., session=2, population=1, antennas=(0,)):
+	def sweep(self, powersDBm=None, freqsMHz=None, modes=None, antennaSets=((0,),), 
+			duration=0.1, session=2, population=1, batchSize=None):
+		'''runs one inventory for every combination of power, frequency, mode 
+		and antenna set and yields the results step by step.
+		
+		All ROSpecs of a batch are added and enabled back to back before the 
+		first one starts, so the setup round trips are paid once per batch 
+		instead of once per step. The ROSpecs of a batch get distinct IDs and 
+		priorities in step order, as far as the reader has priority levels. 
+		Each ROSpec is then started with START_ROSPEC and runs for "duration" 
+		seconds. A step without a report ends after "duration" plus a second. 
+		The installed ROSpecs are deleted when the sweep ends or fails.
+		
+		:param powersDBm: list of tx powers in dBm. Defaults to max power
+		:param freqsMHz: list of frequencies in MHz. Defaults to first channel
+		:param modes: list of preset mode identifiers. Defaults to current mode
+		:param antennaSets: list of antenna tuples, e.g. ((1,), (2,), (0,))
+		:param duration: inventory duration of each step in seconds
+		:param batchSize: number of ROSpecs installed at once.
+			Defaults to the maximum number of ROSpecs the reader supports
+		:returns: generator of dictionaries with the step settings 
+			and the "tags" detected in that step
+		'''
+		powersDBm = powersDBm or [self.power_table[-1]]
+		freqsMHz = freqsMHz or [self.freq_table[0]]
+		modes = modes or [self.reader_mode['ModeIdentifier']]
+		steps = [
+			{'powerDBm': p, 'freqMHz': f, 'mode': m, 'antennas': a}
+			for p in powersDBm for f in freqsMHz for m in modes for a in antennaSets
+		]
+		batchSize = batchSize or self.maxROSpecs()
+		maxPriority = self.maxPriority()
+		
+		self.report_interval = duration
+		self.report_every_n_tags = None
+		
+		reports = []
+		installed = False # ROSpecs of a batch are on the reader
+		self.addMsgCallback('RO_ACCESS_REPORT', reports.append)
+		try:
+			for iBatch in range(0, len(steps), batchSize):
+				batch = steps[iBatch:iBatch+batchSize]
+				# pre-build all ROSpecs of the batch
+				rospecs = []
+				for iStep, step in enumerate(batch):
+					self._applySettings(step['powerDBm'], step['freqMHz'], step['mode'], 
+						session, population, step['antennas'])
+					rospecs.append(self.getInventoryROSpec(rospecID=iStep+1, 
+						priority=min(iStep, maxPriority), start_trigger='Null'))
+				# install them with pipelined requests
+				installed = True
+				for rospec in rospecs:
+					self.send_ADD_ROSPEC(rospec)
+				self.readLLRPMessages('ADD_ROSPEC_RESPONSE', len(rospecs))
+				for rospec in rospecs:
+					self.send_ENABLE_ROSPEC(rospec['ROSpec']['ROSpecID'])
+				self.readLLRPMessages('ENABLE_ROSPEC_RESPONSE', len(rospecs))
+				
+				# run them back to back
+				for iStep, rospec in enumerate(rospecs):
+					del reports[:]
+					self.send_START_ROSPEC(rospec['ROSpec']['ROSpecID'])
+					# some readers do not report when no tags were found
+					deadline = time.monotonic() + duration + 1.
+					try:
+						while not reports:
+							remaining = deadline - time.monotonic()
+							if remaining <= 0:
+								break
+							self.readLLRPMessage(timeout=remaining)
+					except TimeoutError:
+						pass
+					tags = []
+					for report in reports:
+						tags.extend(self.reportedTags(report))
+					
+					step = dict(batch[iStep], step=iBatch+iStep, tags=tags)
+					yield step
+				
+				# remove the batch
+				self.send_DELETE_ROSPEC()
+				self.readLLRPMessage('DELETE_ROSPEC_RESPONSE')
+				installed = False
+		finally:
+			self.removeMsgCallback('RO_ACCESS_REPORT', reports.append)
+			if installed:
+				# sweep aborted or failed, remove the remaining ROSpecs
+				try:
+					self.stopPolitely()
+				except Exception as err:
+					logger.warning('Cannot delete the ROSpecs of the sweep: %s', err)
+	
+	def startLiveReports(self, reportCallback, powerDBm, freqMHz, mode, tagInterval=10, timeInterval=1., session=2, population=1, antennas=(0,), columnar=False):
 		'''starts the readers inventoring process and 
 		reports tagreports periodically through a callback function.
 		
@@ -151,6 +363,7 @@ class Reader(LLRPClient):
 		:param tagInterval: when not None, report for every n tags found
 		:param timeInterval: when tagInterval not None, report timeout in seconds.
 			When tagInterval None, report interval in seconds
+		:param columnar: pass every tagreport as TagBatch instead of a list
 		
 		The other parameters are the same as in "detectTags"
 		'''
@@ -161,20 +374,14 @@ class Reader(LLRPClient):
 		else:
 			self.report_every_n_tags = None
 		
-		self.power = self.getPowerIndex(powerDBm)
-		self.channel = self.getChannelIndex(freqMHz)
-		self.mode_identifier = mode
-		self.session = session
-		self.population = population
-		self.antennas = antennas
+		self._applySettings(powerDBm, freqMHz, mode, session, population, antennas)
 		
 		# we want to get informed when tags are reported
 		self._liveReport = reportCallback
-		self.addMsgCallback('RO_ACCESS_REPORT', self._foundTagsLive)
 		
 		# continue non-blocking
 		self._liveStop.clear()
-		self._liveThread = threading.Thread(target=self._liveInventory, args=(self._liveStop,))
+		self._liveThread = threading.Thread(target=self._liveInventory, args=(self._liveStop, columnar))
 		self._liveThread.start()
 	
 	def stopLiveReports(self):
@@ -187,30 +394,49 @@ class Reader(LLRPClient):
 				raise RuntimeWarning('Could not stop live inventory')
 
 	
-	def _liveInventory(self, stopper):
+	def _liveInventory(self, stopper, columnar=False):
 		'''non-blocking inventory'''
-		# start inventory
-		self.startInventory()
+		# read all tag reports until user stops
+		with InventoryStream(self, batches=True, columnar=columnar) as stream:
+			for tags in stream:
+				self._liveReport(tags)
+				if stopper.is_set():
+					break
+	
+	def inventory(self, powerDBm, freqMHz, mode, tagInterval=10, timeInterval=1., session=2, population=1, antennas=(0,), batches=False, rounds=None, columnar=False):
+		'''prepares an inventory whose tags can be iterated while they are reported.
 		
-		# read all tag report messages until user stops
-		while not stopper.is_set():
-			self.readLLRPMessage('RO_ACCESS_REPORT')
+		:param batches: yield the tag list of every tag report instead of single tags
+		:param rounds: stop after that many tag reports. None runs until the stream is stopped
+		:param columnar: yield every tag report as TagBatch
+		:returns: InventoryStream, which starts the inventory when entered as context manager
 		
-		# don't need more reports
-		self.removeMsgCallback('RO_ACCESS_REPORT', self._foundTagsLive)
-		# stop inventoring
-		self.stopPolitely()
+		The other parameters are the same as in "startLiveReports"
+		'''
+		# update settings
+		self.report_interval = timeInterval # in case tags don't respond
+		if tagInterval:
+			self.report_every_n_tags = tagInterval # report every n tags
+		else:
+			self.report_every_n_tags = None
+		
+		self._applySettings(powerDBm, freqMHz, mode, session, population, antennas)
+		return InventoryStream(self, batches=batches, rounds=rounds, columnar=columnar)
 	
-	def _foundTagsLive(self, msgdict):
-		tags = msgdict['TagReportData'] or []
-		tags = self.filterTags(tags) # filter tags
-		self._liveReport(tags)
+	def iterTags(self, *args, **kwargs):
+		'''runs an inventory and yields the tags as they are reported.
+		The inventory stops when the generator is closed.
+		
+		The parameters are the same as in "inventory"
+		'''
+		with self.inventory(*args, **kwargs) as stream:
+			for tag in stream:
+				yield tag
 	
 	def getEPC(self, tag):
-		''':param tag: single tag dictionary of a tagreport
+		''':param tag: single tag dictionary or TagRead of a tagreport
 		:returns: EPC string'''
-		epc = tag['EPC-96'] if 'EPC-96' in tag else tag['EPCData']['EPC']
-		return epc.decode()
+		return tagEPC(tag).decode()
 	
 	def uniqueTags(self, tags):
 		'''gets unique tags of a tagreport
@@ -243,12 +469,7 @@ class ARU2400(Reader):
 		# update settings
 		self.report_interval = duration
 		self.report_every_n_tags = 10 # report every n tags
-		self.power = self.getPowerIndex(powerDBm)
-		self.channel = self.getChannelIndex(freqMHz)
-		self.mode_identifier = mode
-		self.session = session
-		self.population = population
-		self.antennas = antennas
+		self._applySettings(powerDBm, freqMHz, mode, session, population, antennas)
 		
 		# prepare inventory
 		self.round = 0
@@ -278,8 +499,7 @@ class ARU2400(Reader):
 		
 	def foundTags(self, msgdict):
 		'''report about found tags'''
-		tags = msgdict['TagReportData'] or []
-		tags = self.filterTags(tags) # filter tags
+		tags = self.reportedTags(msgdict)
 		# faking duration-based inventory (like R420) by updating existing tagreports if necessary
 		for newTag in tags:
 			newEPC = self.getEPC(newTag)
@@ -346,6 +566,14 @@ class R420(Reader):
 	def startLiveReports(self, reportCallback, powerDBm=31.5, freqMHz=866.9, mode=1002, searchmode=0, **kwargs):
 		self.impinj_searchmode = searchmode # update searchmode
 		return super().startLiveReports(reportCallback, powerDBm=powerDBm, freqMHz=freqMHz, mode=mode,**kwargs)
+	
+	def sweep(self, searchmode=0, **kwargs):
+		self.impinj_searchmode = searchmode # update searchmode
+		return super().sweep(**kwargs)
+	
+	def inventory(self, powerDBm=31.5, freqMHz=866.9, mode=1002, searchmode=0, **kwargs):
+		self.impinj_searchmode = searchmode # update searchmode
+		return super().inventory(powerDBm=powerDBm, freqMHz=freqMHz, mode=mode, **kwargs)
 
 R420_EU = Reader # for backward compatibility
 
@@ -378,3 +606,6 @@ class FX9600(Reader):
 	
 	def startLiveReports(self, reportCallback, powerDBm=29.2, freqMHz=866.3, mode=21, session=0, **kwargs):
 		return super().startLiveReports(reportCallback, powerDBm=powerDBm, freqMHz=freqMHz, mode=mode, session=session, **kwargs)
+	
+	def inventory(self, powerDBm=29.2, freqMHz=866.3, mode=21, session=0, **kwargs):
+		return super().inventory(powerDBm=powerDBm, freqMHz=freqMHz, mode=mode, session=session, **kwargs)
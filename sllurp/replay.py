@@ -0,0 +1,187 @@
+'''
+Replaying capture files through the LLRP client, e.g. for benchmarking decoders
+'''
+from collections import namedtuple
+import time
+
+from .capture import readRecords, RECEIVED
+from .llrp import LLRPClient
+
+ReplayStats = namedtuple('ReplayStats', ('frames', 'reports', 'tags', 'bytes', 'seconds',
+	'framesPerSecond', 'tagsPerSecond', 'latencyMean', 'latencyP50', 'latencyP99', 'latencyMax'))
+
+
+class ReplayTransport(object):
+	'''
+	Transport which returns the received frames of a capture file
+	instead of reading from a socket. Sent messages are dropped.
+
+	Frames recorded with the same receive time arrived in one chunk and
+	are returned together. Without speed the frames are returned as fast
+	as possible, otherwise with their recorded timing.
+	'''
+	def __init__(self, path, speed=None):
+		''':param path: capture file of capture.FrameRecorder
+		:param speed: 1. replays in real time, 2. twice as fast.
+			None replays as fast as possible
+		'''
+		self.path = path
+		self.speed = speed
+		self.isConnected = False
+		self.arrival = None # perf_counter time the last chunk arrived
+		self.sent = 0 # number of dropped messages
+
+	def connect(self, ip=None, port=None):
+		self.file = open(self.path, 'rb')
+		self.records = readRecords(self.file)
+		self.pending = None # first record of the next chunk
+		self.start = None # (capture time, perf_counter time) of the first chunk
+		self.isConnected = True
+
+	def write(self, msg):
+		self.sent += 1
+
+	def _next(self):
+		''':returns: next received record or None at the end'''
+		if self.pending is not None:
+			record, self.pending = self.pending, None
+			return record
+		for record in self.records:
+			if record[1] == RECEIVED:
+				return record
+		return None
+
+	def read(self, timeout=None):
+		''':returns: the frames of the next chunk
+		:raises EOFError: at the end of the capture'''
+		record = self._next()
+		if record is None:
+			raise EOFError('end of capture {}'.format(self.path))
+		t = record[0]
+		frames = [record[2]]
+		while True:
+			record = self._next()
+			if record is None:
+				break
+			if record[0] != t:
+				self.pending = record
+				break
+			frames.append(record[2])
+
+		now = time.perf_counter()
+		if self.start is None:
+			self.start = (t, now)
+		if self.speed:
+			due = self.start[1] + (t - self.start[0]) / self.speed
+			if due > now:
+				time.sleep(due - now)
+			# count the time a slow decoder let the chunk wait
+			self.arrival = due
+		else:
+			self.arrival = now
+		return b''.join(frames)
+
+	def disconnect(self):
+		if self.isConnected:
+			self.file.close()
+			self.isConnected = False
+
+
+class CaptureReplay(object):
+	'''
+	Feeds a capture file through a LLRPClient and measures the decoding:
+	framing, LLRPMessage decoding, handleMessage and the message callbacks.
+	With a Reader, the tags of every report also go through reportedTags
+	(TagRead conversion and EPC filters).
+
+		stats = CaptureReplay('shift.llrp').run()
+		print(stats.tagsPerSecond, stats.latencyP99)
+
+	A capture including the connection can also be replayed into a
+	Reader, which then connects to the capture:
+
+		reader = R420('replay', transport=ReplayTransport('shift.llrp'), compact=True)
+		stats = CaptureReplay(client=reader).run()
+	'''
+	def __init__(self, path=None, client=None, speed=None):
+		''':param path: capture file, not needed with a client on a ReplayTransport
+		:param client: LLRPClient or Reader, by default a LLRPClient
+			which is not connected to a reader
+		:param speed: replay speed, see ReplayTransport. None is as fast as possible
+		'''
+		if client is None:
+			transport = ReplayTransport(path, speed)
+			client = LLRPClient('replay', transport=transport)
+			transport.connect()
+		self.client = client
+		self.transport = client.transport
+		self.latencies = []
+		self.reports = 0
+		self.tags = 0
+
+	def _report(self, msgdict):
+		if hasattr(self.client, 'reportedTags'):
+			tags = self.client.reportedTags(msgdict)
+		else:
+			tags = msgdict['TagReportData'] or []
+		self.reports += 1
+		self.tags += len(tags)
+
+	def _received(self, data):
+		self.bytes += len(data)
+		self.client.rawDataReceived(data)
+		self.latencies.append(time.perf_counter() - self.transport.arrival)
+
+	def run(self, maxChunks=None):
+		'''replays the capture until its end
+		:param maxChunks: stop after that many received chunks
+		:returns: ReplayStats with latencies in seconds from the arrival
+			of a chunk until its messages were handled'''
+		client = self.client
+		client.addMsgCallback('RO_ACCESS_REPORT', self._report)
+		self.latencies = []
+		self.reports = self.tags = self.bytes = 0
+		frames = 0
+		start = time.perf_counter()
+		try:
+			while maxChunks is None or len(self.latencies) < maxChunks:
+				data = self.transport.read()
+				frames += _countFrames(data)
+				self._received(data)
+		except EOFError:
+			pass
+		finally:
+			client.removeMsgCallback('RO_ACCESS_REPORT', self._report)
+		seconds = time.perf_counter() - start
+		return self._stats(frames, seconds)
+
+	def _stats(self, frames, seconds):
+		latencies = sorted(self.latencies)
+		n = len(latencies)
+		def percentile(p):
+			return latencies[min(int(p * n), n - 1)] if n else 0.
+		return ReplayStats(
+			frames=frames,
+			reports=self.reports,
+			tags=self.tags,
+			bytes=self.bytes,
+			seconds=seconds,
+			framesPerSecond=frames / seconds if seconds else 0.,
+			tagsPerSecond=self.tags / seconds if seconds else 0.,
+			latencyMean=sum(latencies) / n if n else 0.,
+			latencyP50=percentile(0.5),
+			latencyP99=percentile(0.99),
+			latencyMax=latencies[-1] if n else 0.,
+		)
+
+
+def _countFrames(data):
+	'''counts the LLRP messages in a chunk'''
+	count = offset = 0
+	while offset + 6 <= len(data):
+		length = int.from_bytes(data[offset+2:offset+6], 'big')
+		if length < 10:
+			break
+		offset += length
+		count += 1
+	return count
@@ -0,0 +1,104 @@
+'''
+Scheduling of antenna dwell times from recent tag activity
+'''
+from .tags import TagRead, TagBatch
+
+
+class AntennaScheduler(object):
+	'''
+	Splits an inventory cycle between the antennas by their recent read rate.
+
+	The read rate of an antenna is counted per second of its dwell time and
+	smoothed over the last cycles, so a short dwell does not make an antenna
+	look quiet. Every antenna keeps minDwell to notice new tags, the rest of
+	the cycle is shared in proportion to the read rates. Busy antennas run
+	first. The ROSpec holds one AISpec per antenna (see LLRPROSpec
+	antenna_dwell) and is only reinstalled when the schedule changed by
+	more than minChange:
+
+		scheduler = AntennaScheduler(range(1, 9), cycle=1.)
+		for tags in scheduler.inventory(reader, powerDBm=25):
+			...
+	'''
+	def __init__(self, antennas, cycle=1., minDwell=0.02, alpha=0.5, minChange=0.2):
+		''':param antennas: antenna ports to schedule (>0)
+		:param cycle: duration of one pass over all antennas in seconds
+		:param minDwell: minimum dwell time of every antenna in seconds
+		:param alpha: weight of the last cycle in the read rates
+		:param minChange: minimum relative dwell change to reinstall the ROSpec
+		'''
+		self.antennas = tuple(antennas)
+		if not self.antennas or min(self.antennas) <= 0:
+			raise ValueError('antennas must be ports > 0')
+		self.cycle = cycle
+		self.minDwell = minDwell
+		self.alpha = alpha
+		self.minChange = minChange
+		self.rates = dict.fromkeys(self.antennas) # reads per second of dwell
+		self.installed = None # schedule of the running ROSpec
+
+	def schedule(self):
+		''':returns: list of (antenna, dwell in seconds), busiest antenna first'''
+		n = len(self.antennas)
+		spare = self.cycle - n * self.minDwell
+		rates = {ant: rate or 0. for ant, rate in self.rates.items()}
+		total = sum(rates.values())
+		if spare <= 0 or not total:
+			dwell = {ant: self.cycle / n for ant in self.antennas}
+		else:
+			dwell = {ant: self.minDwell + spare * rates[ant] / total for ant in self.antennas}
+		return sorted(dwell.items(), key=lambda item: (-item[1], item[0]))
+
+	def update(self, tags, schedule=None):
+		'''adds the reads of one cycle
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param schedule: schedule the reads were made with, defaults to the installed one'''
+		schedule = schedule or self.installed or self.schedule()
+		reads = dict.fromkeys(self.rates, 0)
+		if isinstance(tags, TagBatch):
+			tags = iter(tags)
+		for tag in tags:
+			if isinstance(tag, TagRead):
+				ant, count = tag.antenna, tag.seen_count or 1
+			else:
+				ant, count = tag.get('AntennaID'), tag.get('TagSeenCount', 1)
+			if ant in reads:
+				reads[ant] += count
+		for ant, dwell in schedule:
+			rate = reads[ant] / dwell
+			old = self.rates[ant]
+			self.rates[ant] = rate if old is None else old + self.alpha * (rate - old)
+
+	def changed(self):
+		''':returns: True when the schedule differs enough from the installed one'''
+		if self.installed is None:
+			return True
+		# the order alone follows the dwell times and is no reason to reinstall
+		installed = dict(self.installed)
+		return any(abs(dwell - installed[ant]) > self.minChange * installed[ant]
+			for ant, dwell in self.schedule())
+
+	def inventory(self, reader, rounds=None, **kwargs):
+		'''yields the tag list of every cycle like Reader.inventory(batches=True)
+		:param reader: connected Reader
+		:param rounds: stop after that many cycles. None runs until the generator is closed
+		The other parameters are the same as in "inventory"'''
+		kwargs.update(batches=True, tagInterval=None, timeInterval=self.cycle)
+		kwargs.pop('rounds', None)
+		done = 0
+		try:
+			while rounds is None or done < rounds:
+				self.installed = self.schedule()
+				kwargs['antennas'] = tuple(ant for ant, _ in self.installed)
+				stream = reader.inventory(**kwargs)
+				reader.antenna_dwell = self.installed
+				with stream:
+					for tags in stream:
+						self.update(tags)
+						done += 1
+						yield tags
+						if (rounds is not None and done >= rounds) or self.changed():
+							break
+		finally:
+			reader.antenna_dwell = None
+			self.installed = None
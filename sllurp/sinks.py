@@ -0,0 +1,370 @@
+'''
+Sinks which store tag reads in the background
+'''
+from collections import deque
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from .tags import TagRead, TagBatch
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+try:
+	import pyarrow as pa # optional, for Arrow IPC and Parquet
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = pq = None
+
+
+class ColumnarSink(object):
+	'''
+	Buffers tag reads in column chunks and writes every chunk in a
+	background thread, so the thread receiving the reports never waits
+	for the disk. The format follows the file extension:
+
+	- .npz: one compressed NumPy file per chunk (name-000000.npz, ...)
+	  with the arrays "epcs" (the EPCs of the chunk) and "epc" (index into
+	  epcs per row), plus one array per TagBatch column (needs numpy)
+	- .arrow or .feather: Arrow IPC file with one record batch per chunk
+	- .parquet: Parquet file with one row group per chunk
+
+	Arrow and Parquet need pyarrow. Every chunk is compressed on its own,
+	so single chunks can be read without the rest of the file. The
+	compression defaults to the format's default (npz: zlib, Arrow: none,
+	Parquet: snappy). The sink can be used as callback:
+
+		with ColumnarSink('reads.parquet') as sink:
+			reader.startLiveReports(sink.update)
+			...
+			reader.stopLiveReports()
+	'''
+	formats = {'.npz': 'npz', '.arrow': 'arrow', '.feather': 'arrow', '.parquet': 'parquet'}
+
+	def __init__(self, path, chunkRows=65536, interval=10., format=None, compression=None):
+		''':param path: output file, for .npz the name of the chunk files
+		:param chunkRows: write a chunk when it has that many rows
+		:param interval: write a chunk at least every that many seconds
+		:param format: "npz", "arrow" or "parquet", defaults to the file extension
+		:param compression: npz: "zlib" or "none", Arrow: "lz4" or "zstd",
+			Parquet: "snappy", "gzip", "zstd", "lz4", "brotli" or "none"
+		'''
+		base, ext = os.path.splitext(path)
+		self.format = format or self.formats.get(ext.lower())
+		if self.format not in self.formats.values():
+			raise ValueError('unknown format of {}'.format(path))
+		if self.format == 'npz' and np is None:
+			raise ImportError('npz output needs numpy')
+		if self.format != 'npz' and pa is None:
+			raise ImportError('{} output needs pyarrow'.format(self.format))
+		if self.format == 'npz' and compression not in (None, 'zlib', 'none'):
+			raise ValueError('npz output supports zlib compression only')
+		self.compression = compression
+		self.path = path
+		self.base = base
+		self.chunkRows = chunkRows
+		self.interval = interval
+		self.chunk = TagBatch()
+		self.chunkStart = time.monotonic()
+		self.chunks = 0 # number of written chunks
+		self.rows = 0 # number of written rows
+		self.writer = None # Arrow or Parquet writer
+		self.error = None # exception which stopped the writer
+		self.lock = threading.Lock()
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self._write, name='ColumnarSink', daemon=True)
+		self.thread.start()
+
+	def update(self, tags):
+		'''adds the reads of a tag report
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:raises: the exception which stopped the writer thread'''
+		if self.error:
+			raise self.error
+		with self.lock:
+			if isinstance(tags, TagBatch):
+				self.chunk.extend(tags)
+			else:
+				self.chunk.extendTags(tags)
+			if len(self.chunk) >= self.chunkRows or \
+					time.monotonic() - self.chunkStart >= self.interval:
+				self._rotate()
+
+	def _rotate(self):
+		'''hands the current chunk over to the writer thread, needs the lock'''
+		if len(self.chunk):
+			self.queue.put(self.chunk)
+			self.chunk = TagBatch()
+		self.chunkStart = time.monotonic()
+
+	def flush(self):
+		'''writes the buffered reads with the next chunk'''
+		with self.lock:
+			self._rotate()
+
+	def close(self):
+		'''writes all buffered reads and closes the output'''
+		if self.thread is None:
+			return
+		self.flush()
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+		if self.error:
+			raise self.error
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _write(self):
+		'''writer thread'''
+		try:
+			while True:
+				try:
+					chunk = self.queue.get(timeout=self.interval)
+				except queue.Empty:
+					with self.lock:
+						if time.monotonic() - self.chunkStart >= self.interval:
+							self._rotate()
+					continue
+				if chunk is None:
+					break
+				getattr(self, '_write_' + self.format)(chunk)
+				self.chunks += 1
+				self.rows += len(chunk)
+			if self.writer is not None:
+				self.writer.close()
+		except Exception as err:
+			self.error = err
+			if self.writer is not None:
+				try:
+					self.writer.close()
+				except Exception:
+					pass
+
+	def _write_npz(self, chunk):
+		columns = chunk.toNumpy()
+		save = np.savez if self.compression == 'none' else np.savez_compressed
+		save('{}-{:06d}.npz'.format(self.base, self.chunks),
+			epcs=np.array(chunk.epcs, dtype=bytes), **columns)
+
+	def _table(self, chunk):
+		columns = {name: pa.array(values) for name, values in chunk.toNumpy().items()}
+		columns['epc'] = pa.array(chunk.epcColumn(), type=pa.binary())
+		return pa.table(columns)
+
+	def _write_arrow(self, chunk):
+		table = self._table(chunk)
+		if self.writer is None:
+			options = pa.ipc.IpcWriteOptions(compression=self.compression) \
+				if self.compression not in (None, 'none') else None
+			self.writer = pa.ipc.new_file(self.path, table.schema, options=options)
+		self.writer.write_table(table)
+
+	def _write_parquet(self, chunk):
+		table = self._table(chunk)
+		if self.writer is None:
+			self.writer = pq.ParquetWriter(self.path, table.schema, 
+				compression=self.compression or 'snappy')
+		self.writer.write_table(table)
+
+
+class SQLiteSink(object):
+	'''
+	Stores tag reads in a SQLite database from a writer thread.
+
+	The thread receiving the reports only queues them. The writer inserts
+	the reads with executemany in batches of batchRows or after interval
+	seconds, in WAL mode so readers of the database do not block it.
+	With aggregate, the table "<table>_summary" keeps first and last
+	time, number of reads and maximum RSSI per (EPC, antenna):
+
+		with SQLiteSink('reads.db', aggregate=True) as sink:
+			reader.startLiveReports(sink.update)
+			...
+			print(sink.metrics())
+	'''
+	columns = ('time', 'epc', 'antenna', 'peak_rssi', 'rssi', 'phase', 'channel',
+		'first_seen', 'last_seen', 'seen_count')
+
+	def __init__(self, path, table='reads', batchRows=5000, interval=1., aggregate=False):
+		''':param path: database file
+		:param table: name of the table with one row per read
+		:param batchRows: insert when that many reads are buffered
+		:param interval: insert buffered reads at least every that many seconds
+		:param aggregate: keep the per (EPC, antenna) summary table
+		'''
+		self.path = path
+		self.table = table
+		self.batchRows = batchRows
+		self.interval = interval
+		self.aggregate = aggregate
+		self.queue = queue.SimpleQueue()
+		self.pending = deque() # (arrival time, reads queued so far) of uncommitted reports
+		self.queued = 0 # number of queued reads
+		self.written = 0 # number of committed reads
+		self.commitSeconds = 0. # duration of the last commit
+		self.error = None # exception which stopped the writer
+		self.lock = threading.Lock()
+		ready = threading.Event()
+		self.thread = threading.Thread(target=self._write, args=(ready,), name='SQLiteSink', daemon=True)
+		self.thread.start()
+		ready.wait()
+		if self.error:
+			raise self.error
+
+	def update(self, tags, now=None):
+		'''queues the reads of a tag report
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param now: receive time in seconds since the epoch, defaults to now
+		:raises: the exception which stopped the writer thread'''
+		if self.error:
+			raise self.error
+		if now is None:
+			now = time.time()
+		with self.lock: # several readers may share the sink
+			self.queued += len(tags)
+			self.pending.append((now, self.queued))
+			self.queue.put((now, tags))
+
+	def metrics(self):
+		''':returns: dictionary with the number of queued and written reads,
+			the reads waiting for their commit, the lag in seconds of the
+			oldest waiting read and the duration of the last commit'''
+		pending = self.pending
+		try:
+			oldest = pending[0][0]
+		except IndexError:
+			oldest = None
+		return {
+			'queued': self.queued,
+			'written': self.written,
+			'waiting': self.queued - self.written,
+			'lag': time.time() - oldest if oldest is not None else 0.,
+			'commitSeconds': self.commitSeconds,
+		}
+
+	def close(self):
+		'''writes the queued reads and closes the database'''
+		if self.thread is None:
+			return
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+		if self.error:
+			raise self.error
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def _open(self):
+		db = sqlite3.connect(self.path)
+		db.execute('PRAGMA journal_mode=WAL')
+		db.execute('PRAGMA synchronous=NORMAL')
+		table = self.table
+		db.execute('''CREATE TABLE IF NOT EXISTS {} (time REAL, epc TEXT, antenna INTEGER, 
+			peak_rssi INTEGER, rssi REAL, phase REAL, channel INTEGER, 
+			first_seen INTEGER, last_seen INTEGER, seen_count INTEGER)'''.format(table))
+		db.execute('CREATE INDEX IF NOT EXISTS {0}_epc ON {0} (epc)'.format(table))
+		db.execute('CREATE INDEX IF NOT EXISTS {0}_time ON {0} (time)'.format(table))
+		self.insert = 'INSERT INTO {} ({}) VALUES ({})'.format(table, 
+			', '.join(self.columns), ', '.join('?' * len(self.columns)))
+		if self.aggregate:
+			db.execute('''CREATE TABLE IF NOT EXISTS {}_summary (epc TEXT, antenna INTEGER, 
+				first_time REAL, last_time REAL, reads INTEGER, max_rssi REAL, 
+				PRIMARY KEY (epc, antenna))'''.format(table))
+			self.upsert = '''INSERT INTO {}_summary VALUES (?, ?, ?, ?, ?, ?) 
+				ON CONFLICT (epc, antenna) DO UPDATE SET 
+				last_time = max(last_time, excluded.last_time), 
+				reads = reads + excluded.reads, 
+				max_rssi = max(coalesce(max_rssi, excluded.max_rssi), coalesce(excluded.max_rssi, max_rssi))'''.format(table)
+		db.commit()
+		return db
+
+	def _rows(self, now, tags):
+		''':returns: list of row tuples of a tag report'''
+		if isinstance(tags, TagBatch):
+			tags = iter(tags)
+		rows = []
+		for tag in tags:
+			if not isinstance(tag, TagRead):
+				tag = TagRead.fromDict(tag)
+			rows.append((now, tag.epc.decode(), tag.antenna, tag.peak_rssi, tag.rssi, tag.phase,
+				tag.channel, tag.first_seen, tag.last_seen, tag.seen_count))
+		return rows
+
+	def _summary(self, rows):
+		''':returns: summary rows of a batch, one per (EPC, antenna)'''
+		summary = {}
+		for now, epc, antenna, peak, rssi, _, _, _, _, count in rows:
+			rssi = rssi if rssi is not None else peak
+			entry = summary.get((epc, antenna))
+			if entry is None:
+				summary[(epc, antenna)] = [epc, antenna, now, now, count or 1, rssi]
+			else:
+				entry[3] = max(entry[3], now)
+				entry[4] += count or 1
+				if rssi is not None and (entry[5] is None or rssi > entry[5]):
+					entry[5] = rssi
+		return summary.values()
+
+	def _commit(self, db, rows, reports):
+		start = time.monotonic()
+		with db:
+			db.executemany(self.insert, rows)
+			if self.aggregate:
+				db.executemany(self.upsert, self._summary(rows))
+		self.commitSeconds = time.monotonic() - start
+		self.written += len(rows)
+		for _ in range(reports):
+			self.pending.popleft()
+
+	def _write(self, ready):
+		'''writer thread'''
+		try:
+			db = self._open()
+		except Exception as err:
+			self.error = err
+			ready.set()
+			return
+		ready.set()
+		rows = []
+		reports = 0
+		first = None # monotonic time of the first buffered read
+		try:
+			running = True
+			while running:
+				timeout = self.interval if first is None else \
+					max(first + self.interval - time.monotonic(), 0.)
+				try:
+					item = self.queue.get(timeout=timeout)
+				except queue.Empty:
+					item = False
+				if item is None:
+					running = False
+				elif item:
+					rows.extend(self._rows(*item))
+					reports += 1
+					if first is None:
+						first = time.monotonic()
+				if reports and (not running or len(rows) >= self.batchRows or 
+						time.monotonic() - first >= self.interval):
+					self._commit(db, rows, reports)
+					rows = []
+					reports = 0
+					first = None
+		except Exception as err:
+			self.error = err
+		finally:
+			db.close()
@@ -0,0 +1,181 @@
+'''
+Incremental statistics of tag reads
+'''
+import math
+import threading
+import time
+
+from .tags import TagRead, TagBatch, tagEPC
+
+
+class RunningStats(object):
+	'''
+	RSSI statistics and read rate of one key with constant memory.
+
+	Mean and variance are updated with Welford's algorithm, so no
+	values are stored. The recent read rate is an exponentially
+	decaying read counter.
+	'''
+	__slots__ = ('count', 'reads', 'mean', 'm2', 'ewma', 'min', 'max',
+		'first', 'last', 'decayed', 'alpha', 'tau')
+
+	def __init__(self, alpha=0.2, tau=1.):
+		''':param alpha: weight of a new value in the exponential moving average
+		:param tau: time constant of the recent read rate in seconds
+		'''
+		self.alpha = alpha
+		self.tau = tau
+		self.count = 0 # number of RSSI values
+		self.reads = 0 # number of reads, including TagSeenCount
+		self.mean = 0.
+		self.m2 = 0.
+		self.ewma = None
+		self.min = None
+		self.max = None
+		self.first = None
+		self.last = None
+		self.decayed = 0.
+
+	def add(self, value, now, reads=1):
+		'''adds one RSSI value
+		:param value: RSSI in dBm or None when only counting reads
+		:param now: time of the read in seconds
+		:param reads: number of reads the value stands for'''
+		if self.last is None:
+			self.first = now
+		else:
+			self.decayed *= math.exp(-max(now - self.last, 0.) / self.tau)
+		self.last = now
+		self.decayed += reads
+		self.reads += reads
+		if value is None:
+			return
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+		if self.ewma is None:
+			self.ewma = self.min = self.max = value
+		else:
+			self.ewma += self.alpha * (value - self.ewma)
+			if value < self.min:
+				self.min = value
+			elif value > self.max:
+				self.max = value
+
+	@property
+	def variance(self):
+		return self.m2 / (self.count - 1) if self.count > 1 else 0.
+
+	@property
+	def std(self):
+		return math.sqrt(self.variance)
+
+	def rate(self, now=None):
+		''':param now: time in seconds, defaults to the last read
+		:returns: recent reads per second'''
+		if self.last is None:
+			return 0.
+		dt = 0. if now is None else max(now - self.last, 0.)
+		return self.decayed * math.exp(-dt / self.tau) / self.tau
+
+	def averageRate(self):
+		''':returns: reads per second since the first read'''
+		if self.last is None or self.last == self.first:
+			return 0.
+		return self.reads / (self.last - self.first)
+
+	def toDict(self, now=None):
+		return {
+			'count': self.count,
+			'reads': self.reads,
+			'mean': self.mean,
+			'std': self.std,
+			'ewma': self.ewma,
+			'min': self.min,
+			'max': self.max,
+			'rate': self.rate(now),
+			'first': self.first,
+			'last': self.last,
+		}
+
+
+class TagStatistics(object):
+	'''
+	Keeps RunningStats per EPC, per antenna and per channel.
+
+	Impinj RSSI (0.01 dB resolution) is used when reported, PeakRSSI
+	otherwise. Can be used as callback for live reports:
+
+		stats = TagStatistics()
+		reader.startLiveReports(stats.update)
+		...
+		stats.get('epc', b'3000...').ewma
+	'''
+	kinds = ('epc', 'antenna', 'channel')
+
+	def __init__(self, alpha=0.2, tau=1.):
+		''':param alpha: weight of a new value in the exponential moving average
+		:param tau: time constant of the recent read rate in seconds
+		'''
+		self.alpha = alpha
+		self.tau = tau
+		self.stats = {kind: {} for kind in self.kinds}
+		self.lock = threading.Lock() # live reports arrive on the reader thread
+
+	def _reads(self, tags):
+		'''yields (epc, antenna, channel, rssi, reads) of each read'''
+		if isinstance(tags, TagBatch):
+			tags = iter(tags)
+		for tag in tags:
+			if isinstance(tag, TagRead):
+				rssi = tag.rssi if tag.rssi is not None else tag.peak_rssi
+				yield tag.epc, tag.antenna, tag.channel, rssi, tag.seen_count or 1
+			else:
+				epc = tagEPC(tag)
+				yield (epc, tag.get('AntennaID'), tag.get('ChannelIndex'),
+					tag.get('RSSI', tag.get('PeakRSSI')), tag.get('TagSeenCount', 1))
+
+	def _add(self, table, key, value, now, reads):
+		try:
+			stats = table[key]
+		except KeyError:
+			stats = table[key] = RunningStats(self.alpha, self.tau)
+		stats.add(value, now, reads)
+
+	def update(self, tags, now=None):
+		'''adds the reads of a tag report
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param now: time of the reads in seconds. Defaults to time.monotonic()'''
+		if now is None:
+			now = time.monotonic()
+		byEPC, byAntenna, byChannel = (self.stats[kind] for kind in self.kinds)
+		with self.lock:
+			for epc, antenna, channel, rssi, reads in self._reads(tags):
+				self._add(byEPC, epc, rssi, now, reads)
+				if antenna is not None:
+					self._add(byAntenna, antenna, rssi, now, reads)
+				if channel is not None:
+					self._add(byChannel, channel, rssi, now, reads)
+
+	def get(self, kind, key):
+		''':param kind: "epc", "antenna" or "channel"
+		:param key: EPC, antenna port or channel index
+		:returns: RunningStats or None'''
+		return self.stats[kind].get(key)
+
+	def keys(self, kind):
+		with self.lock:
+			return list(self.stats[kind])
+
+	def snapshot(self, kind='epc', now=None):
+		''':param kind: "epc", "antenna" or "channel"
+		:param now: time for the recent read rate, defaults to the last read of each key
+		:returns: dictionary key -> statistics dictionary'''
+		with self.lock:
+			return {key: stats.toDict(now) for key, stats in self.stats[kind].items()}
+
+	def reset(self):
+		with self.lock:
+			for table in self.stats.values():
+				table.clear()
@@ -0,0 +1,314 @@
+'''
+Compact containers for tag reads
+'''
+from array import array
+import math
+
+try:
+	import numpy as np # optional, for TagBatch.toNumpy
+except ImportError:
+	np = None
+
+
+def tagEPC(tag):
+	''':param tag: tag dictionary of a tag report or TagRead
+	:returns: EPC as hex bytes, of EPC-96 or EPCData'''
+	if isinstance(tag, TagRead):
+		return tag.epc
+	return tag['EPC-96'] if 'EPC-96' in tag else tag['EPCData']['EPC']
+
+
+class TagRead(object):
+	'''
+	One entry of a tag report with attribute access.
+
+	Uses __slots__ instead of a dictionary per tag, which takes several
+	times less memory when many reads are kept. For compatibility, the
+	LLRP field names can still be used as keys, e.g. tag['PeakRSSI'].
+	Fields without an attribute (UTC timestamps, ROSpecID, OpSpecResult, ...)
+	are kept in "extra". TagReads are not hashable, like dictionaries.
+	'''
+	__slots__ = ('epc', 'antenna', 'peak_rssi', 'channel', 'first_seen',
+		'last_seen', 'seen_count', 'phase', 'rssi', 'extra')
+
+	# LLRP field name -> attribute
+	fields = {
+		'EPC-96': 'epc',
+		'AntennaID': 'antenna',
+		'PeakRSSI': 'peak_rssi',
+		'ChannelIndex': 'channel',
+		'FirstSeenTimestampUptime': 'first_seen',
+		'LastSeenTimestampUptime': 'last_seen',
+		'TagSeenCount': 'seen_count',
+		'PhaseAngle': 'phase',
+		'RSSI': 'rssi',
+	}
+
+	def __init__(self, epc, antenna=None, peak_rssi=None, channel=None,
+			first_seen=None, last_seen=None, seen_count=None, phase=None,
+			rssi=None, extra=None):
+		''':param epc: EPC as hex bytes, like in the tag report
+		:param antenna: antenna port
+		:param peak_rssi: peak RSSI in dBm
+		:param channel: channel index of the frequency table
+		:param first_seen: first seen timestamp (reader uptime in us)
+		:param last_seen: last seen timestamp (reader uptime in us)
+		:param seen_count: number of reads
+		:param phase: Impinj phase angle in degree
+		:param rssi: Impinj RSSI in dBm with 0.01 dB resolution
+		:param extra: dictionary of other tag report fields or None
+		'''
+		self.epc = epc
+		self.antenna = antenna
+		self.peak_rssi = peak_rssi
+		self.channel = channel
+		self.first_seen = first_seen
+		self.last_seen = last_seen
+		self.seen_count = seen_count
+		self.phase = phase
+		self.rssi = rssi
+		self.extra = extra
+
+	@classmethod
+	def fromDict(cls, tag):
+		'''creates a TagRead from a decoded TagReportData dictionary'''
+		self = cls(None)
+		fields = cls.fields
+		extra = None
+		for key, value in tag.items():
+			attr = fields.get(key)
+			if attr:
+				setattr(self, attr, value)
+			elif key == 'EPCData':
+				self.epc = value['EPC']
+				extra = extra or {}
+				extra['EPCLengthBits'] = value['EPCLengthBits']
+			else:
+				extra = extra or {}
+				extra[key] = value
+		self.extra = extra
+		return self
+
+	def toDict(self):
+		''':returns: the tag as TagReportData dictionary'''
+		tag = {}
+		extra = self.extra or {}
+		for key, attr in self.fields.items():
+			value = getattr(self, attr)
+			if value is not None:
+				tag[key] = value
+		if 'EPCLengthBits' in extra:
+			del tag['EPC-96']
+			tag['EPCData'] = {'EPCLengthBits': extra['EPCLengthBits'], 'EPC': self.epc}
+		for key, value in extra.items():
+			if key != 'EPCLengthBits':
+				tag[key] = value
+		return tag
+
+	def __getitem__(self, key):
+		attr = self.fields.get(key)
+		if attr:
+			value = getattr(self, attr)
+			if value is not None:
+				return value
+		elif key == 'EPCData' and self.extra and 'EPCLengthBits' in self.extra:
+			return {'EPCLengthBits': self.extra['EPCLengthBits'], 'EPC': self.epc}
+		elif self.extra and key in self.extra:
+			return self.extra[key]
+		raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		attr = self.fields.get(key)
+		if attr:
+			setattr(self, attr, value)
+		else:
+			if self.extra is None:
+				self.extra = {}
+			self.extra[key] = value
+
+	def __contains__(self, key):
+		try:
+			self[key]
+			return True
+		except KeyError:
+			return False
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def __eq__(self, other):
+		if isinstance(other, TagRead):
+			return all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+		return NotImplemented
+
+	# reads compare by value but can be changed, like dictionaries they are
+	# not hashable. Use tag.epc as key of sets and dictionaries.
+	__hash__ = None
+
+	def __repr__(self):
+		return 'TagRead({})'.format(', '.join('{}={!r}'.format(a, getattr(self, a))
+			for a in self.__slots__ if getattr(self, a) is not None))
+
+
+class TagBatch(object):
+	'''
+	Tag reads stored column by column in typed arrays.
+	
+	Holds one tag report or an accumulated window of reports. Every tag read 
+	is a row, every TagRead attribute a column. EPCs are stored once in 
+	"epcs" and referenced by the "epc" index column. Missing values are 
+	0 for integer columns and NaN for phase and rssi.
+	'''
+	# column name -> (array typecode, TagRead attribute, value if missing)
+	columns = {
+		'epc': ('l', None, 0),
+		'antenna': ('H', 'antenna', 0),
+		'peak_rssi': ('b', 'peak_rssi', 0),
+		'channel': ('H', 'channel', 0),
+		'first_seen': ('Q', 'first_seen', 0),
+		'last_seen': ('Q', 'last_seen', 0),
+		'seen_count': ('H', 'seen_count', 0),
+		'phase': ('d', 'phase', float('nan')),
+		'rssi': ('d', 'rssi', float('nan')),
+	}
+	
+	def __init__(self, shared=None):
+		''':param shared: other TagBatch to share the EPC list with, 
+			so that the EPC indices of both batches are comparable'''
+		if shared is not None:
+			self.epcs = shared.epcs
+			self.epcIndex = shared.epcIndex
+		else:
+			self.epcs = []
+			self.epcIndex = {}
+		self.data = {name: array(col[0]) for name, col in self.columns.items()}
+	
+	@classmethod
+	def fromTags(cls, tags, shared=None):
+		'''creates a batch from a tag report
+		:param tags: list of tag dictionaries or TagRead objects
+		:param shared: other TagBatch to share the EPC list with
+		:returns: TagBatch'''
+		batch = cls(shared)
+		batch.extendTags(tags)
+		return batch
+	
+	def epcId(self, epc):
+		''':returns: index of an EPC in "epcs", adds it when unknown'''
+		try:
+			return self.epcIndex[epc]
+		except KeyError:
+			i = self.epcIndex[epc] = len(self.epcs)
+			self.epcs.append(epc)
+			return i
+	
+	def extendTags(self, tags):
+		'''appends tag dictionaries or TagRead objects as rows'''
+		rows = [tag if isinstance(tag, TagRead) else TagRead.fromDict(tag) for tag in tags]
+		self.data['epc'].extend([self.epcId(tag.epc) for tag in rows])
+		for name, (_, attr, missing) in self.columns.items():
+			if attr:
+				self.data[name].extend([missing if getattr(tag, attr) is None 
+					else getattr(tag, attr) for tag in rows])
+	
+	def extend(self, other):
+		'''appends all rows of another batch'''
+		if other.epcIndex is self.epcIndex:
+			self.data['epc'].extend(other.data['epc'])
+		else:
+			self.data['epc'].extend([self.epcId(epc) for epc in other.epcColumn()])
+		for name in self.columns:
+			if name != 'epc':
+				self.data[name].extend(other.data[name])
+	
+	@classmethod
+	def concat(cls, batches):
+		''':returns: new batch with the rows of all batches'''
+		result = cls()
+		for batch in batches:
+			result.extend(batch)
+		return result
+	
+	def __len__(self):
+		return len(self.data['epc'])
+	
+	def __getattr__(self, name):
+		# columns as attributes, e.g. batch.antenna
+		if name in TagBatch.columns:
+			return self.data[name]
+		raise AttributeError(name)
+	
+	def __getitem__(self, i):
+		''':returns: row as TagRead'''
+		values = {}
+		for name, (_, attr, missing) in self.columns.items():
+			if attr:
+				value = self.data[name][i]
+				if not (value == missing or (isinstance(value, float) and math.isnan(value))):
+					values[attr] = value
+		return TagRead(self.epcs[self.data['epc'][i]], **values)
+	
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+	
+	def epcColumn(self):
+		''':returns: list with the EPC of every row'''
+		epcs = self.epcs
+		return [epcs[i] for i in self.data['epc']]
+	
+	def take(self, indices):
+		''':param indices: row indices, e.g. a NumPy integer array
+		:returns: new batch with the selected rows, sharing the EPC list'''
+		batch = TagBatch(self)
+		if np is not None:
+			indices = np.asarray(indices, dtype=np.intp)
+			for name, column in self.toNumpy().items():
+				batch.data[name].frombytes(column[indices].tobytes())
+			return batch
+		for name, (typecode, _, _) in self.columns.items():
+			column = self.data[name]
+			batch.data[name] = array(typecode, [column[i] for i in indices])
+		return batch
+	
+	def where(self, mask):
+		''':param mask: sequence of booleans, one per row (e.g. a NumPy bool array)
+		:returns: new batch with the rows where mask is true'''
+		if np is not None:
+			return self.take(np.flatnonzero(np.asarray(mask, dtype=bool)))
+		return self.take([i for i, keep in enumerate(mask) if keep])
+	
+	def groupByEPC(self):
+		''':returns: dictionary EPC -> list of row indices'''
+		if np is not None:
+			if not len(self):
+				return {}
+			ids = self.toNumpy()['epc']
+			rows = np.argsort(ids, kind='stable')
+			ids = ids[rows]
+			starts = np.flatnonzero(np.diff(ids)) + 1
+			epcs = self.epcs
+			return {epcs[i]: group.tolist() for i, group in 
+				zip(ids[np.concatenate(([0], starts))].tolist(), np.split(rows, starts))}
+		groups = {}
+		for row, i in enumerate(self.data['epc']):
+			groups.setdefault(i, []).append(row)
+		return {self.epcs[i]: rows for i, rows in groups.items()}
+	
+	def toNumpy(self):
+		'''Gets the columns as NumPy arrays without copying the data.
+		:returns: dictionary column name -> NumPy array'''
+		if np is None:
+			raise ImportError('TagBatch.toNumpy needs numpy')
+		return {name: np.frombuffer(column, dtype=column.typecode) if len(column) 
+			else np.array([], dtype=column.typecode) for name, column in self.data.items()}
+	
+	def toTags(self):
+		''':returns: list of TagRead objects'''
+		return list(self)
+	
+	def __repr__(self):
+		return 'TagBatch({} tags, {} EPCs)'.format(len(self), len(self.epcs))
@@ -0,0 +1,215 @@
+'''
+Automatic tuning of the inventory settings from observed reads
+'''
+import math
+import time
+
+from .tags import TagRead, TagBatch, tagEPC
+
+
+def frameSlots(population):
+	''':param population: TagPopulation setting of C1G2SingulationControl
+	:returns: number of slots of the first inventory frame, 2**Q'''
+	return 2 ** int(math.ceil(math.log2(max(population, 1))))
+
+
+def slotEfficiency(tags, population):
+	'''Expected share of slots with exactly one reply in framed slotted ALOHA.
+	Empty slots and collisions waste air time.
+	:param tags: number of replying tags
+	:param population: TagPopulation setting
+	:returns: probability of a successful slot, at most 1/e for many tags'''
+	if tags <= 0:
+		return 0.
+	slots = frameSlots(population)
+	return tags / slots * (1. - 1./slots) ** (tags - 1)
+
+
+def bestPopulation(tags, maxPopulation=1024):
+	''':param tags: estimated number of replying tags
+	:param maxPopulation: upper limit of the result
+	:returns: TagPopulation setting with the best slot efficiency'''
+	if tags <= 1:
+		return 1
+	q = math.log2(tags)
+	candidates = {min(2 ** int(math.floor(q)), maxPopulation), min(2 ** int(math.ceil(q)), maxPopulation)}
+	return max(sorted(candidates), key=lambda population: slotEfficiency(tags, population))
+
+
+class PopulationTuner(object):
+	'''
+	Adjusts population, session and Impinj searchmode between inventories.
+
+	The number of replying tags is estimated from the unique tags of each
+	round. The population is changed when the ALOHA model of the first
+	frame promises more successful slots. Each (session, searchmode)
+	candidate is measured for a few rounds and the one with the most
+	reads per second is kept. Settings only change when the expected gain
+	is above minGain, because every change reinstalls the ROSpec.
+
+		tuner = PopulationTuner(reader, candidates=((2, 0), (1, 0), (2, 2)))
+		for tags in tuner.inventory(powerDBm=25):
+			...
+	'''
+	def __init__(self, reader, population=1, session=2, searchmode=None, candidates=None,
+			minGain=0.1, alpha=0.3, exploreRounds=3, maxPopulation=1024):
+		''':param reader: connected Reader
+		:param population: initial TagPopulation
+		:param session: initial session
+		:param searchmode: initial Impinj searchmode, None for readers without it
+		:param candidates: (session, searchmode) pairs to try.
+			Defaults to only the initial session and searchmode
+		:param minGain: minimum relative gain (0.1 = 10 %) to change the settings
+		:param alpha: weight of a new round in the moving averages
+		:param exploreRounds: rounds to measure each candidate before comparing
+		:param maxPopulation: upper limit of the population
+		'''
+		self.reader = reader
+		self.population = population
+		self.session = session
+		self.searchmode = searchmode
+		self.candidates = list(candidates or [(session, searchmode)])
+		if (session, searchmode) not in self.candidates:
+			self.candidates.insert(0, (session, searchmode))
+		self.minGain = minGain
+		self.alpha = alpha
+		self.exploreRounds = exploreRounds
+		self.maxPopulation = maxPopulation
+		self.tags = None # moving average of unique tags per round
+		self.measured = {} # (session, searchmode) -> [reads per second, rounds]
+		self.changes = 0 # number of setting changes
+
+	@property
+	def settings(self):
+		''':returns: keyword arguments for detectTags or inventory'''
+		settings = {'population': self.population, 'session': self.session}
+		if self.searchmode is not None:
+			settings['searchmode'] = self.searchmode
+		return settings
+
+	def _ewma(self, old, new):
+		return new if old is None else old + self.alpha * (new - old)
+
+	def observe(self, tags, duration):
+		'''adds the result of one inventory round with the current settings
+		:param tags: list of tag dictionaries or TagRead objects, or a TagBatch
+		:param duration: air time of the round in seconds, e.g. the report interval'''
+		if isinstance(tags, TagBatch):
+			unique = len(set(tags.epc))
+			reads = sum(count or 1 for count in tags.seen_count)
+		else:
+			epcs = set()
+			reads = 0
+			for tag in tags:
+				if isinstance(tag, TagRead):
+					epcs.add(tag.epc)
+					reads += tag.seen_count or 1
+				else:
+					epcs.add(tagEPC(tag))
+					reads += tag.get('TagSeenCount', 1)
+			unique = len(epcs)
+		self.tags = self._ewma(self.tags, unique)
+		if duration > 0:
+			measured = self.measured.setdefault((self.session, self.searchmode), [None, 0])
+			measured[0] = self._ewma(measured[0], reads / duration)
+			measured[1] += 1
+
+	def propose(self):
+		''':returns: dictionary of settings to change, or None to keep them'''
+		change = {}
+		current = (self.session, self.searchmode)
+		candidate = self._nextCandidate(current)
+		if candidate != current:
+			change['session'], change['searchmode'] = candidate
+		if self.tags is not None:
+			population = bestPopulation(self.tags, self.maxPopulation)
+			old = slotEfficiency(self.tags, self.population)
+			new = slotEfficiency(self.tags, population)
+			if population != self.population and (not old or new / old - 1. > self.minGain):
+				change['population'] = population
+		if not change:
+			return None
+		if self.searchmode is None:
+			change.pop('searchmode', None)
+		return change
+
+	def _nextCandidate(self, current):
+		'''explores candidates which have too few rounds, then picks the fastest'''
+		rounds = self.measured.get(current, (None, 0))[1]
+		if rounds < self.exploreRounds:
+			return current
+		for candidate in self.candidates:
+			if self.measured.get(candidate, (None, 0))[1] < self.exploreRounds:
+				return candidate
+		rate = self.measured[current][0]
+		best = max(self.candidates, key=lambda candidate: self.measured[candidate][0])
+		if self.measured[best][0] > rate * (1. + self.minGain):
+			return best
+		return current
+
+	def step(self, tags, duration):
+		'''observes a round and applies the proposed settings
+		:returns: dictionary of changed settings or None'''
+		self.observe(tags, duration)
+		return self._apply()
+
+	def _apply(self):
+		'''applies the proposed settings
+		:returns: dictionary of changed settings or None'''
+		change = self.propose()
+		if change:
+			for name, value in change.items():
+				setattr(self, name, value)
+			self.changes += 1
+		return change
+
+	def detectTags(self, **kwargs):
+		'''runs Reader.detectTags with the tuned settings and learns from every round.
+		The air time of a round is the report interval, or the time since the
+		previous report when the inventory stopped early. The setup of the
+		ROSpec is not counted.
+		The other parameters are the same as in "detectTags"'''
+		reader = self.reader
+		arrivals = []
+		def received(msgdict):
+			arrivals.append(time.monotonic())
+		kwargs.update(self.settings)
+		reader.addMsgCallback('RO_ACCESS_REPORT', received)
+		try:
+			last = time.monotonic()
+			tags = reader.detectTags(**kwargs)
+		finally:
+			reader.removeMsgCallback('RO_ACCESS_REPORT', received)
+		interval = reader.report_interval # the duration of detectTags
+		rounds = tags if kwargs.get('rounds', 1) > 1 else [tags]
+		for i, roundTags in enumerate(rounds):
+			if i < len(arrivals):
+				# setup round trips delay the first report, decoding the later ones
+				duration = min(interval, arrivals[i] - last)
+				last = arrivals[i]
+			else:
+				duration = interval
+			self.observe(roundTags, duration)
+		self._apply()
+		return tags
+
+	def inventory(self, rounds=None, **kwargs):
+		'''yields the tag list of every tag report like Reader.inventory(batches=True).
+		The ROSpec is reinstalled whenever the settings change.
+		:param rounds: stop after that many tag reports. None runs until the generator is closed
+		The other parameters are the same as in "inventory"'''
+		kwargs['batches'] = True
+		kwargs.pop('rounds', None)
+		done = 0
+		while rounds is None or done < rounds:
+			kwargs.update(self.settings)
+			with self.reader.inventory(**kwargs) as stream:
+				last = time.monotonic()
+				for tags in stream:
+					now = time.monotonic()
+					change = self.step(tags, now - last)
+					last = now
+					done += 1
+					yield tags
+					if change or (rounds is not None and done >= rounds):
+						break
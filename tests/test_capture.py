@@ -0,0 +1,72 @@
+import os
+import struct
+
+from sllurp.capture import FrameRecorder, CaptureFile, CHUNK_HEADER, COMPRESSED_MAGIC, \
+	INDEX_ENTRY, INDEX_MAGIC, indexPath, readRecords
+
+
+def frame(n, size=200):
+	'''RO_ACCESS_REPORT with a counter and padding'''
+	body = struct.pack('!I', n) + bytes(size)
+	return struct.pack('!HII', (1 << 10) | 61, len(body) + 10, n) + body
+
+
+def record(path, numbers, **kwargs):
+	with FrameRecorder(path, **kwargs) as recorder:
+		for n in numbers:
+			recorder.received(frame(n), t=float(n))
+
+
+def recorded(path):
+	''':returns: counters of the frames in a capture, checking the index'''
+	with CaptureFile(path) as capture:
+		numbers = [struct.unpack_from('!I', bytes(f), 10)[0] for _, _, f in capture.frames()]
+		assert [t for t, _, _ in capture.frames()] == [float(n) for n in numbers]
+	return numbers
+
+
+def chunkOffsets(path):
+	''':returns: file offsets of the chunks of a compressed capture'''
+	with open(path, 'rb') as file:
+		data = file.read()
+	offsets = []
+	offset = len(COMPRESSED_MAGIC)
+	while offset < len(data):
+		offsets.append(offset)
+		offset += CHUNK_HEADER.size + CHUNK_HEADER.unpack_from(data, offset)[1]
+	return offsets
+
+
+def test_truncated_last_chunk(tmp_path):
+	path = str(tmp_path / 'capture.llrp')
+	record(path, range(30), compression='zlib', chunkSize=2000)
+	offsets = chunkOffsets(path)
+	assert len(offsets) > 2
+	# crash while writing the last chunk, after the index entries of the chunks before
+	with open(path, 'r+b') as file:
+		file.truncate(offsets[-1] + CHUNK_HEADER.size + 3)
+
+	record(path, range(100, 110), compression='zlib', chunkSize=2000)
+	numbers = recorded(path)
+	lost = [n for n in range(30) if n not in numbers]
+	assert lost and lost == list(range(30 - len(lost), 30)) # only the last chunk
+	assert numbers == [n for n in range(30) if n not in lost] + list(range(100, 110))
+	# the entries of the lost records were dropped
+	assert os.path.getsize(indexPath(path)) == len(INDEX_MAGIC) + len(numbers) * INDEX_ENTRY.size
+
+
+def test_torn_record(tmp_path):
+	path = str(tmp_path / 'capture.llrp')
+	record(path, range(5))
+	size = os.path.getsize(path)
+	# crash in the middle of a record whose index entry was already written
+	with open(path, 'ab') as file:
+		file.write(frame(5)[:7])
+	with open(indexPath(path), 'ab') as index:
+		index.write(INDEX_ENTRY.pack(5., size, 61, 0, 0))
+
+	record(path, range(6, 9))
+	assert recorded(path) == [0, 1, 2, 3, 4, 6, 7, 8]
+	assert os.path.getsize(indexPath(path)) == len(INDEX_MAGIC) + 8 * INDEX_ENTRY.size
+	with open(path, 'rb') as file:
+		assert [t for t, _, _ in readRecords(file)] == [0., 1., 2., 3., 4., 6., 7., 8.]
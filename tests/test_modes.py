@@ -0,0 +1,31 @@
+import struct
+
+import pytest
+
+from sllurp.llrp_proto import decode_UHFC1G2RFModeTableEntry
+from sllurp.modes import linkTimes, theoreticalThroughput
+
+
+def modeEntry(identifier, mod, m, bdr, pie=2000, tari=25000):
+	''':returns: decoded UHFC1G2RFModeTableEntry
+	:param mod: tag encoding, 0 for FM0 to 3 for Miller 8
+	:param m: spectral mask indicator'''
+	body = struct.pack('!IBBBBIIIII', identifier, 0x80, mod, 0, m, bdr, pie, tari, tari, 0)
+	mode, rest = decode_UHFC1G2RFModeTableEntry(struct.pack('!HH', 329, len(body) + 4) + body)
+	assert not rest
+	return mode
+
+
+def test_encoding_is_mod_not_spectral_mask():
+	# FM0 with the dense reader mask and Miller 8 with an unknown mask
+	fm0 = modeEntry(0, mod=0, m=3, bdr=40000)
+	miller8 = modeEntry(1, mod=3, m=0, bdr=40000)
+	success, collision, empty = linkTimes(fm0)
+	# QueryRep, T1 of 10 link periods and the short FM0 preamble
+	tari = 25e-6
+	assert empty == pytest.approx(12.5e-6 + 4 * tari + 4 * 1.5 * tari + 10 / 40000. + 6 / 40000.)
+	# Miller 8: T1 is limited by RTcal and the preamble is longer
+	assert linkTimes(miller8)[2] == pytest.approx(12.5e-6 + 4 * tari + 4 * 1.5 * tari + 3 * tari + 10 / 40000.)
+	# the spectral mask does not change the link
+	assert linkTimes(modeEntry(2, mod=0, m=0, bdr=40000)) == pytest.approx((success, collision, empty))
+	assert theoreticalThroughput(fm0) != theoreticalThroughput(miller8)
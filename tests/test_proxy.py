@@ -0,0 +1,236 @@
+import socket
+import struct
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from sllurp.llrp import Transport
+from sllurp.proxy import LLRPProxy, HELLO, statusResponse, _message
+
+RO_ACCESS_REPORT = 61
+READER_EVENT_NOTIFICATION = 63
+ERROR_MESSAGE = 100
+
+
+def addROSpec(roSpecID, msgid):
+	return _message(20, struct.pack('!HHI', 177, 8, roSpecID), msgid)
+
+
+def specCommand(msgtype, specID, msgid):
+	return _message(msgtype, struct.pack('!I', specID), msgid)
+
+
+def readFrames(sock, count, timeout=2.):
+	'''reads count frames from a subscriber socket'''
+	sock.settimeout(timeout)
+	data = b''
+	frames = []
+	while len(frames) < count:
+		while len(data) < 10 or len(data) < struct.unpack_from('!I', data, 2)[0]:
+			data += sock.recv(65536)
+		length = struct.unpack_from('!I', data, 2)[0]
+		frames.append(data[:length])
+		data = data[length:]
+	return frames
+
+
+def header(frame):
+	''':returns: (message type, message ID)'''
+	msgtype, _, msgid = struct.unpack_from('!HII', frame)
+	return msgtype & 0x3ff, msgid
+
+
+class FakeReader(object):
+	'''answers every command on the other end of a socket pair'''
+	def __init__(self, sock):
+		self.sock = sock
+		self.commands = [] # (type, message ID, ROSpecID or AccessSpecID)
+		self.delays = {} # message type -> seconds until the response
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def send(self, frame):
+		try:
+			self.sock.sendall(frame)
+		except OSError:
+			pass # closed at the end of a test
+
+	def _run(self):
+		data = b''
+		while True:
+			try:
+				chunk = self.sock.recv(65536)
+			except OSError:
+				return
+			if not chunk:
+				return
+			data += chunk
+			while len(data) >= 10 and len(data) >= struct.unpack_from('!I', data, 2)[0]:
+				length = struct.unpack_from('!I', data, 2)[0]
+				frame, data = data[:length], data[length:]
+				msgtype, msgid = header(frame)
+				specID = struct.unpack_from('!I', frame, 14 if msgtype in (20, 40) else 10)[0] \
+					if len(frame) >= 14 else None
+				self.commands.append((msgtype, msgid, specID))
+				response = statusResponse(msgtype + 10, msgid)
+				delay = self.delays.get(msgtype)
+				if delay:
+					threading.Timer(delay, self.send, (response,)).start()
+				else:
+					self.send(response)
+
+
+@pytest.fixture
+def proxy(tmp_path):
+	readerSide, clientSide = socket.socketpair()
+	transport = Transport()
+	transport.sock = clientSide
+	reader = FakeReader(readerSide)
+	proxy = LLRPProxy(SimpleNamespace(transport=transport, recorders=[]),
+		str(tmp_path / 'reader.sock'), queueSize=10, commandTimeout=.2)
+	proxy.start()
+	proxy.reader = reader
+	yield proxy
+	proxy.close()
+	readerSide.close()
+
+
+def subscribe(proxy, types=None):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(proxy.path)
+	if types is not None:
+		sock.sendall(HELLO + ('{"types": %s}' % list(types)).replace("'", '"').encode() + b'\n')
+	assert header(readFrames(sock, 1)[0])[0] == READER_EVENT_NOTIFICATION
+	return sock
+
+
+def waitFor(condition, timeout=2.):
+	end = time.time() + timeout
+	while not condition():
+		assert time.time() < end
+		time.sleep(.01)
+
+
+def test_message_ids_are_rewritten(proxy):
+	first, second = subscribe(proxy), subscribe(proxy)
+	first.sendall(addROSpec(1, 7))
+	second.sendall(addROSpec(1, 7))
+	assert header(readFrames(first, 1)[0]) == (30, 7)
+	assert header(readFrames(second, 1)[0]) == (30, 7)
+	ids = [msgid for _, msgid, _ in proxy.reader.commands]
+	assert len(set(ids)) == 2 and 7 not in ids
+
+
+def test_delete_all_only_deletes_own_specs(proxy):
+	first, second = subscribe(proxy), subscribe(proxy)
+	first.sendall(addROSpec(1, 1))
+	readFrames(first, 1)
+	second.sendall(addROSpec(1, 1))
+	readFrames(second, 1)
+	firstID, secondID = [specID for _, _, specID in proxy.reader.commands]
+	assert firstID != secondID
+
+	first.sendall(specCommand(21, 0, 2)) # DELETE_ROSPEC of all, as in stopPolitely
+	assert header(readFrames(first, 1)[0]) == (31, 2)
+	assert proxy.reader.commands[-1][0::2] == (21, firstID)
+
+	# the spec of the second subscriber is still there and reachable
+	second.sendall(specCommand(24, 1, 2)) # ENABLE_ROSPEC
+	assert header(readFrames(second, 1)[0]) == (34, 2)
+	assert proxy.reader.commands[-1][0::2] == (24, secondID)
+
+	# the first subscriber cannot touch it
+	count = len(proxy.reader.commands)
+	first.sendall(specCommand(23, 1, 3)) # STOP_ROSPEC
+	response = readFrames(first, 1)[0]
+	assert header(response) == (33, 3)
+	assert struct.unpack_from('!H', response, 14)[0] == 101 # M_FieldError
+	assert len(proxy.reader.commands) == count
+
+
+def test_specs_are_deleted_on_disconnect(proxy):
+	first, second = subscribe(proxy), subscribe(proxy)
+	first.sendall(addROSpec(1, 1))
+	readFrames(first, 1)
+	second.sendall(addROSpec(1, 1))
+	readFrames(second, 1)
+	firstID, secondID = [specID for _, _, specID in proxy.reader.commands]
+	first.close()
+	waitFor(lambda: proxy.reader.commands[-1][0::2] == (21, firstID))
+	time.sleep(.1)
+	assert (21, secondID) not in [command[0::2] for command in proxy.reader.commands]
+
+
+def test_type_filter(proxy):
+	everything = subscribe(proxy)
+	reports = subscribe(proxy, types=('RO_ACCESS_REPORT',))
+	waitFor(lambda: len(proxy.stats()) == 2)
+	time.sleep(.1) # the filter is applied by the receiver thread
+	proxy.reader.send(_message(READER_EVENT_NOTIFICATION))
+	proxy.reader.send(_message(RO_ACCESS_REPORT))
+	assert [header(frame)[0] for frame in readFrames(everything, 2)] == \
+		[READER_EVENT_NOTIFICATION, RO_ACCESS_REPORT]
+	assert [header(frame)[0] for frame in readFrames(reports, 1)] == [RO_ACCESS_REPORT]
+
+
+def test_slow_subscriber_drops(proxy):
+	slow = subscribe(proxy) # never reads
+	fast = subscribe(proxy)
+	received = [0]
+	def drain():
+		fast.settimeout(5.)
+		try:
+			while True:
+				received[0] += len(fast.recv(1 << 20))
+		except OSError:
+			pass
+	threading.Thread(target=drain, daemon=True).start()
+	report = _message(RO_ACCESS_REPORT, bytes(60000))
+	count = 200
+	for _ in range(count):
+		proxy.reader.send(report)
+	waitFor(lambda: received[0] == count * len(report), timeout=10.)
+	stats = {s['name']: s for s in proxy.stats()}
+	assert stats['subscriber 1']['dropped'] > 0
+	assert stats['subscriber 2']['dropped'] == 0
+	slow.close()
+
+
+def test_late_response_goes_to_sender(proxy):
+	first, second = subscribe(proxy), subscribe(proxy)
+	first.sendall(addROSpec(1, 1))
+	readFrames(first, 1)
+	proxy.reader.delays[21] = .5 # DELETE_ROSPEC is answered after the timeout
+	first.sendall(specCommand(21, 0, 5))
+	time.sleep(.3)
+	second.sendall(addROSpec(2, 6))
+	assert [header(frame) for frame in readFrames(second, 1)] == [(30, 6)]
+	assert [header(frame) for frame in readFrames(first, 1)] == [(31, 5)]
+	second.settimeout(.5)
+	with pytest.raises(socket.timeout):
+		second.recv(1) # the late response went to the first subscriber only
+
+
+def test_write_failure_stops_proxy(proxy):
+	subscriber = subscribe(proxy)
+	def fail(frame):
+		raise OSError('broken pipe')
+	proxy.client.transport.write = fail
+	subscriber.sendall(addROSpec(1, 9))
+	assert header(readFrames(subscriber, 1)[0]) == (ERROR_MESSAGE, 9)
+	waitFor(lambda: not proxy.running)
+	subscriber.settimeout(1.)
+	assert subscriber.recv(1) == b'' # closed
+
+
+def test_close_connection(proxy):
+	subscriber = subscribe(proxy)
+	subscriber.sendall(_message(14, msgid=4)) # CLOSE_CONNECTION
+	response = readFrames(subscriber, 1)[0]
+	assert header(response) == (24, 4)
+	assert struct.unpack_from('!H', response, 14)[0] == 0 # M_Success
+	assert subscriber.recv(1) == b'' # closed
+	waitFor(lambda: not proxy.stats())
+	assert not proxy.reader.commands # not forwarded to the reader